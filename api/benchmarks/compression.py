@@ -0,0 +1,80 @@
+"""
+Measure the size reduction and CPU cost of compressing typical large responses
+(job listings, job exports and logs), with the fake data used to populate the test database,
+for each encoding supported by CompressionMiddleware at a range of levels.
+
+This benchmark does not need a database. Run from the "api" directory:
+
+    python -m benchmarks.compression
+
+"""
+
+import random
+import time
+from typing import List
+
+from fake_data import fake, fake_job, fake_log
+from simqueue.compression import COMPRESSORS
+from simqueue.data_models import Job
+from simqueue.responses import ModelResponse
+from simqueue import settings
+
+N_JOBS = 1000
+N_LOG_LINES = 20000
+LEVELS = {"gzip": (1, 6, 9), "br": (1, 4, 6, 11), "zstd": (1, 3, 9, 19)}
+REPEATS = 3
+
+
+def fake_job_rows(n_jobs):
+    jobs = []
+    for i in range(1, n_jobs + 1):
+        job = fake_job()
+        job.update(
+            id=i,
+            timestamp_completion=job.get("timestamp_completion", None),
+            provenance=job.get("provenance", None),
+            resource_usage=None,
+            input_data=[],
+            output_data=[],
+            tags=fake.words(random.randint(0, 3)),
+        )
+        jobs.append(job)
+    return jobs
+
+
+def payloads():
+    jobs = [Job.from_db(row) for row in fake_job_rows(N_JOBS)]
+    return {
+        f"job list ({N_JOBS} jobs)": ModelResponse(jobs, List[Job]).body,
+        f"job export, NDJSON ({N_JOBS} jobs)": "".join(
+            job.model_dump_json(exclude_unset=True) + "\n" for job in jobs
+        ).encode("utf-8"),
+        f"log ({N_LOG_LINES} lines)": fake_log(N_LOG_LINES).encode("utf-8"),
+    }
+
+
+def measure(compressor_cls, level, data):
+    timings = []
+    for repeat in range(REPEATS):
+        start = time.perf_counter()
+        compressor = compressor_cls(level)
+        compressed = compressor.compress(data) + compressor.flush()
+        timings.append(time.perf_counter() - start)
+    return len(compressed), min(timings)
+
+
+def main():
+    for name, data in payloads().items():
+        print(f"{name}: {len(data) / 1e6:.2f} MB")
+        for encoding, compressor_cls in COMPRESSORS.items():
+            for level in LEVELS[encoding]:
+                size, duration = measure(compressor_cls, level, data)
+                default = " (default)" if settings.COMPRESSION_LEVELS[encoding] == level else ""
+                print(
+                    f"  {encoding:>4} {level:>2}: {100 * size / len(data):5.1f}% of original size, "
+                    f"{1000 * duration:7.1f} ms, {len(data) / 1e6 / duration:6.0f} MB/s{default}"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,63 @@
+"""
+Benchmark registration of job output data, as done when a provider marks a job as finished.
+
+Run from the "api" directory, against the test database (see setup_test_db.py):
+
+    python -m benchmarks.output_data
+
+"""
+
+import asyncio
+import time
+
+from simqueue import settings
+
+assert settings.DATABASE_USERNAME == "test_user"
+
+from simqueue import db
+
+
+N_FILES = (10, 1000, 10000)
+REPEATS = 3
+
+
+def fake_output_data(job_id, n_files):
+    return [
+        {
+            "url": f"https://example.com/jobs/{job_id}/trace_{i:05d}.npz",
+            "path": f"trace_{i:05d}.npz",
+            "hash": f"{job_id:08x}{i:08x}",
+            "size": 1024 * i,
+            "content_type": "application/octet-stream",
+        }
+        for i in range(n_files)
+    ]
+
+
+async def main():
+    await db.database.connect()
+    for n_files in N_FILES:
+        timings = []
+        for repeat in range(REPEATS):
+            job = await db.create_job(
+                user_id="benchmark",
+                job={
+                    "code": "import pyNN",
+                    "command": None,
+                    "collab_id": "neuromorphic-testing-private",
+                    "hardware_platform": "BrainScaleS-2",
+                    "hardware_config": None,
+                },
+            )
+            job_patch = {"status": "finished", "output_data": fake_output_data(job["id"], n_files)}
+            start = time.perf_counter()
+            job = await db.update_job(job["id"], job_patch)
+            timings.append(time.perf_counter() - start)
+            assert len(job["output_data"]) == n_files
+            await db.delete_job(job["id"])
+        print(f"{n_files:>6} files: {min(timings):.3f} s (best of {REPEATS})")
+    await db.database.disconnect()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,91 @@
+"""
+Compare the cost per job of building and serialising job lists, as returned by GET /jobs/,
+through FastAPI's response model handling and through ModelResponse.
+
+This benchmark does not need a database. Run from the "api" directory:
+
+    python -m benchmarks.serialisation
+
+"""
+
+from datetime import datetime, timezone
+import json
+import timeit
+from typing import List
+
+from pydantic import TypeAdapter
+
+from simqueue.data_models import Job
+from simqueue.responses import ModelResponse
+
+N_JOBS = 100
+N_FILES = 10
+REPEATS = 20
+
+
+def fake_job_rows(n_jobs, n_files):
+    return [
+        {
+            "id": i,
+            "code": "import pyNN.spiNNaker as sim\n" * 20,
+            "command": "run.py --duration 1000",
+            "collab_id": "neuromorphic-testing-private",
+            "user_id": "haroldlloyd",
+            "status": "finished",
+            "hardware_platform": "SpiNNaker",
+            "hardware_config": {"spynnaker_version": "7.0", "n_boards": 1},
+            "timestamp_submission": datetime(2024, 5, 1, 12, 0, tzinfo=timezone.utc),
+            "timestamp_completion": datetime(2024, 5, 1, 12, 5, tzinfo=timezone.utc),
+            "provenance": {"spinnaker_machine": "spin-1", "elapsed": 300.0},
+            "resource_usage": 0.5,
+            "input_data": [],
+            "output_data": [
+                {
+                    "id": n_files * i + j,
+                    "url": f"https://example.com/job_{i}/results_{j}.pkl",
+                    "path": f"results_{j}.pkl",
+                    "hash": None,
+                    "size": 1024,
+                    "content_type": "application/octet-stream",
+                }
+                for j in range(n_files)
+            ],
+            "tags": ["benchmark"],
+        }
+        for i in range(1, n_jobs + 1)
+    ]
+
+
+response_field = TypeAdapter(List[Job])
+
+
+def from_db_only(rows):
+    return [Job.from_db(dict(row)) for row in rows]
+
+
+def response_model(rows):
+    """
+    What FastAPI does when an endpoint with response_model=List[Job] returns a list of models:
+    convert them back to dicts, validate again, serialise to JSON-compatible types, encode.
+    """
+    jobs = [Job.from_db(dict(row)) for row in rows]
+    content = [job.model_dump() for job in jobs]
+    value = response_field.validate_python(content)
+    return json.dumps(response_field.dump_python(value, mode="json")).encode("utf-8")
+
+
+def model_response(rows):
+    """The fast path, used by GET /jobs/"""
+    return ModelResponse([Job.from_db(dict(row)) for row in rows], List[Job]).body
+
+
+def main():
+    rows = fake_job_rows(N_JOBS, N_FILES)
+    assert json.loads(response_model(rows)) == json.loads(model_response(rows))
+    for func in (from_db_only, response_model, model_response):
+        best = min(timeit.repeat(lambda: func(rows), number=1, repeat=REPEATS))
+        print(f"{func.__name__:>14}: {1e6 * best / N_JOBS:.1f} µs per job")
+
+
+if __name__ == "__main__":
+    main()
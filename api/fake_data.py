@@ -0,0 +1,56 @@
+"""
+Fake jobs, logs and provenance records, used to populate the test database
+(see setup_test_db.py) and by the benchmarks.
+
+"""
+
+from datetime import timedelta
+import random
+
+from faker import Faker
+
+fake = Faker()
+
+job_status_options = ["submitted", "running", "finished", "error"]
+hardware_platform_options = ["BrainScaleS", "BrainScaleS-2", "SpiNNaker", "Spikey", "Demo"]
+
+
+def fake_job():
+    job = dict(
+        code=fake.text(),
+        command=fake.sentence(),
+        collab_id=fake.word(),
+        user_id=fake.user_name(),
+        status=random.choice(job_status_options),
+        hardware_platform=random.choice(hardware_platform_options),
+        hardware_config=fake.pydict(value_types=[str, int, float, bool]),
+        timestamp_submission=fake.date_time_this_decade(),
+    )
+    # todo: add resource_usage for finished jobs
+    if job["status"] in ("finished", "error"):
+        job["timestamp_completion"] = job["timestamp_submission"] + timedelta(
+            random.uniform(0, 1000)
+        )
+        job["provenance"] = fake_provenance()
+    return job
+
+
+def fake_provenance():
+    return {
+        "machine": fake.hostname(),
+        "software": {
+            "python": fake.numerify("3.1#.#"),
+            "pyNN": fake.numerify("0.1#.#"),
+        },
+        "elapsed": round(random.uniform(1, 3600), 3),
+    }
+
+
+def fake_log(n_lines):
+    timestamp = fake.date_time_this_decade()
+    lines = []
+    for i in range(n_lines):
+        timestamp += timedelta(seconds=random.uniform(0, 5))
+        level = random.choice(["DEBUG", "INFO", "INFO", "INFO", "WARNING"])
+        lines.append(f"{timestamp.isoformat()} {level} {fake.sentence()}")
+    return "\n".join(lines)
@@ -9,7 +9,6 @@ import os
 import random
 from uuid import UUID, uuid4
 
-from faker import Faker
 import asyncpg
 import sqlalchemy
 import databases
@@ -18,14 +17,11 @@ from simqueue import settings
 
 assert settings.DATABASE_USERNAME == "test_user"
 
-from simqueue import db
+from simqueue import db, migrate
+from fake_data import fake, fake_job, fake_log, hardware_platform_options
 
 
-fake = Faker()
-
-job_status_options = ["submitted", "running", "finished", "error"]
 project_status_options = ["under review", "accepted", "rejected", "in preparation"]
-hardware_platform_options = ["BrainScaleS", "BrainScaleS-2", "SpiNNaker", "Spikey", "Demo"]
 tags = ["test"] + fake.words(10)
 
 
@@ -73,24 +69,13 @@ async def create_specific_job(database):
 
 
 async def create_fake_job(database):
-    job = dict(
-        code=fake.text(),
-        command=fake.sentence(),
-        collab_id=fake.word(),
-        user_id=fake.user_name(),
-        status=random.choice(job_status_options),
-        hardware_platform=random.choice(hardware_platform_options),
-        hardware_config=str(fake.pydict()),
-        timestamp_submission=fake.date_time_this_decade(),
-    )
-    # todo: add provenance, resource_usage for finished jobs
-    if job["status"] in ("finished", "error"):
-        job["timestamp_completion"] = job["timestamp_submission"] + timedelta(
-            random.uniform(0, 1000)
-        )
+    job = fake_job()
     ins = db.jobs.insert().values(**job)
     job_id = await database.execute(ins)
     assert isinstance(job_id, int)
+    if job["status"] in ("finished", "error"):
+        ins = db.logs.insert().values(job_id=job_id, content=fake_log(random.randint(10, 1000)))
+        await database.execute(ins)
 
     # tag some jobs
     if random.random() < 0.5:
@@ -228,6 +213,12 @@ async def main():
         schema = sqlalchemy.schema.CreateTable(table, if_not_exists=True)
         query = str(schema.compile(dialect=dialect))
         await db.database.execute(query=query)
+        for index in table.indexes:
+            schema = sqlalchemy.schema.CreateIndex(index, if_not_exists=True)
+            query = str(schema.compile(dialect=dialect))
+            await db.database.execute(query=query)
+    # the tables are created with the latest schema, so no migrations are needed
+    await migrate.stamp(db.database)
 
     # add fake data
     await create_fake_data(db.database)
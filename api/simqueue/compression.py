@@ -0,0 +1,205 @@
+"""
+Compression of HTTP responses, with the encoding (zstd, brotli or gzip)
+negotiated with the client through the Accept-Encoding header.
+
+Streaming responses are compressed chunk by chunk, so they are never held in memory.
+Responses that already have a Content-Encoding, or whose content type is an
+already-compressed format, are passed through unchanged.
+"""
+
+import zlib
+
+import anyio
+import brotli
+import zstandard
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class GzipCompressor:
+    def __init__(self, level):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+class BrotliCompressor:
+    def __init__(self, level):
+        self._compressor = brotli.Compressor(quality=level)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.process(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.finish()
+
+
+class ZstdCompressor:
+    def __init__(self, level):
+        self._compressor = zstandard.ZstdCompressor(level=level).compressobj()
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+# in order of preference, where the client accepts several encodings equally
+COMPRESSORS = {"zstd": ZstdCompressor, "br": BrotliCompressor, "gzip": GzipCompressor}
+
+# content types that are not worth compressing again
+COMPRESSED_CONTENT_TYPES = (
+    "application/gzip",
+    "application/x-gzip",
+    "application/zip",
+    "application/zstd",
+    "application/x-bzip2",
+    "application/x-xz",
+    "application/x-7z-compressed",
+    "image/png",
+    "image/jpeg",
+    "image/gif",
+    "image/webp",
+    "audio/",
+    "video/",
+)
+
+
+def choose_encoding(accept_encoding: str, available=tuple(COMPRESSORS)):
+    """
+    Return the preferred encoding from `available` that is acceptable to the client,
+    according to the given Accept-Encoding header, or None if there is none.
+    """
+    qualities = {}
+    for item in accept_encoding.lower().split(","):
+        coding, *params = [part.strip() for part in item.split(";")]
+        quality = 1.0
+        for param in params:
+            name, _, value = param.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        if coding:
+            qualities[coding] = quality
+    default = qualities.get("*", 0.0)
+    best = max(available, key=lambda coding: qualities.get(coding, default), default=None)
+    if best is None or qualities.get(best, default) <= 0.0:
+        return None
+    return best
+
+
+class CompressionMiddleware:
+    """
+    Compress responses of at least `minimum_size` bytes (and all streaming responses),
+    using the compression levels given in `levels`, e.g. `{"zstd": 3, "br": 4, "gzip": 6}`.
+    Encodings not in `levels` are not used.
+
+    Large response bodies are compressed in a worker thread, so as not to block the event loop.
+    """
+
+    def __init__(
+        self,
+        app: ASGIApp,
+        levels: dict,
+        minimum_size: int = 1024,
+        thread_minimum_size: int = 128 * 1024,
+    ):
+        self.app = app
+        self.levels = levels
+        self.available = tuple(coding for coding in COMPRESSORS if coding in levels)
+        self.minimum_size = minimum_size
+        self.thread_minimum_size = thread_minimum_size
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] == "http":
+            accept_encoding = Headers(scope=scope).get("Accept-Encoding", "")
+            encoding = choose_encoding(accept_encoding, self.available)
+            if encoding:
+                responder = CompressionResponder(
+                    self.app,
+                    encoding,
+                    self.levels[encoding],
+                    self.minimum_size,
+                    self.thread_minimum_size,
+                )
+                await responder(scope, receive, send)
+                return
+        await self.app(scope, receive, send)
+
+
+class CompressionResponder:
+    """Compresses a single response, see `CompressionMiddleware`"""
+
+    def __init__(self, app, encoding, level, minimum_size, thread_minimum_size):
+        self.app = app
+        self.encoding = encoding
+        self.level = level
+        self.minimum_size = minimum_size
+        self.thread_minimum_size = thread_minimum_size
+        self.send = None
+        self.start_message = None
+        self.compressor = None
+        self.passthrough = False
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        self.send = send
+        await self.app(scope, receive, self.send_compressed)
+
+    async def send_compressed(self, message: Message):
+        if self.passthrough:
+            await self.send(message)
+        elif message["type"] == "http.response.start":
+            # we can't tell whether to compress until we see the start of the body
+            self.start_message = message
+        elif message["type"] == "http.response.body" and self.compressor is None:
+            await self.start(message)
+        elif message["type"] == "http.response.body":
+            body = self.compressor.compress(message.get("body", b""))
+            more_body = message.get("more_body", False)
+            if not more_body:
+                body += self.compressor.flush()
+            if body or not more_body:
+                await self.send(
+                    {"type": "http.response.body", "body": body, "more_body": more_body}
+                )
+        else:
+            await self.send(message)
+
+    async def start(self, message: Message):
+        headers = MutableHeaders(raw=self.start_message["headers"])
+        body = message.get("body", b"")
+        more_body = message.get("more_body", False)
+        if (
+            "content-encoding" in headers
+            or headers.get("content-type", "").startswith(COMPRESSED_CONTENT_TYPES)
+            or (len(body) < self.minimum_size and not more_body)
+        ):
+            self.passthrough = True
+            await self.send(self.start_message)
+            await self.send(message)
+            return
+
+        self.compressor = COMPRESSORS[self.encoding](self.level)
+        headers["Content-Encoding"] = self.encoding
+        headers.add_vary_header("Accept-Encoding")
+        if more_body:
+            del headers["Content-Length"]
+            body = self.compressor.compress(body)
+        else:
+            if len(body) >= self.thread_minimum_size:
+                body = await anyio.to_thread.run_sync(self.compress_all, body)
+            else:
+                body = self.compress_all(body)
+            headers["Content-Length"] = str(len(body))
+        await self.send(self.start_message)
+        await self.send({"type": "http.response.body", "body": body, "more_body": more_body})
+
+    def compress_all(self, body: bytes) -> bytes:
+        return self.compressor.compress(body) + self.compressor.flush()
@@ -1,8 +1,8 @@
+from collections import defaultdict
 from datetime import datetime, date, timezone
 from enum import Enum
 from typing import List, Dict, Optional
 from uuid import UUID
-import json
 from urllib.parse import urlparse
 from pydantic import BaseModel, AnyUrl, constr
 
@@ -82,23 +82,40 @@ class DataItem(BaseModel):
         }
 
 
+def lookup_repository(url):
+    """Return the repository object for a data item URL, or None if it is not known"""
+    if url is None:
+        return None
+    return repository_lookup_by_host.get(urlparse(url).hostname, None)
+
+
+def repository_name(repository_obj):
+    if repository_obj:
+        return repository_obj.name
+    else:
+        return "unknown data repository"
+
+
+def dataset_from_db(data_items):
+    """
+    Return the fields of a DataSet as a dict, so that it can be validated
+    in a single pass together with the model containing it.
+    """
+    repository_obj = lookup_repository(data_items[0]["url"])
+    if repository_obj:
+        for data_item in data_items:
+            if data_item["path"] is None:
+                data_item["path"] = repository_obj.get_path(data_item["url"])
+    return {"repository": repository_name(repository_obj), "files": data_items}
+
+
 class DataSet(BaseModel):
     repository: str
     files: List[DataItem]
 
     @classmethod
     def from_db(cls, data_items):
-        urls = [item["url"] for item in data_items]
-        url_parts = urlparse(urls[0])
-        repository_obj = repository_lookup_by_host.get(url_parts.hostname, None)
-        if repository_obj:
-            repository_name = repository_obj.name
-        else:
-            repository_name = "unknown data repository"
-        return cls(
-            repository=repository_name,
-            files=[DataItem.from_db(data_item, repository_obj) for data_item in data_items],
-        )
+        return cls(**dataset_from_db(data_items))
 
     def to_db(self):
         return [item.to_db() for item in self.files]
@@ -114,6 +131,80 @@ class DataSet(BaseModel):
         return self
 
 
+class DataSetPage(DataSet):
+    """
+    Part of a job's output data. To get the next page,
+    pass `next_cursor` as the `cursor` query parameter.
+    """
+
+    next_cursor: Optional[int] = None
+
+    @classmethod
+    def from_db(cls, data_items, summary, size=None):
+        repository_obj = lookup_repository(summary["url"])
+        if size is not None and len(data_items) == size:
+            next_cursor = data_items[-1]["id"]
+        else:
+            next_cursor = None
+        return cls(
+            repository=repository_name(repository_obj),
+            files=[DataItem.from_db(data_item, repository_obj) for data_item in data_items],
+            next_cursor=next_cursor,
+        )
+
+
+class DataSetSummary(BaseModel):
+    repository: Optional[str] = None
+    count: int
+    size: Optional[int] = None  # total size in bytes, where known
+
+    @classmethod
+    def from_db(cls, summary):
+        return cls(
+            repository=(
+                repository_name(lookup_repository(summary["url"])) if summary["count"] else None
+            ),
+            count=summary["count"],
+            size=summary["size"],
+        )
+
+
+class DataTransferStatus(str, Enum):
+    queued = "queued"
+    running = "running"
+    finished = "finished"
+    error = "error"
+
+
+class DataTransfer(BaseModel):
+    id: int
+    job_id: int
+    repository: str
+    status: DataTransferStatus
+    n_files: int
+    n_copied: int
+    error: Optional[str] = None
+    timestamp_start: datetime
+    timestamp_end: Optional[datetime] = None
+    resource_uri: str
+
+    @classmethod
+    def from_db(cls, transfer):
+        data = {
+            "id": transfer["id"],
+            "job_id": transfer["job_id"],
+            "repository": transfer["repository"],
+            "status": transfer["status"],
+            "n_files": transfer["n_files"],
+            "n_copied": transfer["n_copied"],
+            "error": transfer["error"],
+            "timestamp_start": transfer["timestamp_start"],
+            "timestamp_end": transfer["timestamp_end"],
+            "resource_uri": f"/jobs/{transfer['job_id']}/output_data/transfers/{transfer['id']}",
+        }
+        return cls(**data)
+
+
 class ResourceUsage(BaseModel):
     value: float
     units: str
@@ -133,6 +224,7 @@ class SubmittedJob(BaseModel):
     hardware_platform: str
     hardware_config: Optional[dict] = None
     tags: Optional[List[Tag]] = None
+    estimated_resource_usage: Optional[ResourceUsage] = None
 
     def to_db(self):
         return {
@@ -145,7 +237,7 @@ class SubmittedJob(BaseModel):
                 else None
             ),
             "hardware_platform": self.hardware_platform,
-            "hardware_config": json.dumps(self.hardware_config) if self.hardware_config else None,
+            "hardware_config": self.hardware_config or None,
             "tags": self.tags,
         }
 
@@ -160,6 +252,7 @@ class AcceptedJob(SubmittedJob):
 
 class CompletedJob(AcceptedJob):
     output_data: Optional[DataSet] = None
+    output_data_summary: Optional[DataSetSummary] = None
     provenance: Optional[dict] = None
     timestamp_completion: Optional[datetime] = None
     resource_usage: Optional[ResourceUsage] = None
@@ -172,7 +265,11 @@ class Job(CompletedJob):
 
     @classmethod
     def from_db(cls, job):
-        """Change certain fields that are stored as strings or floats into richer Python types"""
+        return cls(**cls.fields_from_db(job))
+
+    @staticmethod
+    def fields_from_db(job):
+        """Change certain fields that are stored as floats into richer Python types"""
         data = {
             "id": job["id"],
             "code": job["code"],
@@ -180,12 +277,12 @@ class Job(CompletedJob):
             "collab": job["collab_id"],
             "input_data": job["input_data"],
             "hardware_platform": job["hardware_platform"],
-            "tags": [tag for tag in job["tags"] if len(tag) > 1],  # filter out invalid tags
+            "tags": [tag for tag in job["tags"] or [] if len(tag) > 1],  # filter out invalid tags
         }
         if job["hardware_config"]:
-            data["hardware_config"] = json.loads(job["hardware_config"])
+            data["hardware_config"] = job["hardware_config"]
         if job["provenance"]:
-            data["provenance"] = json.loads(job["provenance"])
+            data["provenance"] = job["provenance"]
         if job["resource_usage"] is not None:  # can be 0.0
             data["resource_usage"] = {
                 "value": job["resource_usage"],
@@ -197,10 +294,70 @@ class Job(CompletedJob):
             if job.get(field, None):
                 data[field] = job[field]
         if job["output_data"]:
-            data["output_data"] = DataSet.from_db(job["output_data"])
+            data["output_data"] = dataset_from_db(job["output_data"])
+        if job.get("output_data_summary", None):
+            data["output_data_summary"] = DataSetSummary.from_db(job["output_data_summary"])
         if job.get("comments", None):
             data["comments"] = [Comment.from_db(comment) for comment in job["comments"]]
-        return cls(**data)
+        return data
+
+
+# the database columns, or related objects, needed for each field of a job or session,
+# where these differ from the field name
+FIELD_SOURCES = {
+    "collab": ["collab_id"],
+    "resource_uri": ["id"],
+    "resource_usage": ["resource_usage", "hardware_platform"],
+}
+
+
+def db_fields(fields):
+    """Return the database columns and related objects needed for the given fields"""
+    return list(
+        dict.fromkeys(source for field in fields for source in FIELD_SOURCES.get(field, [field]))
+    )
+
+
+class SparseJob(BaseModel):
+    """A job with only the fields that were requested, see `GET /jobs/?fields=`"""
+
+    id: Optional[int] = None
+    code: Optional[str] = None
+    command: Optional[str] = None
+    collab: Optional[str] = None
+    input_data: Optional[List[DataItem]] = None
+    hardware_platform: Optional[str] = None
+    hardware_config: Optional[dict] = None
+    tags: Optional[List[Tag]] = None
+    user_id: Optional[str] = None
+    status: Optional[JobStatus] = None
+    timestamp_submission: Optional[datetime] = None
+    timestamp_completion: Optional[datetime] = None
+    resource_uri: Optional[str] = None
+    output_data: Optional[DataSet] = None
+    output_data_summary: Optional[DataSetSummary] = None
+    provenance: Optional[dict] = None
+    resource_usage: Optional[ResourceUsage] = None
+
+    @classmethod
+    def from_db(cls, job, fields):
+        # the job contains only the columns needed for `fields`, the others are taken as None
+        data = Job.fields_from_db(defaultdict(lambda: None, job))
+        return cls(**{field: data.get(field, None) for field in fields})
+
+
+JobField = Enum("JobField", {field: field for field in SparseJob.model_fields}, type=str)
+
+
+class JobRelationship(str, Enum):
+    input_data = "input_data"
+    output_data = "output_data"
+    tags = "tags"
+
+
+class ExportFormat(str, Enum):
+    ndjson = "ndjson"
+    csv = "csv"
 
 
 class JobPatch(BaseModel):  # todo: rename to JobUpdate
@@ -217,7 +374,7 @@ class JobPatch(BaseModel):  # todo: rename to JobUpdate
         if self.output_data is not None:
             values["output_data"] = self.output_data.to_db()
         if self.provenance is not None:
-            values["provenance"] = json.dumps(self.provenance)
+            values["provenance"] = self.provenance
         if self.resource_usage is not None:
             values["resource_usage"] = self.resource_usage.value
         if self.log is not None:
@@ -237,7 +394,7 @@ class SessionCreation(BaseModel):
         return {
             "collab_id": self.collab,
             "hardware_platform": self.hardware_platform,
-            "hardware_config": json.dumps(self.hardware_config),
+            "hardware_config": self.hardware_config,
             "user_id": self.user_id,
             "timestamp_start": datetime.now(timezone.utc),
             "resource_usage": 0.0,
@@ -255,6 +412,10 @@ class Session(SessionCreation):
 
     @classmethod
     def from_db(cls, session):
+        return cls(**cls.fields_from_db(session))
+
+    @staticmethod
+    def fields_from_db(session):
         data = {
             "id": session["id"],
             "resource_uri": f"/sessions/{session['id']}",
@@ -265,7 +426,7 @@ class Session(SessionCreation):
             "timestamp_start": session["timestamp_start"],
         }
         if session["hardware_config"]:
-            data["hardware_config"] = json.loads(session["hardware_config"])
+            data["hardware_config"] = session["hardware_config"]
         if session["resource_usage"] is not None:  # can be 0.0
             data["resource_usage"] = {
                 "value": session["resource_usage"],
@@ -273,7 +434,32 @@ class Session(SessionCreation):
             }
         if session["timestamp_end"]:
             data["timestamp_end"] = session["timestamp_end"]
-        return cls(**data)
+        return data
+
+
+class SparseSession(BaseModel):
+    """A session with only the fields that were requested, see `GET /sessions/?fields=`"""
+
+    id: Optional[int] = None
+    collab: Optional[str] = None
+    user_id: Optional[str] = None
+    hardware_platform: Optional[str] = None
+    hardware_config: Optional[dict] = None
+    status: Optional[SessionStatus] = None
+    timestamp_start: Optional[datetime] = None
+    timestamp_end: Optional[datetime] = None
+    resource_uri: Optional[str] = None
+    resource_usage: Optional[ResourceUsage] = None
+
+    @classmethod
+    def from_db(cls, session, fields):
+        data = Session.fields_from_db(defaultdict(lambda: None, session))
+        return cls(**{field: data.get(field, None) for field in fields})
+
+
+SessionField = Enum(
+    "SessionField", {field: field for field in SparseSession.model_fields}, type=str
+)
 
 
 class SessionUpdate(BaseModel):
@@ -312,6 +498,7 @@ class QuotaUpdate(BaseModel):
 
 class Quota(QuotaSubmission, QuotaUpdate):
     # id: int  # do we need this? or just use resource_uri
+    reserved: float = 0.0  # "Quantity of resources reserved by queued jobs"
     project: str
     resource_uri: Optional[str] = None
 
@@ -323,12 +510,43 @@ class Quota(QuotaSubmission, QuotaUpdate):
             "platform": quota["platform"],
             "units": quota["units"],
             "usage": quota["usage"],
+            "reserved": quota["reserved"],
             "resource_uri": f"/projects/{quota['project_id']}/quotas/{quota['id']}",
             "project": f"/projects/{quota['project_id']}",
         }
         return cls(**data)
 
 
+class QuotaOperation(BaseModel):
+    project_id: UUID
+    platform: str  # "System to which quota applies"
+    limit: float  # "Quantity of resources granted"
+    usage: Optional[float] = None  # if not given, existing usage is kept (zero for new quotas)
+
+    def to_db(self):
+        return {
+            "project_id": str(self.project_id),
+            "platform": self.platform,
+            "units": RESOURCE_USAGE_UNITS.get(self.platform),
+            "limit": self.limit,
+            "usage": self.usage,
+        }
+
+
+class QuotaOperationStatus(str, Enum):
+    created = "created"
+    updated = "updated"
+    error = "error"
+
+
+class QuotaOperationResult(BaseModel):
+    project_id: UUID
+    platform: str
+    status: QuotaOperationStatus
+    quota: Optional[Quota] = None
+    detail: Optional[str] = None
+
+
 class ProjectStatus(str, Enum):
     in_prep = "in preparation"
     accepted = "accepted"
@@ -445,6 +663,20 @@ class QueueStatus(BaseModel):
     submitted: int
 
 
+class DatabasePoolStatus(BaseModel):
+    size: int  # number of open connections
+    idle: int
+    in_use: int
+    min_size: int
+    max_size: int
+    waiting: int  # number of requests waiting for a connection
+    # totals since the service started
+    acquired: int
+    timeouts: int
+    total_wait_time: float  # seconds
+    max_wait_time: float  # seconds
+
+
 class Histogram(BaseModel):
     values: List
     bins: List
@@ -1,13 +1,36 @@
+from collections import OrderedDict
 import os
+import threading
+import time
 import uuid
-from urllib.request import urlretrieve, urlcleanup, HTTPError
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from functools import partial
 from urllib.parse import urlparse
+import tempfile
 import zipfile
+import httpx
 from ebrains_drive.client import DriveApiClient, BucketApiClient
 from ebrains_drive.exceptions import DoesNotExist
+from ebrains_drive.utils import EBRAINS_DRIVE_MULTIPART_THRESHOLD
 
 from . import settings
 
+CHUNK_SIZE = 1024 * 1024  # bytes
+# a stalled download or upload fails rather than holding one of the transfer threads forever
+TRANSFER_TIMEOUT = httpx.Timeout(
+    settings.FILE_TRANSFER_TIMEOUT, connect=settings.FILE_TRANSFER_CONNECT_TIMEOUT
+)
+
+# the storage clients are blocking, so file transfers are run in a bounded pool of threads.
+# Job submissions have their own pool, so they are not held up by large output data transfers
+transfer_executor = ThreadPoolExecutor(
+    max_workers=settings.FILE_TRANSFER_CONCURRENCY, thread_name_prefix="file-transfer"
+)
+code_archive_executor = ThreadPoolExecutor(
+    max_workers=settings.FILE_TRANSFER_CONCURRENCY, thread_name_prefix="code-archive"
+)
+
 
 class SourceFileDoesNotExist(Exception):
     pass
@@ -28,32 +51,132 @@ def get_file_size(file_path, unit):
         return convert_bytes(file_info.st_size, unit)
 
 
-def drive_mkdir_p(base_dir, relative_path):
+def drive_mkdir_p(base_dir, relative_path, listings=None):
+    """
+    Return the Drive directory at `relative_path` below `base_dir`,
+    creating it and any missing parent directories.
+
+    `listings` is an optional cache of subdirectory listings, mapping (repo id, path)
+    to a dict of subdirectories by name. It is used in place of listing directories
+    on the Drive, and is updated when directories are created.
+    """
     # to move to ebrains_drive
-    path_parts = relative_path.split("/")
+    if listings is None:
+        listings = {}
     parent = base_dir
-    for dirname in path_parts:
-        subdirs = {
-            subdir.name: subdir for subdir in parent.ls(entity_type="dir", force_refresh=False)
-        }
-        try:
-            dir = subdirs[dirname]
-        except KeyError:
+    for dirname in filter(None, relative_path.split("/")):
+        key = (parent.repo.id, parent.path)
+        if key not in listings:
+            listings[key] = {
+                subdir.name: subdir for subdir in parent.ls(entity_type="dir", force_refresh=False)
+            }
+        subdirs = listings[key]
+        if dirname not in subdirs:
             # create directory
-            dir = parent.mkdir(dirname)
-        parent = dir
-    return dir
+            subdirs[dirname] = parent.mkdir(dirname)
+        parent = subdirs[dirname]
+    return parent
+
+
+class DriveCache:
+    """
+    Drive client, repository handles and directory listings for a single user.
+
+    Without this, copying many files into the same collab would look up the repository,
+    and list the same directories, once per file.
+    """
+
+    def __init__(self, client, ttl):
+        self.client = client
+        self.expires = time.monotonic() + ttl
+        # files are copied in several threads at once
+        self.lock = threading.Lock()
+        self.repos = {}
+        self.root_dirs = {}
+        self.listings = {}
+
+    @property
+    def expired(self):
+        return time.monotonic() > self.expires
+
+    def get_repo(self, collab_name):
+        with self.lock:
+            if collab_name not in self.repos:
+                # ebrains_drive_client.repos.get_repo_by_url is currently broken
+                # while waiting for a release with a fix, we implement a fixed version here
+                match_repos = self.client.repos.get_repos_by_filter("name", collab_name)
+                if len(match_repos) == 0:
+                    raise Exception("Couldn't identify any repo associated with specified URL!")
+                elif len(match_repos) > 1:
+                    raise Exception(
+                        "Couldn't uniquely identify the repo associated with specified URL!"
+                    )
+                self.repos[collab_name] = match_repos[0]
+            return self.repos[collab_name]
+
+    def mkdir_p(self, repo, relative_path):
+        with self.lock:
+            if repo.id not in self.root_dirs:
+                self.root_dirs[repo.id] = repo.get_dir("/")
+            return drive_mkdir_p(self.root_dirs[repo.id], relative_path, self.listings)
+
+
+def check_file_size(size_in_bytes, size_limit, repository_name):
+    if size_limit is not None:
+        file_size = convert_bytes(size_in_bytes, "GiB")
+        if file_size > size_limit:
+            raise SourceFileIsTooBig(
+                f"The file is too large ({file_size} GiB) to be moved to the {repository_name} (limit {size_limit} GiB"
+            )
+
+
+@contextmanager
+def open_source_file(url, size_limit=None, repository_name=None):
+    """
+    Start a streaming download of the file at `url`.
+
+    If the server gives the file size, it is checked against `size_limit` (in GiB)
+    before any content is downloaded.
+    """
+    with httpx.stream(
+        "GET", str(url), follow_redirects=True, timeout=TRANSFER_TIMEOUT
+    ) as response:
+        if response.status_code == 404:
+            raise SourceFileDoesNotExist(response.reason_phrase)
+        response.raise_for_status()
+        content_length = response.headers.get("Content-Length")
+        if content_length is not None:
+            check_file_size(int(content_length), size_limit, repository_name)
+        yield response
+
+
+def iter_file_content(response, size_limit=None, repository_name=None):
+    """
+    Yield the content of a streaming download in chunks,
+    checking the size limit as we go, in case the server did not give the file size.
+    """
+    n_bytes = 0
+    for chunk in response.iter_bytes(CHUNK_SIZE):
+        n_bytes += len(chunk)
+        check_file_size(n_bytes, size_limit, repository_name)
+        yield chunk
+
+
+def save_to_tmp_file(chunks):
+    with tempfile.NamedTemporaryFile(delete=False) as fp:
+        try:
+            for chunk in chunks:
+                fp.write(chunk)
+        except BaseException:
+            fp.close()
+            os.remove(fp.name)
+            raise
+    return fp.name
 
 
-def download_file_to_tmp_dir(url):
-    try:
-        local_path, headers = urlretrieve(str(url))
-    except HTTPError as err:
-        if err.code == 404:
-            raise SourceFileDoesNotExist(err.reason)
-        else:
-            raise
-    return local_path
+def download_file_to_tmp_dir(url, size_limit=None, repository_name=None):
+    with open_source_file(url, size_limit, repository_name) as response:
+        return save_to_tmp_file(iter_file_content(response, size_limit, repository_name))
 
 
 def ensure_path_from_root(path):
@@ -98,11 +221,121 @@ class DemoTemporaryStorage:
         return url[len(prefix) + 1 :]
 
 
+class ArchiveCache:
+    """
+    Zip archives of Drive content, stored in a local directory from which they
+    can be downloaded by the computing system providers.
+
+    Archives are written to a temporary file and then renamed, so a partially-written
+    archive is never visible. When the total size exceeds `max_size` (in bytes),
+    `evict()` deletes the least recently used archives, except those still needed by jobs
+    and those used within the last `grace_period` seconds (whose URL may have been handed out
+    for a job that is still being created).
+    """
+
+    def __init__(self, root, max_size, grace_period=0):
+        self.root = root
+        self.max_size = max_size
+        self.grace_period = grace_period
+        self.lock = threading.Lock()
+        # archive name -> size in bytes, least recently used first
+        self._entries = None
+
+    def _load(self):
+        try:
+            os.makedirs(self.root, exist_ok=True)
+        except PermissionError as err:
+            raise Exception(os.getcwd()) from err
+        entries = []
+        for entry in os.scandir(self.root):
+            if entry.is_file() and entry.name.endswith(".zip"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        self._entries = OrderedDict((name, size) for mtime, name, size in sorted(entries))
+
+    def get(self, name):
+        """Return the path of the named archive, or None if it is not in the cache"""
+        path = os.path.join(self.root, name)
+        with self.lock:
+            if self._entries is None:
+                self._load()
+            try:
+                # the modification time records use by any process sharing the directory
+                os.utime(path)
+            except FileNotFoundError:
+                self._entries.pop(name, None)
+                return None
+            if name not in self._entries:  # created by another process
+                self._entries[name] = os.path.getsize(path)
+            self._entries.move_to_end(name)
+        return path
+
+    def add(self, name, write):
+        """Add an archive to the cache, by calling `write(path)` with a temporary path"""
+        with self.lock:
+            if self._entries is None:
+                self._load()
+        path = os.path.join(self.root, name)
+        tmp_path = os.path.join(self.root, f".{name}.{uuid.uuid4().hex}.tmp")
+        try:
+            write(tmp_path)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        with self.lock:
+            self._entries[name] = os.path.getsize(path)
+            self._entries.move_to_end(name)
+        return path
+
+    def is_full(self):
+        with self.lock:
+            return self._entries is not None and sum(self._entries.values()) > self.max_size
+
+    def evict(self, in_use=()):
+        """
+        Delete the least recently used archives until the cache is within `max_size`,
+        except for those named in `in_use` and those used within the grace period.
+        """
+        with self.lock:
+            if self._entries is None:
+                self._load()
+            total_size = sum(self._entries.values())
+            cutoff = time.time() - self.grace_period
+            for name in list(self._entries):
+                if total_size <= self.max_size:
+                    break
+                if name in in_use:
+                    continue
+                try:
+                    if os.path.getmtime(os.path.join(self.root, name)) > cutoff:
+                        continue
+                except FileNotFoundError:
+                    pass
+                total_size -= self._entries[name]
+                self._remove(name)
+
+    def _remove(self, name):
+        del self._entries[name]
+        try:
+            os.remove(os.path.join(self.root, name))
+        except FileNotFoundError:
+            pass
+
+
+archive_cache = ArchiveCache(
+    settings.TMP_FILE_ROOT, settings.TMP_FILE_CACHE_SIZE, settings.TMP_FILE_GRACE_PERIOD
+)
+
+
 class EBRAINSDrive:
     name = "EBRAINS Drive"
     host = settings.EBRAINS_DRIVE_SERVICE_URL
     modes = ("read", "write")
     size_limit = 1.0  # GiB
+    _caches = {}  # DriveCache objects, by access token
+    _caches_lock = threading.Lock()
 
     @classmethod
     def _get_client(cls, token):
@@ -111,10 +344,19 @@ class EBRAINSDrive:
             env = "int"
         return DriveApiClient(token=token, env=env)
 
+    @classmethod
+    def _get_cache(cls, token):
+        with cls._caches_lock:
+            for key in [key for key, cache in cls._caches.items() if cache.expired]:
+                del cls._caches[key]
+            if token not in cls._caches:
+                cls._caches[token] = DriveCache(cls._get_client(token), settings.DRIVE_CACHE_TTL)
+            return cls._caches[token]
+
     @classmethod
     def copy(cls, file, user, collab=None):
         access_token = user.token["access_token"]
-        ebrains_drive_client = cls._get_client(token=access_token)
+        cache = cls._get_cache(access_token)
 
         path_parts = file.path.split("/")
         if collab:
@@ -124,36 +366,24 @@ class EBRAINSDrive:
             collab_name = path_parts[0]
             remote_path = "/".join([""] + path_parts[1:])
 
-        # ebrains_drive_client.repos.get_repo_by_url is currently broken
-        # while waiting for a release with a fix, we implement a fixed version here
-        # target_repository = ebrains_drive_client.repos.get_repo_by_url(collab_name)
-
-        match_repos = ebrains_drive_client.repos.get_repos_by_filter("name", collab_name)
-
-        if len(match_repos) == 0:
-            raise Exception("Couldn't identify any repo associated with specified URL!")
-        elif len(match_repos) > 1:
-            raise Exception("Couldn't uniquely identify the repo associated with specified URL!")
-        else:
-            target_repository = match_repos[0]
+        target_repository = cache.get_repo(collab_name)
 
         try:
             file_obj = target_repository.get_file(remote_path)
             # todo: add option to overwrite files
         except DoesNotExist:
-            local_path = download_file_to_tmp_dir(file.url)
-            # upload the temporary copy to the Drive
-            file_size = get_file_size(local_path, "GiB")
-            if file_size > EBRAINSDrive.size_limit:
-                raise SourceFileIsTooBig(
-                    f"The file is too large ({file_size} GiB) to be moved to the Drive (limit {EBRAINSDrive.size_limit} GiB"
-                )
-            root_dir = target_repository.get_dir("/")
-            dir_path = "/".join(path_parts[1:-1])
-            dir_obj = drive_mkdir_p(root_dir, dir_path)
-            file_name = path_parts[-1]
-            file_obj = dir_obj.upload_local_file(local_path, name=file_name, overwrite=True)
-            urlcleanup()
+            # the Drive upload API takes a multipart form, so we cannot pipe the download
+            # straight into it; instead we stream it to a temporary local copy
+            local_path = download_file_to_tmp_dir(
+                file.url, size_limit=cls.size_limit, repository_name=cls.name
+            )
+            try:
+                dir_path = "/".join(path_parts[1:-1])
+                dir_obj = cache.mkdir_p(target_repository, dir_path)
+                file_name = path_parts[-1]
+                file_obj = dir_obj.upload_local_file(local_path, name=file_name, overwrite=True)
+            finally:
+                os.remove(local_path)
 
         return file_obj.get_download_link()
 
@@ -165,17 +395,31 @@ class EBRAINSDrive:
         dir_obj = target_repository.get_dir(path)
         dir_obj.delete()
 
+    @staticmethod
+    def _download_dir_archive(dir_obj, local_zip_file_path):
+        # download zip of Drive directory contents
+        _response = dir_obj.download(local_zip_file_path)
+        # todo: check the response
+
+    @staticmethod
+    def _write_file_archive(file_obj, file_name, local_zip_file_path):
+        # create a zip archive and put the remote file in it
+        with zipfile.ZipFile(local_zip_file_path, mode="x") as zf:
+            with zf.open(file_name, "w") as fp:
+                fp.write(file_obj.get_content())
+
     @classmethod
     def get_download_url(cls, drive_uri, user):
         access_token = user.token["access_token"]
-        ebrains_drive_client = cls._get_client(token=access_token)
+        cache = cls._get_cache(access_token)
+        ebrains_drive_client = cache.client
         assert drive_uri.startswith("drive://")
         path = drive_uri[len("drive://") :]
 
         collab_name, *path_parts = path.split("/")
         remote_path = "/".join([""] + path_parts)
 
-        target_repository = ebrains_drive_client.repos.get_repo_by_url(collab_name)
+        target_repository = cache.get_repo(collab_name)
         try:
             dir_obj = target_repository.get_dir(remote_path)
             # todo: add option to overwrite files
@@ -191,24 +435,21 @@ class EBRAINSDrive:
                 )
                 raise SourceFileDoesNotExist(errmsg)
 
-        # generate a random but repeatable name for the temporary file
-        try:
-            os.makedirs(settings.TMP_FILE_ROOT, exist_ok=True)
-        except PermissionError as err:
-            raise Exception(os.getcwd()) from err
+        # generate a random but repeatable name for the temporary file.
+        # The Drive object id changes whenever the content changes (for a directory,
+        # whenever anything inside it changes), so edited code gets a new archive
+        archive_key = uuid.uuid5(uuid.NAMESPACE_URL, drive_uri)
+        if dir_obj:
+            zip_file_name = f"{archive_key}-{dir_obj.id}.zip"
+        else:
+            zip_file_name = f"{archive_key}-{file_obj.id}.zip"
 
-        zip_file_name = f"{uuid.uuid5(uuid.NAMESPACE_URL, drive_uri)}.zip"
-        if zip_file_name not in os.listdir(settings.TMP_FILE_ROOT):
-            local_zip_file_path = os.path.join(settings.TMP_FILE_ROOT, zip_file_name)
+        if archive_cache.get(zip_file_name) is None:
             if dir_obj:
-                # download zip of Drive directory contents
-                _response = dir_obj.download(local_zip_file_path)
-                # todo: check the response
+                write_archive = partial(cls._download_dir_archive, dir_obj)
             else:
-                # create a zip archive and put the remote file in it
-                with zipfile.ZipFile(local_zip_file_path, mode="x") as zf:
-                    with zf.open(path_parts[-1], "w") as fp:
-                        fp.write(file_obj.get_content())
+                write_archive = partial(cls._write_file_archive, file_obj, path_parts[-1])
+            archive_cache.add(zip_file_name, write_archive)
 
         return f"{settings.TMP_FILE_URL}/{zip_file_name}"
 
@@ -217,6 +458,7 @@ class EBRAINSBucket:
     name = "EBRAINS Bucket"
     host = settings.EBRAINS_BUCKET_SERVICE_URL
     modes = ("read", "write")
+    size_limit = None  # GiB
 
     @classmethod
     def _get_client(cls, token):
@@ -244,16 +486,54 @@ class EBRAINSBucket:
             remote_path = "/".join([""] + path_parts[1:])
 
         target_bucket = ebrains_bucket_client.buckets.get_bucket(collab_name)
-        all_files = {dpf.name for dpf in target_bucket.ls()}
 
-        if remote_path in all_files:
-            pass  # todo: add option to overwrite files
-        else:
-            local_path = download_file_to_tmp_dir(file.url)
-            target_bucket.upload(local_path, remote_path)
+        try:
+            # this lists only those objects whose names begin with remote_path,
+            # rather than the entire bucket
+            target_bucket.get_file(remote_path)
+            # todo: add option to overwrite files
+        except DoesNotExist:
+            with open_source_file(file.url, cls.size_limit, cls.name) as response:
+                chunks = iter_file_content(response, cls.size_limit, cls.name)
+                content_length = response.headers.get("Content-Length")
+                # if the content is compressed, Content-Length is the compressed size
+                content_encoding = response.headers.get("Content-Encoding", "identity")
+                # larger files are uploaded to the Bucket in several parts,
+                # which needs a seekable local copy
+                if (
+                    content_length is not None
+                    and int(content_length) <= EBRAINS_DRIVE_MULTIPART_THRESHOLD
+                    and content_encoding == "identity"
+                ):
+                    # pipe the download straight into the upload
+                    cls._upload_stream(target_bucket, chunks, int(content_length), remote_path)
+                else:
+                    local_path = save_to_tmp_file(chunks)
+                    try:
+                        target_bucket.upload(local_path, remote_path)
+                    finally:
+                        os.remove(local_path)
 
         return f"https://{cls.host}/api/v1/buckets/{collab_name}{remote_path}"
 
+    @classmethod
+    def _upload_stream(cls, bucket, chunks, content_length, remote_path):
+        filename = remote_path.lstrip("/")
+        response = bucket.client.put(
+            f"/v1/{bucket.target}/{bucket.dataproxy_entity_name}/{filename}"
+        )
+        upload_url = response.json().get("url")
+        if upload_url is None:
+            raise Exception("Unable to obtain an upload URL for the Bucket")
+        # setting Content-Length stops httpx from using chunked transfer encoding
+        response = httpx.put(
+            upload_url,
+            content=chunks,
+            headers={"Content-Length": str(content_length)},
+            timeout=TRANSFER_TIMEOUT,
+        )
+        response.raise_for_status()
+
     @classmethod
     def _delete(cls, collab_name, path, access_token):
         # private method for use by test framework to clean up
@@ -1,28 +1,40 @@
+import asyncio
+import json
+import ssl
 from datetime import datetime, date, timedelta
+import time
 import pytz
 from typing import List
 import uuid
 from slugify import slugify
 
 import databases
+import databases.backends.postgres
 from sqlalchemy import (
     Column,
     ForeignKey,
     Integer,
     Float,
     String,
+    Text,
     Boolean,
     DateTime,
     Date,
     Table,
+    Index,
     MetaData,
     literal_column,
     func,
     distinct,
     select as slct,
     desc,
+    case,
+    exists,
+    cast,
+    bindparam,
 )
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.dialects.postgresql import UUID, ARRAY, JSONB, insert as pg_insert
 from asyncpg.exceptions import PostgresSyntaxError
 
 from .data_models import (
@@ -32,12 +44,145 @@ from .data_models import (
 from . import settings
 
 
-SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.DATABASE_USERNAME}:{settings.DATABASE_PASSWORD}@{settings.DATABASE_HOST}:{settings.DATABASE_PORT}/nmpi?ssl=false"
+SQLALCHEMY_DATABASE_URL = f"postgresql://{settings.DATABASE_USERNAME}:{settings.DATABASE_PASSWORD}@{settings.DATABASE_HOST}:{settings.DATABASE_PORT}/nmpi"
+
+
+async def init_connection(connection):
+    # asyncpg returns jsonb values as text by default, which `databases` would then decode
+    # again each time a field is accessed. Decoding in the driver means it is done only once.
+    # Values are already serialized by SQLAlchemy when written, so they are passed through.
+    await connection.set_type_codec(
+        "jsonb", encoder=lambda value: value, decoder=json.loads, schema="pg_catalog"
+    )
+
+
+def ssl_options(mode: str, root_cert: str = None):
+    """
+    Return the value of the asyncpg `ssl` option for the given sslmode ("true" and "false"
+    are also accepted), using the given root certificate to verify the server, if any.
+    """
+    mode = {"true": True, "false": False}.get(mode.lower(), mode.lower())
+    if root_cert and mode in ("verify-ca", "verify-full"):
+        context = ssl.create_default_context(cafile=root_cert)
+        context.check_hostname = mode == "verify-full"
+        return context
+    return mode
+
+
+class DatabaseBusy(Exception):
+    """Raised when no connection becomes available from the pool within the acquire timeout"""
+
+
+class PostgresConnection(databases.backends.postgres.PostgresConnection):
+    async def acquire(self):
+        # as for the base class, but with a timeout, and recording the time spent waiting
+        assert self._connection is None, "Connection is already acquired"
+        assert self._database._pool is not None, "DatabaseBackend is not running"
+        pool_usage = self._database.usage
+        pool_usage["waiting"] += 1
+        start = time.perf_counter()
+        try:
+            self._connection = await self._database._pool.acquire(
+                timeout=self._database.acquire_timeout
+            )
+        except asyncio.TimeoutError:
+            pool_usage["timeouts"] += 1
+            raise DatabaseBusy("Timed out waiting for a database connection")
+        finally:
+            pool_usage["waiting"] -= 1
+            wait_time = time.perf_counter() - start
+            pool_usage["total_wait_time"] += wait_time
+            pool_usage["max_wait_time"] = max(pool_usage["max_wait_time"], wait_time)
+        pool_usage["acquired"] += 1
+
+
+class PostgresBackend(databases.backends.postgres.PostgresBackend):
+    def __init__(self, database_url, acquire_timeout: float = None, **options):
+        super().__init__(database_url, **options)
+        self.acquire_timeout = acquire_timeout
+        self.usage = {
+            "acquired": 0,
+            "waiting": 0,
+            "timeouts": 0,
+            "total_wait_time": 0.0,
+            "max_wait_time": 0.0,
+        }
+
+    def connection(self):
+        return PostgresConnection(self, self._dialect)
+
+
+class Database(databases.Database):
+    """
+    A `databases.Database` whose connections are taken from the pool with a timeout
+    (raising `DatabaseBusy` if it expires), and which records the usage of the pool.
+    """
+
+    def __init__(self, url, acquire_timeout: float = None, **options):
+        super().__init__(url, **options)
+        self._backend = PostgresBackend(self.url, acquire_timeout=acquire_timeout, **self.options)
+
+    def pool_status(self) -> dict:
+        """Return the current size and usage of the connection pool"""
+        pool = self._backend._pool
+        status = {
+            "size": pool.get_size() if pool else 0,
+            "idle": pool.get_idle_size() if pool else 0,
+            "min_size": pool.get_min_size() if pool else self.options.get("min_size"),
+            "max_size": pool.get_max_size() if pool else self.options.get("max_size"),
+            **self._backend.usage,
+        }
+        status["in_use"] = status["size"] - status["idle"]
+        return status
+
+
+database = Database(
+    SQLALCHEMY_DATABASE_URL,
+    acquire_timeout=settings.DATABASE_POOL_ACQUIRE_TIMEOUT,
+    init=init_connection,
+    min_size=settings.DATABASE_POOL_MIN_SIZE,
+    max_size=settings.DATABASE_POOL_MAX_SIZE,
+    statement_cache_size=settings.DATABASE_STATEMENT_CACHE_SIZE,
+    ssl=ssl_options(settings.DATABASE_SSL, settings.DATABASE_SSL_ROOT_CERT),
+)
+
+
+class CachedQuery:
+    """
+    A query that is compiled to SQL once, rather than each time it is run,
+    for queries that are run very often. Values are given by `bindparam()`s in the query,
+    and passed by name when running it.
+
+    Queries are run directly with asyncpg, which also keeps the prepared statement
+    for each connection, so results are asyncpg Records, with values not processed
+    by SQLAlchemy: this is only suitable for columns whose values asyncpg returns as is
+    (e.g. not UUID or Enum columns).
+    """
+
+    def __init__(self, query):
+        compiled = query.compile(dialect=postgresql.dialect(paramstyle="pyformat"))
+        # default values, e.g. from `.limit()`
+        self.defaults = compiled.params
+        self.names = sorted(compiled.params)
+        self.sql = compiled.string % {name: f"${i}" for i, name in enumerate(self.names, start=1)}
+
+    def _args(self, values):
+        values = {**self.defaults, **values}
+        return [values[name] for name in self.names]
+
+    async def fetch_all(self, **values):
+        async with database.connection() as connection:
+            return await connection.raw_connection.fetch(self.sql, *self._args(values))
+
+    async def fetch_one(self, **values):
+        async with database.connection() as connection:
+            return await connection.raw_connection.fetchrow(self.sql, *self._args(values))
 
-database = databases.Database(SQLALCHEMY_DATABASE_URL)
 
 metadata = MetaData()
 
+# Changes to the tables below need a migration, see migrate.py and the "migrations" directory
+
 
 def now_in_utc():
     return datetime.now(pytz.UTC)
@@ -52,6 +197,9 @@ data_items = Table(
     Column("hash", String(256)),
     Column("size", Integer),
     Column("content_type", String(100)),
+    # data items are shared between jobs: there is a single row for each file (url + hash).
+    # Items without a hash are never shared, since NULLs are distinct in a unique index.
+    Index("ix_simqueue_dataitem_url_hash", "url", "hash", unique=True),
 )
 
 jobs = Table(
@@ -64,11 +212,35 @@ jobs = Table(
     Column("user_id", String(36), nullable=False),
     Column("status", String(15), default="submitted", nullable=False),
     Column("hardware_platform", String(20), nullable=False),
-    Column("hardware_config", String),
+    Column("hardware_config", JSONB(none_as_null=True)),
     Column("timestamp_submission", DateTime(timezone=True), default=now_in_utc, nullable=False),
     Column("timestamp_completion", DateTime(timezone=True)),
-    Column("provenance", String),
+    Column("provenance", JSONB(none_as_null=True)),
     Column("resource_usage", Float),
+    # the queue of submitted jobs for each platform, see get_next_job()
+    Index(
+        "ix_simqueue_job_submitted",
+        "hardware_platform",
+        "timestamp_submission",
+        postgresql_where=literal_column("status = 'submitted'"),
+    ),
+    # jobs of a given user or collab, most recent first, see query_jobs()
+    Index("ix_simqueue_job_user_id_id", "user_id", "id"),
+    Index("ix_simqueue_job_collab_id_id", "collab_id", "id"),
+    # jsonb_path_ops indexes support only containment (@>) queries, which is all we use,
+    # and are smaller and faster than the default jsonb_ops
+    Index(
+        "ix_simqueue_job_hardware_config",
+        "hardware_config",
+        postgresql_using="gin",
+        postgresql_ops={"hardware_config": "jsonb_path_ops"},
+    ),
+    Index(
+        "ix_simqueue_job_provenance",
+        "provenance",
+        postgresql_using="gin",
+        postgresql_ops={"provenance": "jsonb_path_ops"},
+    ),
 )
 
 job_input_data = Table(
@@ -76,6 +248,7 @@ job_input_data = Table(
     metadata,
     Column("job_id", ForeignKey("simqueue_job.id"), primary_key=True),
     Column("dataitem_id", ForeignKey("simqueue_dataitem.id"), primary_key=True),
+    Index("ix_simqueue_job_input_data_dataitem_id", "dataitem_id"),
 )
 
 job_output_data = Table(
@@ -83,6 +256,7 @@ job_output_data = Table(
     metadata,
     Column("job_id", ForeignKey("simqueue_job.id"), primary_key=True),
     Column("dataitem_id", ForeignKey("simqueue_dataitem.id"), primary_key=True),
+    Index("ix_simqueue_job_output_data_dataitem_id", "dataitem_id"),
 )
 
 sessions = Table(
@@ -93,7 +267,7 @@ sessions = Table(
     Column("user_id", String(36), nullable=False),
     Column("status", String(15), default="submitted", nullable=False),
     Column("hardware_platform", String(20), nullable=False),
-    Column("hardware_config", String),
+    Column("hardware_config", JSONB(none_as_null=True)),
     Column("timestamp_start", DateTime(timezone=True), default=now_in_utc, nullable=False),
     Column("timestamp_end", DateTime(timezone=True)),
     Column("resource_usage", Float),
@@ -105,13 +279,39 @@ CREATE TABLE simqueue_session(
     user_id character varying(36) NOT NULL,
     status character varying(15) NOT NULL,
     hardware_platform character varying(20) NOT NULL,
-    hardware_config text,
+    hardware_config jsonb,
     timestamp_start timestamp with time zone NOT NULL,
     timestamp_end timestamp with time zone,
     resource_usage double precision
 );
 """
 
+data_transfers = Table(
+    "simqueue_datatransfer",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("job_id", Integer, ForeignKey("simqueue_job.id"), nullable=False, index=True),
+    Column("user_id", String(36), nullable=False),
+    Column("repository", String(100), nullable=False),
+    Column("status", String(15), nullable=False),
+    Column("n_files", Integer, nullable=False),
+    Column("n_copied", Integer, server_default="0", nullable=False),
+    Column("error", String),
+    Column("timestamp_start", DateTime(timezone=True), nullable=False),
+    Column("timestamp_end", DateTime(timezone=True)),
+    # updated regularly while the transfer is in progress, see expire_stale_data_transfers()
+    Column("timestamp_update", DateTime(timezone=True), nullable=False),
+    # a job has at most one active transfer
+    Index(
+        "ix_simqueue_datatransfer_active",
+        "job_id",
+        unique=True,
+        postgresql_where=literal_column("status IN ('queued', 'running')"),
+    ),
+)
+
+ACTIVE_TRANSFER_STATUSES = ("queued", "running")
+
 comments = Table(
     "simqueue_comment",
     metadata,
@@ -133,7 +333,7 @@ taglist = Table(
     "taggit_tag",
     metadata,
     Column("id", Integer, primary_key=True),
-    Column("name", String(100), nullable=False),
+    Column("name", String(100), nullable=False, index=True),
     Column("slug", String(100), nullable=False),
 )
 
@@ -141,16 +341,16 @@ tagged_items = Table(
     "taggit_taggeditem",
     metadata,
     Column("id", Integer, primary_key=True),
-    Column("object_id", Integer, nullable=False),
+    Column("object_id", Integer, nullable=False, index=True),
     Column("content_type_id", Integer, nullable=False),
-    Column("tag_id", Integer, ForeignKey("taggit_tag.id"), nullable=False),
+    Column("tag_id", Integer, ForeignKey("taggit_tag.id"), nullable=False, index=True),
 )
 
 projects = Table(
     "quotas_project",
     metadata,
     Column("context", UUID, primary_key=True, default=uuid.uuid4),
-    Column("collab", String(40), nullable=False),
+    Column("collab", String(40), nullable=False, index=True),
     Column("owner", String(36), nullable=False),
     Column("title", String(200), nullable=False),
     Column("abstract", String, nullable=False),
@@ -171,7 +371,35 @@ quotas = Table(
     Column("limit", Float, nullable=False),
     Column("usage", Float, default=0, nullable=False),
     Column("platform", String(20), nullable=False),
-    Column("project_id", UUID, ForeignKey("quotas_project.context"), nullable=False),
+    Column("project_id", UUID, ForeignKey("quotas_project.context"), nullable=False, index=True),
+)
+
+quota_reservations = Table(
+    "quotas_reservation",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("job_id", Integer, ForeignKey("simqueue_job.id"), nullable=False, index=True),
+    Column("quota_id", Integer, ForeignKey("quotas_quota.id"), nullable=False, index=True),
+    Column("amount", Float, nullable=False),
+)
+
+quota_ledger = Table(
+    "quotas_ledger",
+    metadata,
+    Column("id", Integer, primary_key=True),
+    Column("quota_id", Integer, ForeignKey("quotas_quota.id"), nullable=False),
+    Column("job_id", Integer),
+    Column("session_id", Integer),
+    Column("platform", String(20), nullable=False),
+    Column("amount", Float, nullable=False),
+    Column("timestamp", DateTime(timezone=True), nullable=False),
+    # set once the amount has been folded into quotas_quota.usage
+    Column("compacted", Boolean, server_default="false", nullable=False),
+    Index(
+        "ix_quotas_ledger_uncompacted",
+        "quota_id",
+        postgresql_where=literal_column("NOT compacted"),
+    ),
 )
 
 api_keys = Table(
@@ -183,96 +411,373 @@ api_keys = Table(
     Column("user_id", Integer, nullable=False),
 )
 
+schema_migrations = Table(
+    "schema_migrations",
+    metadata,
+    Column("version", String(10), primary_key=True),
+    Column("applied", DateTime(timezone=True), nullable=False),
+)
+
 
-async def follow_relationships(job):
-    # input data
-    query = data_items.select().where(
-        data_items.c.id == job_input_data.c.dataitem_id, job_input_data.c.job_id == job["id"]
+JOB_RELATIONSHIPS = ("input_data", "output_data", "output_data_summary", "tags")
+
+
+# the queries run for (almost) every request from users and providers
+_job_query = CachedQuery(jobs.select().where(jobs.c.id == bindparam("job_id")))
+_next_job_query = CachedQuery(
+    jobs.select()
+    .where(
+        jobs.c.hardware_platform == bindparam("hardware_platform"), jobs.c.status == "submitted"
     )
-    results = await database.fetch_all(query)
-    job["input_data"] = [dict(row) for row in results or []]
+    .order_by("timestamp_submission")
+    .limit(1)
+)
+_input_data_query = CachedQuery(
+    data_items.select().where(
+        data_items.c.id == job_input_data.c.dataitem_id,
+        job_input_data.c.job_id == bindparam("job_id"),
+    )
+)
+_output_data_summary_query = CachedQuery(
+    slct(
+        func.count(data_items.c.id).label("count"),
+        func.sum(data_items.c.size).label("size"),
+        func.min(data_items.c.url).label("url"),
+    ).where(
+        data_items.c.id == job_output_data.c.dataitem_id,
+        job_output_data.c.job_id == bindparam("job_id"),
+    )
+)
+_tags_query = CachedQuery(
+    slct(taglist.c.name).where(
+        taglist.c.id == tagged_items.c.tag_id, tagged_items.c.object_id == bindparam("job_id")
+    )
+)
+_api_key_query = CachedQuery(slct(api_keys.c.user_id).where(api_keys.c.key == bindparam("key")))
+
+
+async def follow_relationships(job, include=("input_data", "output_data", "tags")):
+    """
+    Add the related objects named in `include` (see JOB_RELATIONSHIPS) to a job.
+
+    "output_data_summary" is an alternative to "output_data" that is much faster
+    for jobs with many output files.
+    """
+    # input data
+    if "input_data" in include:
+        results = await _input_data_query.fetch_all(job_id=job["id"])
+        job["input_data"] = [dict(row) for row in results]
 
     # output data
-    query = data_items.select().where(
-        data_items.c.id == job_output_data.c.dataitem_id, job_output_data.c.job_id == job["id"]
-    )
-    results = await database.fetch_all(query)
-    job["output_data"] = [dict(row) for row in results or []]
+    if "output_data" in include:
+        job["output_data"] = await query_output_data(job["id"])
+    if "output_data_summary" in include:
+        job["output_data_summary"] = await get_output_data_summary(job["id"])
 
     # tags
-    query = tagged_items.select().where(tagged_items.c.object_id == job["id"])
-    results = await database.fetch_all(query)
-    tags = []
-    for tag_item in results:
-        query = taglist.select().where(taglist.c.id == tag_item.tag_id)
-        used_tag = await database.fetch_one(query)
-        tags.append(Tag(used_tag["name"]))
-    job["tags"] = sorted([item for item in tags or []])
+    if "tags" in include:
+        results = await _tags_query.fetch_all(job_id=job["id"])
+        job["tags"] = sorted(Tag(row["name"]) for row in results)
 
     return job
 
 
+def _output_data_query(job_id: int):
+    return (
+        data_items.select()
+        .where(
+            data_items.c.id == job_output_data.c.dataitem_id, job_output_data.c.job_id == job_id
+        )
+        .order_by(data_items.c.id)
+    )
+
+
+async def query_output_data(job_id: int, size: int = None, cursor: int = None):
+    """
+    Return the output data items of a job, ordered by id.
+
+    For pagination, pass the id of the last item of the previous page as `cursor`.
+    """
+    query = _output_data_query(job_id)
+    if cursor is not None:
+        query = query.where(data_items.c.id > cursor)
+    if size is not None:
+        query = query.limit(size)
+    results = await database.fetch_all(query)
+    return [dict(row) for row in results]
+
+
+async def iterate_output_data(job_id: int):
+    """Yield the output data items of a job one by one, using a server-side cursor."""
+    async for row in database.iterate(_output_data_query(job_id)):
+        yield dict(row)
+
+
+async def get_output_data_summary(job_id: int):
+    """
+    Return the number and total size of a job's output data items,
+    and the URL of one of them, from which the repository can be determined.
+    """
+    return dict(await _output_data_summary_query.fetch_one(job_id=job_id))
+
+
 async def follow_relationships_quotas(id):
-    query = quotas.select().where(quotas.c.project_id == id)
+    query = select_quotas().where(quotas.c.project_id == id)
     results = await database.fetch_all(query)
     return [dict(result) for result in results]
 
 
 async def delete_dataitems(job_id):
-    # input data
-    query = job_input_data.delete().where(job_input_data.c.job_id == job_id)
-    await database.execute(query)
-    query2 = data_items.delete().where(
-        data_items.c.id == job_input_data.c.dataitem_id, job_input_data.c.job_id == job_id
-    )
-    await database.execute(query2)
-
-    # output data
-    query3 = job_output_data.delete().where(job_output_data.c.job_id == job_id)
-    await database.execute(query3)
-    query4 = data_items.delete().where(
-        data_items.c.id == job_output_data.c.dataitem_id, job_output_data.c.job_id == job_id
-    )
-    await database.execute(query4)
+    """Unlink the data items of a job, deleting those no longer used by any other job."""
+    async with database.transaction():
+        dataitem_ids = set()
+        for link_table in (job_input_data, job_output_data):
+            query = (
+                link_table.delete()
+                .where(link_table.c.job_id == job_id)
+                .returning(link_table.c.dataitem_id)
+            )
+            results = await database.fetch_all(query)
+            dataitem_ids.update(row["dataitem_id"] for row in results)
+        await delete_unreferenced_dataitems(dataitem_ids)
 
     return
 
 
+async def delete_unreferenced_dataitems(dataitem_ids):
+    """Of the given data items, delete those not linked to any job."""
+    if dataitem_ids:
+        query = data_items.delete().where(
+            data_items.c.id.in_(dataitem_ids),
+            ~exists().where(job_input_data.c.dataitem_id == data_items.c.id),
+            ~exists().where(job_output_data.c.dataitem_id == data_items.c.id),
+        )
+        await database.execute(query)
+
+
+def unnest_rows(table: Table, rows: List[dict], fields: List[str]):
+    """
+    Return a SELECT producing the given rows from one array parameter per column.
+
+    Unlike a multi-row VALUES list, the statement does not grow with the number of rows,
+    so it compiles quickly and is not subject to PostgreSQL's limit on the number of parameters.
+    """
+
+    def element_type(column):
+        # an explicit cast to varchar(n) silently truncates longer values,
+        # so we cast to unbounded text and let the insert enforce the column length
+        if isinstance(column.type, String):
+            return Text()
+        return column.type
+
+    arrays = [
+        cast(
+            bindparam(f"{field}_array", [row.get(field) for row in rows]),
+            ARRAY(element_type(table.c[field])),
+        )
+        for field in fields
+    ]
+    return slct(func.unnest(*arrays).table_valued(*fields).render_derived())
+
+
+DATA_ITEM_FIELDS = ["url", "path", "hash", "size", "content_type"]
+
+
+async def upsert_dataitems(items: List[dict]) -> List[int]:
+    """
+    Insert data items in a single statement, reusing any existing item
+    with the same url and hash.
+
+    Returns the data item ids, in the same order as `items`.
+    """
+    # a row may only be upserted once per statement, so we merge repeated items first
+    unique_items = {}
+    for item in items:
+        item = dict(item)
+        key = (item["url"], item.get("hash"))
+        if key in unique_items:
+            for field, value in unique_items[key].items():
+                if value is None:
+                    unique_items[key][field] = item.get(field)
+        else:
+            unique_items[key] = item
+    if not unique_items:
+        return []
+    ins = pg_insert(data_items).from_select(
+        DATA_ITEM_FIELDS, unnest_rows(data_items, list(unique_items.values()), DATA_ITEM_FIELDS)
+    )
+    ins = ins.on_conflict_do_update(
+        index_elements=[data_items.c.url, data_items.c.hash],
+        # fill in any metadata missing from the existing item
+        set_={
+            field: func.coalesce(data_items.c[field], ins.excluded[field])
+            for field in ("path", "size", "content_type")
+        },
+    ).returning(data_items.c.id, data_items.c.url, data_items.c.hash)
+    results = await database.fetch_all(ins)
+    ids = {(row["url"], row["hash"]): row["id"] for row in results}
+    return [ids[(item["url"], item.get("hash"))] for item in items]
+
+
+async def link_dataitems(link_table: Table, job_id: int, items: List[dict]):
+    dataitem_ids = await upsert_dataitems(items)
+    if dataitem_ids:
+        rows = [{"job_id": job_id, "dataitem_id": id} for id in dataitem_ids]
+        fields = ["job_id", "dataitem_id"]
+        ins = (
+            pg_insert(link_table)
+            .from_select(fields, unnest_rows(link_table, rows, fields))
+            .on_conflict_do_nothing()
+        )
+        await database.execute(ins)
+
+
 async def create_job_input_data_item(job_id, input_data):
-    for item in input_data:
-        ins_data_item = data_items.insert().values(**dict(item))
-        data_item_id = await database.execute(ins_data_item)
-        ins_job_input = job_input_data.insert().values(job_id=job_id, dataitem_id=data_item_id)
-        await database.execute(ins_job_input)
+    async with database.transaction():
+        await link_dataitems(job_input_data, job_id, input_data)
 
     return
 
 
 async def create_job_output_data_item(job_id, output_data):
-    for item in output_data:
-        ins_data_item = data_items.insert().values(**item)
-        data_item_id = await database.execute(ins_data_item)
-        ins_job_output = job_output_data.insert().values(job_id=job_id, dataitem_id=data_item_id)
-        await database.execute(ins_job_output)
+    async with database.transaction():
+        await link_dataitems(job_output_data, job_id, output_data)
 
     return
 
 
+async def relink_output_dataitem(job_id: int, dataitem_id: int, values: dict):
+    """
+    Change a data item of a job's output data.
+
+    Since data items may be shared with other jobs, rather than modifying the item in place
+    we link the job to an item with the new values, and delete the old one if it is no longer used.
+    Must be called within a transaction.
+    """
+    query = data_items.select().where(data_items.c.id == dataitem_id)
+    item = dict(await database.fetch_one(query))
+    item.pop("id")
+    item.update(values)
+    await database.execute(
+        job_output_data.delete().where(
+            job_output_data.c.job_id == job_id, job_output_data.c.dataitem_id == dataitem_id
+        )
+    )
+    await link_dataitems(job_output_data, job_id, [item])
+    await delete_unreferenced_dataitems([dataitem_id])
+
+
 async def update_job_output_data_item(job_id, output_data):
-    for item in output_data:
-        if "hash" in item:
-            ins = (
-                data_items.update()
-                .where(
+    async with database.transaction():
+        for item in output_data:
+            if "hash" in item:
+                query = slct(job_output_data.c.dataitem_id).where(
                     data_items.c.id == job_output_data.c.dataitem_id,
                     job_output_data.c.job_id == job_id,
                     data_items.c.hash == item["hash"],
                 )
-                .values(**item)
-            )
-            await database.execute(ins)
-        else:
-            raise ValueError("Modification of data items without hashes not yet implemented.")
+                for row in await database.fetch_all(query):
+                    await relink_output_dataitem(job_id, row["dataitem_id"], item)
+            else:
+                raise ValueError("Modification of data items without hashes not yet implemented.")
+
+
+async def create_data_transfer(job_id: int, user_id: str, repository: str, n_files: int):
+    """
+    Create a transfer of the given job's output data, unless the job already has an active
+    (queued or running) transfer.
+
+    Returns the new transfer, or the existing active one, and whether it was created.
+    """
+    now = now_in_utc()
+    ins = (
+        pg_insert(data_transfers)
+        .values(
+            job_id=job_id,
+            user_id=user_id,
+            repository=repository,
+            status="queued",
+            n_files=n_files,
+            timestamp_start=now,
+            timestamp_update=now,
+        )
+        .on_conflict_do_nothing(
+            index_elements=[data_transfers.c.job_id],
+            index_where=data_transfers.c.status.in_(ACTIVE_TRANSFER_STATUSES),
+        )
+        .returning(data_transfers.c.id)
+    )
+    async with database.transaction():
+        await expire_stale_data_transfers(job_id)
+        # if another request created a transfer concurrently, this waits for it to commit
+        transfer_id = await database.fetch_val(ins)
+        if transfer_id is None:
+            return await get_active_data_transfer(job_id), False
+        return await get_data_transfer(transfer_id), True
+
+
+async def get_data_transfer(transfer_id: int):
+    query = data_transfers.select().where(data_transfers.c.id == transfer_id)
+    result = await database.fetch_one(query)
+    return dict(result) if result else None
+
+
+async def get_active_data_transfer(job_id: int):
+    """Return the queued or running transfer of the given job's output data, if any"""
+    await expire_stale_data_transfers(job_id)
+    query = data_transfers.select().where(
+        data_transfers.c.job_id == job_id,
+        data_transfers.c.status.in_(ACTIVE_TRANSFER_STATUSES),
+    )
+    result = await database.fetch_one(query)
+    return dict(result) if result else None
+
+
+async def expire_stale_data_transfers(job_id: int = None):
+    """
+    Mark as failed any active transfers (of the given job, or of all jobs) that have not been
+    updated within `settings.DATA_TRANSFER_TIMEOUT`, e.g. because the process running
+    the transfer was restarted, so that the transfer can be started again.
+    """
+    cutoff = now_in_utc() - timedelta(seconds=settings.DATA_TRANSFER_TIMEOUT)
+    ins = (
+        data_transfers.update()
+        .where(
+            data_transfers.c.status.in_(ACTIVE_TRANSFER_STATUSES),
+            data_transfers.c.timestamp_update < cutoff,
+        )
+        .values(
+            status="error",
+            error="The transfer was interrupted, please try again",
+            timestamp_end=now_in_utc(),
+        )
+    )
+    if job_id is not None:
+        ins = ins.where(data_transfers.c.job_id == job_id)
+    await database.execute(ins)
+
+
+async def update_data_transfer(transfer_id: int, values: dict):
+    values = dict(values, timestamp_update=now_in_utc())
+    ins = data_transfers.update().where(data_transfers.c.id == transfer_id).values(**values)
+    await database.execute(ins)
+
+
+async def record_file_transferred(transfer_id: int, dataitem_id: int = None, values: dict = None):
+    """
+    Update a data item with its location in the new repository,
+    and count it as copied by the given transfer.
+    """
+    async with database.transaction():
+        if dataitem_id is not None:
+            transfer = await get_data_transfer(transfer_id)
+            await relink_output_dataitem(transfer["job_id"], dataitem_id, values)
+        ins = (
+            data_transfers.update()
+            .where(data_transfers.c.id == transfer_id)
+            .values(n_copied=data_transfers.c.n_copied + 1, timestamp_update=now_in_utc())
+        )
+        await database.execute(ins)
 
 
 async def update_log(job_id, log, append=False):
@@ -298,7 +803,7 @@ def get_list_filter(attr, value):
         return attr == value[0]
 
 
-async def query_jobs(
+def job_filters(
     status: List[str] = None,
     tags: List[str] = None,
     collab: List[str] = None,
@@ -306,11 +811,16 @@ async def query_jobs(
     hardware_platform: List[str] = None,
     date_range_start: date = None,
     date_range_end: date = None,
-    fields: List[str] = None,
-    from_index: int = 0,
-    size: int = 10,
+    hardware_config: dict = None,
+    provenance: dict = None,
     exclude_removed=False,
 ):
+    """
+    Return the filters for a query of the jobs table.
+
+    `hardware_config` and `provenance` select jobs whose JSON document contains the given
+    (possibly nested) structure, e.g. `{"wafer": 62}`, which can use the GIN indexes.
+    """
     filters = []
     if exclude_removed:
         filters.append(jobs.c.status != "removed")
@@ -330,18 +840,111 @@ async def query_jobs(
     elif date_range_end:
         filters.append(jobs.c.timestamp_submission <= date_range_end)
     if tags:
-        # this is a simplistic implementation where we first fetch the tag ids
-        # todo: replace this with a single, more sophisticated SQL query
-        tag_query = taglist.select().where(taglist.c.name.in_(tags))
-        tag_ids = [row["id"] for row in await database.fetch_all(tag_query)]
-        tagged_item_query = tagged_items.select().where(tagged_items.c.tag_id.in_(tag_ids))
-        tagged_item_ids = [row["object_id"] for row in await database.fetch_all(tagged_item_query)]
-        filters.append(jobs.c.id.in_(tagged_item_ids))
+        tagged_job_ids = slct(tagged_items.c.object_id).where(
+            tagged_items.c.tag_id == taglist.c.id, taglist.c.name.in_(tags)
+        )
+        filters.append(jobs.c.id.in_(tagged_job_ids))
+    if hardware_config:
+        filters.append(jobs.c.hardware_config.contains(hardware_config))
+    if provenance:
+        filters.append(jobs.c.provenance.contains(provenance))
+    return filters
+
+
+async def iterate_jobs(include=(), batch_size: int = 1000, **filters):
+    """
+    Yield all jobs matching the filters (see `job_filters()`) in order of id,
+    reading them from a server-side cursor so that memory use does not depend
+    on the number of jobs.
+
+    The related objects named in `include` are loaded for each batch of jobs,
+    with one query per relationship.
+    """
+    query = jobs.select().where(*job_filters(**filters)).order_by(jobs.c.id)
+    batch = []
+    async for row in database.iterate(query):
+        batch.append(dict(row))
+        if len(batch) == batch_size:
+            # the cursor holds this task's connection until iteration is complete,
+            # so related objects are loaded in another task, with its own connection
+            await asyncio.create_task(follow_relationships_batch(batch, include))
+            for job in batch:
+                yield job
+            batch = []
+    await follow_relationships_batch(batch, include)
+    for job in batch:
+        yield job
+
+
+async def follow_relationships_batch(batch, include):
+    """Add the related objects named in `include` to each of a list of jobs"""
+    if not (batch and include):
+        return
+    jobs_by_id = {job["id"]: job for job in batch}
+    for name, link_table in (("input_data", job_input_data), ("output_data", job_output_data)):
+        if name in include:
+            for job in batch:
+                job[name] = []
+            query = (
+                slct(link_table.c.job_id, data_items)
+                .where(
+                    data_items.c.id == link_table.c.dataitem_id,
+                    link_table.c.job_id.in_(jobs_by_id),
+                )
+                .order_by(data_items.c.id)
+            )
+            for row in await database.fetch_all(query):
+                data_item = dict(row)
+                jobs_by_id[data_item.pop("job_id")][name].append(data_item)
+    if "tags" in include:
+        for job in batch:
+            job["tags"] = []
+        query = slct(tagged_items.c.object_id, taglist.c.name).where(
+            tagged_items.c.tag_id == taglist.c.id, tagged_items.c.object_id.in_(jobs_by_id)
+        )
+        for row in await database.fetch_all(query):
+            jobs_by_id[row["object_id"]]["tags"].append(row["name"])
+        for job in batch:
+            job["tags"].sort()
+
+
+async def query_jobs(
+    status: List[str] = None,
+    tags: List[str] = None,
+    collab: List[str] = None,
+    user_id: List[str] = None,
+    hardware_platform: List[str] = None,
+    date_range_start: date = None,
+    date_range_end: date = None,
+    hardware_config: dict = None,
+    provenance: dict = None,
+    fields: List[str] = None,
+    from_index: int = 0,
+    size: int = 10,
+    exclude_removed=False,
+):
+    filters = job_filters(
+        status=status,
+        tags=tags,
+        collab=collab,
+        user_id=user_id,
+        hardware_platform=hardware_platform,
+        date_range_start=date_range_start,
+        date_range_end=date_range_end,
+        hardware_config=hardware_config,
+        provenance=provenance,
+        exclude_removed=exclude_removed,
+    )
 
     if fields is None:
         select = jobs.select()
     else:
-        select = jobs.select().with_only_columns(*[literal_column(field) for field in fields])
+        # `fields` may contain both column names and the names of related objects
+        columns = [field for field in fields if field not in JOB_RELATIONSHIPS]
+        include = [field for field in fields if field in JOB_RELATIONSHIPS]
+        if include and "id" not in columns:
+            columns.append("id")
+        select = jobs.select().with_only_columns(*[jobs.c[field] for field in columns])
 
     if filters:
         query = select.where(*filters).offset(from_index).limit(size)
@@ -351,28 +954,34 @@ async def query_jobs(
     results = await database.fetch_all(query.order_by(desc("id")))
 
     if fields:
+        if include:
+            return [await follow_relationships(dict(result), include) for result in results]
         return [dict(result) for result in results]
     return [await follow_relationships(dict(result)) for result in results]
 
 
-async def get_job(job_id: int):
-    query = jobs.select().where(jobs.c.id == job_id)
-    result = await database.fetch_one(query)
+async def get_job(job_id: int, output_data: bool = True):
+    """
+    Return a job, including its input and output data.
+
+    With `output_data=False`, only a summary of the output data is included,
+    as "output_data_summary", which is much faster for jobs with many output files.
+    """
+    result = await _job_query.fetch_one(job_id=job_id)
     if result is not None:
         intermediate_result = dict(result)
-        return await follow_relationships(intermediate_result)
+        if output_data:
+            return await follow_relationships(intermediate_result)
+        intermediate_result["output_data"] = None
+        return await follow_relationships(
+            intermediate_result, include=("input_data", "output_data_summary", "tags")
+        )
     else:
         return None
 
 
 async def get_next_job(hardware_platform: str):
-    query = (
-        jobs.select()
-        .where(jobs.c.hardware_platform == hardware_platform, jobs.c.status == "submitted")
-        .order_by("timestamp_submission")
-        .limit(1)
-    )
-    result = await database.fetch_one(query)
+    result = await _next_job_query.fetch_one(hardware_platform=hardware_platform)
     if result is not None:
         intermediate_result = dict(result)
         return await follow_relationships(intermediate_result)
@@ -380,6 +989,19 @@ async def get_next_job(hardware_platform: str):
         return None
 
 
+async def get_code_archives_in_use(url_prefix: str):
+    """
+    Return the names of the code archives (files under `url_prefix`)
+    given as the code of jobs that have not yet finished.
+    """
+    query = slct(jobs.c.code).where(
+        jobs.c.status.in_(["submitted", "validated", "running", "mapped"]),
+        jobs.c.code.startswith(url_prefix + "/", autoescape=True),
+    )
+    results = await database.fetch_all(query)
+    return {row["code"][len(url_prefix) + 1 :] for row in results}
+
+
 async def create_job(user_id: str, job: dict):
     ins = jobs.insert().values(
         code=job["code"],
@@ -407,17 +1029,18 @@ async def update_job(job_id: int, job_patch: dict):
     output_data = job_patch.pop("output_data", None)
     log = job_patch.pop("log", None)
 
-    if job_patch:
-        try:
-            ins = jobs.update().where(jobs.c.id == job_id).values(**job_patch)
-            await database.execute(ins)
-        except PostgresSyntaxError as err:
-            raise PostgresSyntaxError(f"job_patch was {job_patch}") from err
-
-    if output_data:
-        await create_job_output_data_item(job_id, output_data)
-    if log:
-        await update_log(job_id, log)
+    async with database.transaction():
+        if job_patch:
+            try:
+                ins = jobs.update().where(jobs.c.id == job_id).values(**job_patch)
+                await database.execute(ins)
+            except PostgresSyntaxError as err:
+                raise PostgresSyntaxError(f"job_patch was {job_patch}") from err
+
+        if output_data:
+            await create_job_output_data_item(job_id, output_data)
+        if log:
+            await update_log(job_id, log)
     return await get_job(job_id)
 
 
@@ -437,6 +1060,13 @@ async def delete_job(job_id: int):
     query = comments.delete().where(comments.c.job_id == job_id)
     await database.execute(query)
 
+    # delete records of output data transfers
+    query = data_transfers.delete().where(data_transfers.c.job_id == job_id)
+    await database.execute(query)
+
+    # release any quota reserved for the job
+    await release_reservations(job_id)
+
     # delete the job
     ins = jobs.delete().where(jobs.c.id == job_id)
     result = await database.execute(ins)
@@ -475,7 +1105,7 @@ async def query_sessions(
     if fields is None:
         select = sessions.select()
     else:
-        select = sessions.select().with_only_columns(*[literal_column(field) for field in fields])
+        select = sessions.select().with_only_columns(*[sessions.c[field] for field in fields])
 
     if filters:
         query = select.where(*filters).offset(from_index).limit(size)
@@ -535,8 +1165,7 @@ async def get_provider(apikey):
     # we could use the auth_user table in the database for mapping user_id to username,
     # but since we only have five users with API keys, we take the simple
     # approach for now
-    query = api_keys.select().where(api_keys.c.key == apikey)
-    result = await database.fetch_one(query)
+    result = await _api_key_query.fetch_one(key=apikey)
     if result:
         return provider_id_map[result["user_id"]]
     else:
@@ -806,14 +1435,40 @@ async def create_project(project):
         accepted=False,
     )
     await database.execute(ins)
+    invalidate_quota_cache()
     return await get_project(project_id)
 
 
+async def provision_quota(collab: str, platform: str, project: dict, quota: dict):
+    """
+    Create an accepted project with a single quota, unless the collab already has
+    an accepted quota for the given platform.
+
+    Provisioning is serialised per (collab, platform) with a transaction-level advisory lock,
+    so that concurrent requests create at most one project.
+    Returns the new project and quota, or None if the collab already has a quota.
+    """
+    async with database.transaction():
+        lock_key = func.hashtext(f"quota-provisioning:{collab}:{platform}")
+        await database.fetch_val(slct(func.pg_advisory_xact_lock(lock_key)))
+        if await query_available_quotas(collab, platform):
+            return None
+        new_project = await create_project(project)
+        project_id = new_project["context"]
+        new_project = await update_project(
+            project_id, {"accepted": True, "decision_date": project["submission_date"]}
+        )
+        new_quota = await create_quota(project_id, quota)
+    invalidate_quota_cache(collab, platform)
+    return new_project, new_quota
+
+
 async def update_project(project_id, project_update):
     # todo: allow only some fields to be updated
 
     ins = projects.update().where(projects.c.context == project_id).values(**project_update)
     await database.execute(ins)
+    invalidate_quota_cache()
     return await get_project(project_id)
 
 
@@ -827,12 +1482,13 @@ async def delete_project(project_id):
     await delete_quotas_from_project(project_id)
     query = projects.delete().where(projects.c.context == project_id)
     await database.execute(query)
+    invalidate_quota_cache()
 
 
 async def query_quotas(
     project_id: UUID = None, platform=None, from_index: int = 0, size: int = 10
 ):
-    query = quotas.select()
+    query = select_quotas()
     if project_id:
         query = query.where(quotas.c.project_id == project_id)
     if platform:
@@ -851,14 +1507,19 @@ async def delete_quotas_from_project(project_id):
 
 
 async def get_quota(quota_id):
-    query = quotas.select().where(quotas.c.id == quota_id)
+    query = select_quotas().where(quotas.c.id == quota_id)
     results = await database.fetch_one(query)
     return results
 
 
 async def delete_quota(quota_id):
+    query = quota_reservations.delete().where(quota_reservations.c.quota_id == quota_id)
+    await database.execute(query)
+    query = quota_ledger.delete().where(quota_ledger.c.quota_id == quota_id)
+    await database.execute(query)
     query = quotas.delete().where(quotas.c.id == quota_id)
     await database.execute(query)
+    invalidate_quota_cache()
 
 
 async def create_quota(project_id, quota):
@@ -870,6 +1531,7 @@ async def create_quota(project_id, quota):
         platform=quota["platform"],
     )
     quota_id = await database.execute(ins)
+    invalidate_quota_cache()
     return await get_quota(quota_id)
 
 
@@ -883,5 +1545,463 @@ async def update_quota(quota_id, quota_update):
             usage=quota_update["usage"],
         )
     )
-    await database.execute(ins)
+    async with database.transaction():
+        await database.execute(ins)
+        # the new usage value replaces any debits not yet compacted
+        ins = (
+            quota_ledger.update()
+            .where(quota_ledger.c.quota_id == quota_id, quota_ledger.c.compacted == False)
+            .values(compacted=True)
+        )
+        await database.execute(ins)
+    invalidate_quota_cache()
     return await get_quota(quota_id)
+
+
+async def apply_quota_operations(operations: List[dict]):
+    """
+    Create or update quotas for many projects in a single transaction.
+
+    Each operation is a dict with keys "project_id", "platform", "units", "limit" and "usage".
+    If the project already has a quota for the platform, its limit is updated,
+    together with its usage unless this is None. Otherwise a new quota is created.
+
+    Returns one dict per operation, in the same order, containing the "status"
+    ("created", "updated" or "error") and either the "quota" or an error "detail".
+    """
+    results = [None] * len(operations)
+    project_ids = {operation["project_id"] for operation in operations}
+    async with database.transaction():
+        query = slct(projects.c.context).where(projects.c.context.in_(project_ids))
+        known_projects = {str(row["context"]) for row in await database.fetch_all(query)}
+        query = (
+            quotas.select()
+            .where(quotas.c.project_id.in_(project_ids))
+            .order_by(quotas.c.id)
+            .with_for_update()
+        )
+        existing_quotas = {}
+        for row in await database.fetch_all(query):
+            key = (str(row["project_id"]), row["platform"])
+            existing_quotas.setdefault(key, []).append(row["id"])
+
+        to_create = {}
+        to_update = {}
+        for i, operation in enumerate(operations):
+            key = (operation["project_id"], operation["platform"])
+            if operation["project_id"] not in known_projects:
+                detail = f"There is no project with id {operation['project_id']}"
+            elif key in to_create or key in to_update:
+                detail = "Duplicate operation for this project and platform"
+            elif len(existing_quotas.get(key, [])) > 1:
+                detail = "This project has more than one quota for this platform"
+            else:
+                detail = None
+            if detail:
+                results[i] = {"status": "error", "detail": detail}
+            elif key in existing_quotas:
+                to_update[key] = (i, existing_quotas[key][0], operation)
+            else:
+                to_create[key] = (i, operation)
+
+        quota_ids = {}
+        if to_update:
+            new_limits = {
+                quota_id: operation["limit"] for i, quota_id, operation in to_update.values()
+            }
+            new_usage = {
+                quota_id: operation["usage"]
+                for i, quota_id, operation in to_update.values()
+                if operation["usage"] is not None
+            }
+            new_values = {"limit": case(new_limits, value=quotas.c.id, else_=quotas.c.limit)}
+            if new_usage:
+                new_values["usage"] = case(new_usage, value=quotas.c.id, else_=quotas.c.usage)
+            ins = quotas.update().where(quotas.c.id.in_(new_limits)).values(**new_values)
+            await database.execute(ins)
+            # as in update_quota(), a new usage value replaces any debits not yet compacted
+            if new_usage:
+                ins = (
+                    quota_ledger.update()
+                    .where(
+                        quota_ledger.c.quota_id.in_(new_usage), quota_ledger.c.compacted == False
+                    )
+                    .values(compacted=True)
+                )
+                await database.execute(ins)
+            for i, quota_id, operation in to_update.values():
+                results[i] = {"status": "updated"}
+                quota_ids[i] = quota_id
+        if to_create:
+            ins = (
+                quotas.insert()
+                .values(
+                    [
+                        {
+                            "project_id": operation["project_id"],
+                            "platform": operation["platform"],
+                            "units": operation["units"],
+                            "limit": operation["limit"],
+                            "usage": operation["usage"] or 0.0,
+                        }
+                        for i, operation in to_create.values()
+                    ]
+                )
+                .returning(quotas.c.id, quotas.c.project_id, quotas.c.platform)
+            )
+            for row in await database.fetch_all(ins):
+                i, operation = to_create[(str(row["project_id"]), row["platform"])]
+                results[i] = {"status": "created"}
+                quota_ids[i] = row["id"]
+
+        if quota_ids:
+            query = select_quotas().where(quotas.c.id.in_(quota_ids.values()))
+            new_quotas = {row["id"]: dict(row) for row in await database.fetch_all(query)}
+            for i, quota_id in quota_ids.items():
+                results[i]["quota"] = new_quotas[quota_id]
+    if quota_ids:
+        invalidate_quota_cache()
+    return results
+
+
+def allocate_usage(available_quotas, usage):
+    """
+    Spread `usage` over the given quotas, in order, filling each quota before moving on to the next.
+
+    Returns a dict mapping quota id to new usage value, for those quotas that have changed.
+    """
+    new_usage = {}
+    for quota in available_quotas:
+        remaining = quota["limit"] - quota["usage"]
+        if remaining > 0:
+            if usage <= remaining:
+                new_usage[quota["id"]] = quota["usage"] + usage
+                break
+            else:
+                new_usage[quota["id"]] = quota["limit"]
+                usage -= remaining
+    return new_usage
+
+
+def select_quotas():
+    """
+    Select from the quotas table, with exact usage:
+    the compacted usage plus any ledger entries not yet folded into it,
+    and with the total amount reserved by queued jobs.
+    """
+    uncompacted = (
+        slct(func.coalesce(func.sum(quota_ledger.c.amount), 0.0))
+        .where(quota_ledger.c.quota_id == quotas.c.id, quota_ledger.c.compacted == False)
+        .scalar_subquery()
+    )
+    reserved = (
+        slct(func.coalesce(func.sum(quota_reservations.c.amount), 0.0))
+        .where(quota_reservations.c.quota_id == quotas.c.id)
+        .scalar_subquery()
+    )
+    columns = [
+        (quotas.c.usage + uncompacted).label("usage") if column.name == "usage" else column
+        for column in quotas.c
+    ]
+    return slct(*columns, reserved.label("reserved"))
+
+
+def _available_quotas_query(collab: str, platform: str):
+    return (
+        select_quotas()
+        .where(
+            quotas.c.project_id == projects.c.context,
+            projects.c.collab == collab,
+            projects.c.accepted == True,
+            quotas.c.platform == platform,
+        )
+        .order_by(quotas.c.id)
+    )
+
+
+async def query_available_quotas(collab: str, platform: str):
+    """Return the quotas for the given platform from all accepted projects in the given collab"""
+    results = await database.fetch_all(_available_quotas_query(collab, platform))
+    return [dict(result) for result in results]
+
+
+# cache of available quotas, keyed by (collab, platform). Job submission does not use it,
+# since `reserve_quotas()` must read the quotas under a lock; it serves the checks made
+# before creating a demo quota and before starting a session, which tolerate a stale value.
+# Entries are removed whenever a project or quota changes; the time-to-live
+# limits how long changes made by other server processes can go unnoticed.
+_available_quotas_cache = {}
+# incremented by every invalidation, so that a query which started before
+# an invalidation does not store its (possibly stale) result
+_quota_cache_generation = 0
+
+
+def invalidate_quota_cache(collab: str = None, platform: str = None):
+    global _quota_cache_generation
+    _quota_cache_generation += 1
+    if collab and platform:
+        _available_quotas_cache.pop((collab, platform), None)
+    else:
+        _available_quotas_cache.clear()
+
+
+def _store_available_quotas(key, available_quotas):
+    now = time.monotonic()
+    if len(_available_quotas_cache) >= settings.QUOTA_CACHE_MAX_ENTRIES:
+        for other_key, (expires, _) in list(_available_quotas_cache.items()):
+            if expires < now:
+                del _available_quotas_cache[other_key]
+        while len(_available_quotas_cache) >= settings.QUOTA_CACHE_MAX_ENTRIES:
+            # entries are kept in insertion order, so this removes the oldest
+            del _available_quotas_cache[next(iter(_available_quotas_cache))]
+    _available_quotas_cache[key] = (now + settings.QUOTA_CACHE_TTL, available_quotas)
+
+
+async def get_available_quotas(collab: str, platform: str):
+    """
+    Cached version of `query_available_quotas()`, for checks that can tolerate stale data.
+
+    Not suitable for admission control: use `reserve_quotas()` or `submit_job()` instead.
+    """
+    key = (collab, platform)
+    cached = _available_quotas_cache.get(key)
+    if cached is not None and cached[0] >= time.monotonic():
+        available_quotas = cached[1]
+    else:
+        generation = _quota_cache_generation
+        available_quotas = await query_available_quotas(collab, platform)
+        if generation == _quota_cache_generation:
+            # re-inserting moves the key to the end of the eviction order
+            _available_quotas_cache.pop(key, None)
+            _store_available_quotas(key, available_quotas)
+    return [dict(quota) for quota in available_quotas]
+
+
+class QuotaExceeded(Exception):
+    """Raised when a collab has no quota left for a platform"""
+
+
+async def reserve_quotas(job_id: int, collab: str, platform: str, amount: float):
+    """
+    Reserve `amount` from the accepted quotas for the given collab and platform,
+    to be settled against actual usage when the job completes.
+
+    If less than `amount` remains available, only the remainder is reserved.
+    If nothing remains available (counting existing reservations as used),
+    raises QuotaExceeded without reserving anything.
+    Returns a dict mapping quota id to the amount reserved from that quota.
+    """
+    async with database.transaction():
+        available_quotas = await _lock_available_quotas(collab, platform)
+        if not any(
+            quota["usage"] + quota["reserved"] < quota["limit"] for quota in available_quotas
+        ):
+            raise QuotaExceeded(f"No quota available for collab {collab} on {platform}")
+        if amount <= 0:
+            return {}
+        # treat reserved amounts as already used
+        committed = {quota["id"]: quota["usage"] + quota["reserved"] for quota in available_quotas}
+        new_committed = allocate_usage(
+            [dict(quota, usage=committed[quota["id"]]) for quota in available_quotas], amount
+        )
+        reservations = {
+            quota_id: value - committed[quota_id] for quota_id, value in new_committed.items()
+        }
+        for quota_id, reserved in reservations.items():
+            ins = quota_reservations.insert().values(
+                job_id=job_id, quota_id=quota_id, amount=reserved
+            )
+            await database.execute(ins)
+    invalidate_quota_cache(collab, platform)
+    return reservations
+
+
+async def submit_job(user_id: str, job: dict, amount: float):
+    """
+    Create a job, and reserve `amount` from the quotas of its collab for its platform,
+    in a single transaction, so that concurrent submissions are checked against
+    each other's reservations.
+
+    Raises QuotaExceeded, without creating the job, if there is no quota available.
+    """
+    async with database.transaction():
+        accepted_job = await create_job(user_id=user_id, job=job)
+        await reserve_quotas(
+            accepted_job["id"], job["collab_id"], job["hardware_platform"], amount
+        )
+    # the reservation is only visible to other requests once committed
+    invalidate_quota_cache(job["collab_id"], job["hardware_platform"])
+    return accepted_job
+
+
+async def _lock_available_quotas(collab: str, platform: str):
+    """
+    Lock the available quotas, in order of id, until the end of the current transaction,
+    then return them with their exact usage.
+
+    The lock (FOR NO KEY UPDATE) serializes reservations, but does not block debits,
+    which only add rows referencing the quotas.
+    """
+    query = (
+        slct(quotas.c.id)
+        .where(
+            quotas.c.project_id == projects.c.context,
+            projects.c.collab == collab,
+            projects.c.accepted == True,
+            quotas.c.platform == platform,
+        )
+        .order_by(quotas.c.id)
+        .with_for_update(of=quotas, key_share=True)
+    )
+    await database.fetch_all(query)
+    # usage is read in a separate statement, so that it includes
+    # any compaction committed while we were waiting for the lock
+    results = await database.fetch_all(_available_quotas_query(collab, platform))
+    return [dict(result) for result in results]
+
+
+async def _release_reservations(job_id: int):
+    ins = (
+        quota_reservations.delete()
+        .where(quota_reservations.c.job_id == job_id)
+        .returning(quota_reservations.c.quota_id, quota_reservations.c.amount)
+    )
+    return await database.fetch_all(ins)
+
+
+async def release_reservations(job_id: int):
+    """Release any quota reserved for the given job"""
+    async with database.transaction():
+        reservations = await _release_reservations(job_id)
+    if reservations:
+        invalidate_quota_cache()
+
+
+async def debit_quotas(
+    collab: str, platform: str, usage: float, job_id: int = None, session_id: int = None
+):
+    """
+    Add `usage` to the accepted quotas for the given collab and platform.
+
+    Each debit is recorded as an entry in the quota ledger,
+    to be folded into the usage column later by `compact_quota_ledger()`.
+    If `job_id` is given, any quota reserved for that job is released in the same transaction.
+
+    The quota rows are not locked, so concurrent debits do not wait for each other.
+    Debits that run at the same time may each fill the same quota, taking it over its limit;
+    this is corrected when the ledger is compacted.
+    """
+    timestamp = now_in_utc()
+    async with database.transaction():
+        available_quotas = await query_available_quotas(collab, platform)
+        if job_id is not None:
+            await _release_reservations(job_id)
+        new_usage = allocate_usage(available_quotas, usage)
+        old_usage = {quota["id"]: quota["usage"] for quota in available_quotas}
+        for quota_id, value in new_usage.items():
+            ins = quota_ledger.insert().values(
+                quota_id=quota_id,
+                job_id=job_id,
+                session_id=session_id,
+                platform=platform,
+                amount=value - old_usage[quota_id],
+                timestamp=timestamp,
+            )
+            await database.execute(ins)
+    invalidate_quota_cache(collab, platform)
+    return new_usage
+
+
+async def compact_quota_ledger():
+    """
+    Fold all uncompacted ledger entries into the usage column of their quotas.
+
+    Ledger entries are kept, marked as compacted, as an audit trail.
+    Usage over the limit of a quota, from concurrent debits, is then moved to the next quotas
+    (in order of id) for the same collab and platform, as `allocate_usage()` would have done.
+    Returns the number of entries compacted.
+    """
+    async with database.transaction():
+        query = (
+            quota_ledger.update()
+            .where(quota_ledger.c.compacted == False)
+            .values(compacted=True)
+            .returning(quota_ledger.c.quota_id, quota_ledger.c.amount)
+        )
+        entries = await database.fetch_all(query)
+        totals = {}
+        for entry in entries:
+            totals[entry["quota_id"]] = totals.get(entry["quota_id"], 0.0) + entry["amount"]
+        for quota_id in sorted(totals):
+            ins = (
+                quotas.update()
+                .where(quotas.c.id == quota_id)
+                .values(usage=quotas.c.usage + totals[quota_id])
+            )
+            await database.execute(ins)
+        over_limit = set()
+        if totals:
+            query = slct(projects.c.collab, quotas.c.platform).where(
+                quotas.c.project_id == projects.c.context,
+                projects.c.accepted == True,
+                quotas.c.id.in_(totals),
+                quotas.c.usage > quotas.c.limit,
+            )
+            over_limit = {
+                (row["collab"], row["platform"]) for row in await database.fetch_all(query)
+            }
+            for collab, platform in sorted(over_limit):
+                await _rebalance_quotas(collab, platform)
+    if over_limit:
+        invalidate_quota_cache()
+    return len(entries)
+
+
+async def _rebalance_quotas(collab: str, platform: str):
+    """
+    Move usage over the limit of any quota for the given collab and platform
+    to the quotas with remaining capacity, recording the corrections in the ledger.
+    """
+    query = (
+        slct(quotas.c.id, quotas.c.usage, quotas.c.limit)
+        .where(
+            quotas.c.project_id == projects.c.context,
+            projects.c.collab == collab,
+            projects.c.accepted == True,
+            quotas.c.platform == platform,
+        )
+        .order_by(quotas.c.id)
+    )
+    available_quotas = [dict(row) for row in await database.fetch_all(query)]
+    excess = sum(max(quota["usage"] - quota["limit"], 0.0) for quota in available_quotas)
+    capped = [dict(quota, usage=min(quota["usage"], quota["limit"])) for quota in available_quotas]
+    new_usage = {quota["id"]: quota["usage"] for quota in capped}
+    new_usage.update(allocate_usage(capped, excess))
+    timestamp = now_in_utc()
+    for quota in available_quotas:
+        correction = new_usage[quota["id"]] - quota["usage"]
+        if correction != 0.0:
+            ins = (
+                quotas.update()
+                .where(quotas.c.id == quota["id"])
+                .values(usage=new_usage[quota["id"]])
+            )
+            await database.execute(ins)
+            ins = quota_ledger.insert().values(
+                quota_id=quota["id"],
+                platform=platform,
+                amount=correction,
+                timestamp=timestamp,
+                compacted=True,
+            )
+            await database.execute(ins)
+
+
+async def get_quota_ledger(quota_id: int):
+    query = (
+        quota_ledger.select()
+        .where(quota_ledger.c.quota_id == quota_id)
+        .order_by(quota_ledger.c.id)
+    )
+    results = await database.fetch_all(query)
+    return [dict(result) for result in results]
@@ -27,4 +27,16 @@ DEMO_QUOTA_SIZES = {
     "Demo": 1.0,
 }
 
+# amount of quota reserved when a job is submitted, if the user does not provide an estimate.
+# The reservation is settled against the actual resource usage when the job completes.
+DEFAULT_RESOURCE_USAGE_ESTIMATES = {
+    "BrainScaleS": 0.01,
+    "BrainScaleS-2": 0.01,
+    "SpiNNaker": 10.0,
+    "Spikey": 0.01,
+    "Demo": 0.01,
+    "TestPlatform": 1.0,
+    "Test": 1.0,
+}
+
 PRIVATE_SPACE = "private"
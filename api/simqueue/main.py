@@ -1,5 +1,6 @@
+import asyncio
 import os
-from contextlib import asynccontextmanager
+from contextlib import asynccontextmanager, suppress
 from fastapi import FastAPI, Request
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
@@ -7,8 +8,10 @@ from starlette.middleware.sessions import SessionMiddleware
 from starlette.middleware.cors import CORSMiddleware
 
 from . import settings
+from .compression import CompressionMiddleware
 from .resources import for_users, for_providers, for_admins, statistics, auth
-from .db import database
+from .db import database, DatabaseBusy
+from .utils import compact_quota_ledger_periodically
 
 
 description = """
@@ -46,8 +49,15 @@ under Specific Grant Agreements No. 720270, No. 785907 and No. 945539
 async def lifespan(app: FastAPI):
     # Before the application starts, connect to the database
     await database.connect()
+    compactor = asyncio.create_task(
+        compact_quota_ledger_periodically(settings.QUOTA_LEDGER_COMPACTION_INTERVAL)
+    )
     yield
-    # When the application shuts down, disconnect from the database
+    # When the application shuts down, stop background tasks and disconnect from the database
+    compactor.cancel()
+    # a compaction in progress is rolled back before we disconnect
+    with suppress(asyncio.CancelledError):
+        await compactor
     await database.disconnect()
 
 
@@ -72,6 +82,11 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],
 )
+app.add_middleware(
+    CompressionMiddleware,
+    levels=settings.COMPRESSION_LEVELS,
+    minimum_size=settings.COMPRESSION_MINIMUM_SIZE,
+)
 
 
 @app.middleware("http")
@@ -88,9 +103,19 @@ async def check_service_status(request: Request, call_next):
     return response
 
 
+@app.exception_handler(DatabaseBusy)
+async def database_busy(request: Request, exc: DatabaseBusy):
+    return JSONResponse(
+        status_code=503,
+        content={"error": "The service is busy, please try again later"},
+        headers={"Retry-After": "5"},
+    )
+
+
+# the admin router comes first, so that "/jobs/export" is not taken for "/jobs/{job_id}"
+app.include_router(for_admins.router, tags=["For use by administrators"])
 app.include_router(for_users.router, tags=["For all users"])
 app.include_router(for_providers.router, tags=["For use by computing system providers"])
-app.include_router(for_admins.router, tags=["For use by administrators"])
 app.include_router(statistics.router, tags=["Statistics"])
 app.include_router(auth.router, tags=["Authentication and authorization"])
 
@@ -0,0 +1,99 @@
+"""
+Versioned migrations of the database schema.
+
+Each migration is a file of SQL statements in the "migrations" directory,
+named "<version>_<description>.sql". Migrations are applied in order of version,
+each in its own transaction, and the versions applied are recorded in the
+"schema_migrations" table. Migrations should be written so they can be re-applied
+safely (e.g. "CREATE INDEX IF NOT EXISTS"), since some were first applied by hand.
+
+To apply any pending migrations, run from the "api" directory:
+
+    python -m simqueue.migrate
+
+A database created directly from the table definitions in db.py (e.g. by setup_test_db.py)
+already has the latest schema, and should instead be marked as up-to-date with:
+
+    python -m simqueue.migrate --stamp
+
+"""
+
+import argparse
+import asyncio
+import os
+import re
+
+import sqlalchemy
+from sqlalchemy.dialects import postgresql
+
+from . import db
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(__file__), "migrations")
+
+
+def list_migrations(directory=MIGRATIONS_DIR):
+    """Return a list of (version, path) for all migrations, in order of version"""
+    migrations = []
+    for filename in os.listdir(directory):
+        match = re.match(r"(\d+)_\w+\.sql$", filename)
+        if match:
+            migrations.append((match.group(1), os.path.join(directory, filename)))
+    return sorted(migrations)
+
+
+async def _applied_versions(database):
+    create = sqlalchemy.schema.CreateTable(db.schema_migrations, if_not_exists=True)
+    await database.execute(str(create.compile(dialect=postgresql.dialect())))
+    results = await database.fetch_all(sqlalchemy.select(db.schema_migrations.c.version))
+    return {row["version"] for row in results}
+
+
+async def _record(database, version):
+    ins = db.schema_migrations.insert().values(version=version, applied=db.now_in_utc())
+    await database.execute(ins)
+
+
+async def migrate(database=db.database, directory=MIGRATIONS_DIR):
+    """Apply all migrations not yet applied, returning the list of versions applied"""
+    applied = await _applied_versions(database)
+    newly_applied = []
+    for version, path in list_migrations(directory):
+        if version in applied:
+            continue
+        with open(path) as fp:
+            statements = fp.read()
+        async with database.connection() as connection:
+            async with connection.transaction():
+                # the raw connection is used since the file may contain several statements
+                await connection.raw_connection.execute(statements)
+                await _record(connection, version)
+        newly_applied.append(version)
+    return newly_applied
+
+
+async def stamp(database=db.database, directory=MIGRATIONS_DIR):
+    """Record all migrations as applied, without running them"""
+    applied = await _applied_versions(database)
+    for version, path in list_migrations(directory):
+        if version not in applied:
+            await _record(database, version)
+
+
+async def main(args):
+    await db.database.connect()
+    try:
+        if args.stamp:
+            await stamp()
+        else:
+            versions = await migrate()
+            print(f"Applied migrations: {', '.join(versions) or 'none'}")
+    finally:
+        await db.database.disconnect()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Apply migrations of the database schema")
+    parser.add_argument(
+        "--stamp", action="store_true", help="mark all migrations as applied, without running them"
+    )
+    asyncio.run(main(parser.parse_args()))
@@ -0,0 +1,9 @@
+-- Quota is reserved when a job is submitted, and settled when it completes
+ALTER TABLE quotas_quota ADD COLUMN IF NOT EXISTS reserved double precision NOT NULL DEFAULT 0;
+CREATE TABLE IF NOT EXISTS quotas_reservation(
+    id integer PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    job_id integer NOT NULL REFERENCES simqueue_job(id),
+    quota_id integer NOT NULL REFERENCES quotas_quota(id),
+    amount double precision NOT NULL
+);
+CREATE INDEX IF NOT EXISTS ix_quotas_reservation_job_id ON quotas_reservation (job_id);
@@ -0,0 +1,13 @@
+-- Quota debits are appended to a ledger, and periodically folded into quotas_quota.usage
+CREATE TABLE IF NOT EXISTS quotas_ledger(
+    id integer PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    quota_id integer NOT NULL REFERENCES quotas_quota(id),
+    job_id integer,
+    session_id integer,
+    platform varchar(20) NOT NULL,
+    amount double precision NOT NULL,
+    timestamp timestamp with time zone NOT NULL,
+    compacted boolean NOT NULL DEFAULT false
+);
+CREATE INDEX IF NOT EXISTS ix_quotas_ledger_uncompacted ON quotas_ledger (quota_id)
+    WHERE NOT compacted;
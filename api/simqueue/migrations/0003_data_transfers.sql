@@ -0,0 +1,14 @@
+-- Transfers of job output data to another repository, run in the background
+CREATE TABLE IF NOT EXISTS simqueue_datatransfer(
+    id integer PRIMARY KEY GENERATED ALWAYS AS IDENTITY,
+    job_id integer NOT NULL REFERENCES simqueue_job(id),
+    user_id character varying(36) NOT NULL,
+    repository character varying(100) NOT NULL,
+    status character varying(15) NOT NULL,
+    n_files integer NOT NULL,
+    n_copied integer NOT NULL DEFAULT 0,
+    error text,
+    timestamp_start timestamp with time zone NOT NULL,
+    timestamp_end timestamp with time zone
+);
+CREATE INDEX IF NOT EXISTS ix_simqueue_datatransfer_job_id ON simqueue_datatransfer (job_id);
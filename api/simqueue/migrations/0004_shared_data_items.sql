@@ -0,0 +1,32 @@
+-- Data items are shared between jobs: there is a single row for each file (url + hash).
+-- Existing duplicates are merged into the oldest row before adding the unique index.
+CREATE TEMPORARY TABLE dataitem_duplicates ON COMMIT DROP AS
+    SELECT id, min(id) OVER (PARTITION BY url, hash) AS keep_id
+    FROM simqueue_dataitem
+    WHERE url IS NOT NULL AND hash IS NOT NULL;
+DELETE FROM dataitem_duplicates WHERE id = keep_id;
+
+INSERT INTO simqueue_job_input_data (job_id, dataitem_id)
+    SELECT link.job_id, duplicate.keep_id
+    FROM simqueue_job_input_data link JOIN dataitem_duplicates duplicate
+        ON link.dataitem_id = duplicate.id
+    ON CONFLICT DO NOTHING;
+DELETE FROM simqueue_job_input_data link USING dataitem_duplicates duplicate
+    WHERE link.dataitem_id = duplicate.id;
+
+INSERT INTO simqueue_job_output_data (job_id, dataitem_id)
+    SELECT link.job_id, duplicate.keep_id
+    FROM simqueue_job_output_data link JOIN dataitem_duplicates duplicate
+        ON link.dataitem_id = duplicate.id
+    ON CONFLICT DO NOTHING;
+DELETE FROM simqueue_job_output_data link USING dataitem_duplicates duplicate
+    WHERE link.dataitem_id = duplicate.id;
+
+DELETE FROM simqueue_dataitem item USING dataitem_duplicates duplicate
+    WHERE item.id = duplicate.id;
+
+CREATE UNIQUE INDEX IF NOT EXISTS ix_simqueue_dataitem_url_hash ON simqueue_dataitem (url, hash);
+CREATE INDEX IF NOT EXISTS ix_simqueue_job_input_data_dataitem_id
+    ON simqueue_job_input_data (dataitem_id);
+CREATE INDEX IF NOT EXISTS ix_simqueue_job_output_data_dataitem_id
+    ON simqueue_job_output_data (dataitem_id);
@@ -0,0 +1,10 @@
+-- Store job and session configuration and provenance as jsonb, with indexes for containment (@>)
+ALTER TABLE simqueue_job
+    ALTER COLUMN hardware_config TYPE jsonb USING NULLIF(hardware_config::text, '')::jsonb,
+    ALTER COLUMN provenance TYPE jsonb USING NULLIF(provenance::text, '')::jsonb;
+ALTER TABLE simqueue_session
+    ALTER COLUMN hardware_config TYPE jsonb USING NULLIF(hardware_config::text, '')::jsonb;
+CREATE INDEX IF NOT EXISTS ix_simqueue_job_hardware_config ON simqueue_job
+    USING gin (hardware_config jsonb_path_ops);
+CREATE INDEX IF NOT EXISTS ix_simqueue_job_provenance ON simqueue_job
+    USING gin (provenance jsonb_path_ops);
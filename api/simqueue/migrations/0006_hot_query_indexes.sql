@@ -0,0 +1,13 @@
+-- The queue of submitted jobs for each platform, see db.get_next_job()
+CREATE INDEX IF NOT EXISTS ix_simqueue_job_submitted
+    ON simqueue_job (hardware_platform, timestamp_submission) WHERE status = 'submitted';
+-- Jobs of a given user or collab, most recent first, see db.query_jobs()
+CREATE INDEX IF NOT EXISTS ix_simqueue_job_user_id_id ON simqueue_job (user_id, id);
+CREATE INDEX IF NOT EXISTS ix_simqueue_job_collab_id_id ON simqueue_job (collab_id, id);
+-- Tags of a job, and jobs with a given tag
+CREATE INDEX IF NOT EXISTS ix_taggit_taggeditem_object_id ON taggit_taggeditem (object_id);
+CREATE INDEX IF NOT EXISTS ix_taggit_taggeditem_tag_id ON taggit_taggeditem (tag_id);
+CREATE INDEX IF NOT EXISTS ix_taggit_tag_name ON taggit_tag (name);
+-- Quotas of a project, and projects of a collab
+CREATE INDEX IF NOT EXISTS ix_quotas_quota_project_id ON quotas_quota (project_id);
+CREATE INDEX IF NOT EXISTS ix_quotas_project_collab ON quotas_project (collab);
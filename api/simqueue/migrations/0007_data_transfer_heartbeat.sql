@@ -0,0 +1,14 @@
+-- Detection of interrupted transfers, see db.expire_stale_data_transfers()
+ALTER TABLE simqueue_datatransfer ADD COLUMN IF NOT EXISTS timestamp_update timestamp with time zone;
+UPDATE simqueue_datatransfer SET timestamp_update = coalesce(timestamp_end, timestamp_start)
+    WHERE timestamp_update IS NULL;
+ALTER TABLE simqueue_datatransfer ALTER COLUMN timestamp_update SET NOT NULL;
+-- At most one active transfer per job: earlier duplicates can only be left over from
+-- interrupted transfers, so all but the most recent are marked as failed
+UPDATE simqueue_datatransfer SET status = 'error', error = 'The transfer was interrupted, please try again',
+        timestamp_end = now()
+    WHERE status IN ('queued', 'running') AND id NOT IN (
+        SELECT max(id) FROM simqueue_datatransfer WHERE status IN ('queued', 'running') GROUP BY job_id
+    );
+CREATE UNIQUE INDEX IF NOT EXISTS ix_simqueue_datatransfer_active
+    ON simqueue_datatransfer (job_id) WHERE status IN ('queued', 'running');
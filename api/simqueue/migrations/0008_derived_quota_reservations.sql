@@ -0,0 +1,4 @@
+-- The amount reserved from each quota is now summed from quotas_reservation when read,
+-- so that releasing a reservation does not need to lock the quota row
+CREATE INDEX IF NOT EXISTS ix_quotas_reservation_quota_id ON quotas_reservation (quota_id);
+ALTER TABLE quotas_quota DROP COLUMN IF EXISTS reserved;
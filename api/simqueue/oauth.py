@@ -1,8 +1,10 @@
+import asyncio
 import logging
-import requests
+from types import MappingProxyType
 from authlib.integrations.starlette_client import OAuth
 import httpx
 from httpx import Timeout
+from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi.security.api_key import APIKeyHeader
 from fastapi import Security, HTTPException, status as status_codes
 
@@ -28,20 +30,53 @@ oauth.register(
 )
 
 
-async def get_collab_info(collab, token):
+async def get_collab_info(collab, token, client=None):
     collab_info_url = f"{settings.EBRAINS_COLLAB_SERVICE_URL}collabs/{collab}"
     headers = {"Authorization": f"Bearer {token}"}
-    res = requests.get(collab_info_url, headers=headers)
+    if client is None:
+        async with httpx.AsyncClient(timeout=settings.AUTHENTICATION_TIMEOUT) as client:
+            res = await client.get(collab_info_url, headers=headers)
+    else:
+        res = await client.get(collab_info_url, headers=headers)
     response = res.json()
     if isinstance(response, dict) and "code" in response and response["code"] == 404:
         raise ValueError("Invalid collab id")
     return response
 
 
+VIEW_ROLES = frozenset(("viewer", "editor", "administrator"))
+EDIT_ROLES = frozenset(("editor", "administrator"))
+NO_ROLES = frozenset()
+
+
+def build_collab_role_index(team_roles, username):
+    """
+    Build a read-only mapping from collab name to the set of roles the user has in that collab,
+    from the team roles (e.g. "collab-my-collab-editor") in the user info.
+    """
+    index = {}
+    for team_access in team_roles:
+        # note, if team information is missing from userinfo that means
+        # the user is not a member of any collab
+        prefix, _, rest = team_access.partition("-")
+        collab, _, role = rest.rpartition("-")
+        if prefix != "collab" or not collab:
+            continue
+        index.setdefault(collab, set()).add(role)
+    # users always have full access to their private space
+    index[f"{PRIVATE_SPACE}-{username}"] = set(VIEW_ROLES)
+    return MappingProxyType({collab: frozenset(roles) for collab, roles in index.items()})
+
+
 class User:
-    def __init__(self, **kwargs):
-        for key, value in kwargs.items():
-            setattr(self, key, value)
+    __slots__ = ("username", "token", "_collab_roles", "_public_collabs")
+
+    def __init__(self, preferred_username, roles=None, token=None, **other_user_info):
+        self.username = preferred_username
+        self.token = token
+        self._collab_roles = build_collab_role_index((roles or {}).get("team", []), self.username)
+        # results of public-collab lookups, so that each collab is checked at most once
+        self._public_collabs = {}
 
     @classmethod
     async def from_token(cls, token):
@@ -71,50 +106,63 @@ class User:
     def is_admin(self):
         return self.can_edit("neuromorphic-platform-admin")
 
-    @property
-    def username(self):
-        return self.preferred_username
+    def _has_team_role(self, collab, roles):
+        return not self._collab_roles.get(collab, NO_ROLES).isdisjoint(roles)
 
     async def can_view(self, collab):
-        if collab == f"{PRIVATE_SPACE}-{self.username}":
-            return True
-        # first of all, check team permissions
-        target_team_names = {
-            role: f"collab-{collab}-{role}" for role in ("viewer", "editor", "administrator")
-        }
-        for role, team_name in target_team_names.items():
-            if team_name in self.roles.get("team", []):
-                return True
-        # if that fails, check if it's a public collab
-        try:
-            collab_info = await get_collab_info(collab, self.token["access_token"])
-        except ValueError:
-            return False
-        else:
-            return collab_info.get("isPublic", False)
+        access = await self.can_view_many([collab])
+        return access[collab]
+
+    async def can_view_many(self, collabs):
+        """
+        Check whether the user can view each of the given collabs.
+
+        Team memberships are checked locally first; any remaining collabs are
+        looked up concurrently in the Collaboratory to see if they are public.
+        Returns a dict mapping each distinct collab to True or False.
+        """
+        access = {}
+        to_look_up = []
+        for collab in collabs:
+            if collab in access:
+                continue
+            if self._has_team_role(collab, VIEW_ROLES):
+                access[collab] = True
+            elif collab in self._public_collabs:
+                access[collab] = self._public_collabs[collab]
+            else:
+                access[collab] = False
+                to_look_up.append(collab)
+
+        if to_look_up:
+            semaphore = asyncio.Semaphore(settings.COLLAB_LOOKUP_CONCURRENCY)
+
+            async def is_public(collab, client):
+                async with semaphore:
+                    try:
+                        collab_info = await get_collab_info(
+                            collab, self.token["access_token"], client=client
+                        )
+                    except ValueError:
+                        return False
+                return collab_info.get("isPublic", False)
+
+            async with httpx.AsyncClient(timeout=settings.AUTHENTICATION_TIMEOUT) as client:
+                results = await asyncio.gather(
+                    *(is_public(collab, client) for collab in to_look_up)
+                )
+            for collab, is_public_collab in zip(to_look_up, results):
+                self._public_collabs[collab] = is_public_collab
+                access[collab] = is_public_collab
+        return access
 
     def can_edit(self, collab):
-        if collab == f"{PRIVATE_SPACE}-{self.username}":
-            return True
-        target_team_names = {
-            role: f"collab-{collab}-{role}" for role in ("editor", "administrator")
-        }
-        for role, team_name in target_team_names.items():
-            if team_name in self.roles.get("team", []):
-                return True
-
-    def get_collabs(self, access=["viewer", "editor", "administrator"]):
-        collabs = set([f"{PRIVATE_SPACE}-{self.username}"])
-        for team_access in self.roles.get("team", []):
-            # note, if team information is missing from userinfo that means
-            # the user is not a member of any collab
-            parts = team_access.split("-")
-            assert parts[0] == "collab"
-            collab = "-".join(parts[1:-1])
-            role = parts[-1]
-            if role in access:
-                collabs.add(collab)
-        return sorted(collabs)
+        return self._has_team_role(collab, EDIT_ROLES)
+
+    def get_collabs(self, access=VIEW_ROLES):
+        return sorted(
+            collab for collab, roles in self._collab_roles.items() if not roles.isdisjoint(access)
+        )
 
 
 api_key_header_optional = APIKeyHeader(name="x-api-key", auto_error=False)
@@ -140,3 +188,96 @@ async def get_provider_optional(api_key: str = Security(api_key_header_optional)
         return await _get_provider(api_key)
     else:
         return None
+
+
+bearer_auth = HTTPBearer()
+bearer_auth_optional = HTTPBearer(auto_error=False)
+
+
+class RequestContext:
+    """
+    Resolves the principal making a request (an EBRAINS user or a computing system provider)
+    once per request, and memoises the job and project look-ups made while handling it.
+
+    Look-ups are started as tasks, so that authentication and the main database query
+    can run concurrently, e.g.:
+
+        user, job = await context.authenticate(context.get_job(job_id))
+    """
+
+    def __init__(self, token: HTTPAuthorizationCredentials = None, api_key: str = None):
+        self.token = token
+        self.api_key = api_key
+        self.user = None
+        self.provider_name = None
+        self._lookups = {}
+
+    def _lookup(self, key, func, *args, **kwargs):
+        if key not in self._lookups:
+            self._lookups[key] = asyncio.ensure_future(func(*args, **kwargs))
+        return self._lookups[key]
+
+    async def _get_user(self):
+        self.user = await User.from_token(self.token.credentials)
+        return self.user
+
+    async def _get_provider(self):
+        provider_name = await db.get_provider(self.api_key)
+        if not provider_name:
+            raise HTTPException(
+                status_code=status_codes.HTTP_403_FORBIDDEN, detail="Could not validate API key"
+            )
+        self.provider_name = provider_name
+        return provider_name
+
+    def get_user(self):
+        return self._lookup("user", self._get_user)
+
+    def get_provider(self):
+        return self._lookup("provider", self._get_provider)
+
+    def get_job(self, job_id: int, output_data: bool = True):
+        return self._lookup(
+            ("job", job_id, output_data), db.get_job, job_id, output_data=output_data
+        )
+
+    def get_project(self, project_id):
+        return self._lookup(("project", str(project_id)), db.get_project, project_id)
+
+    async def authenticate(self, *lookups):
+        """
+        Resolve the principal, concurrently with any other awaitables given as arguments.
+
+        Returns a list containing the User object (or the provider name, if authenticated
+        with an API key) followed by the results of `lookups`.
+        If authentication fails, the other look-ups are cancelled.
+        """
+        lookups = [asyncio.ensure_future(lookup) for lookup in lookups]
+        try:
+            if self.token:
+                principal = self.get_user()
+            elif self.api_key:
+                principal = self.get_provider()
+            else:
+                raise HTTPException(
+                    status_code=status_codes.HTTP_401_UNAUTHORIZED,
+                    detail="You must provide either a token or an API key",
+                )
+            return await asyncio.gather(principal, *lookups)
+        except BaseException:
+            for lookup in lookups:
+                lookup.cancel()
+            # wait for the look-ups to stop, retrieving their exceptions so they are not logged
+            await asyncio.gather(*lookups, return_exceptions=True)
+            raise
+
+
+async def get_user_context(token: HTTPAuthorizationCredentials = Security(bearer_auth)):
+    return RequestContext(token=token)
+
+
+async def get_request_context(
+    token: HTTPAuthorizationCredentials = Security(bearer_auth_optional),
+    api_key: str = Security(api_key_header_optional),
+):
+    return RequestContext(token=token, api_key=api_key)
@@ -1,37 +1,165 @@
 from uuid import UUID
+from typing import List
+from datetime import date
+import csv
+import io
+import json
 import logging
-import asyncio
 
-from fastapi import APIRouter, Depends, Query, Path, HTTPException, status as status_codes
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
+from fastapi import (
+    APIRouter,
+    Depends,
+    Query,
+    Path,
+    HTTPException,
+    Request,
+    status as status_codes,
+)
+from fastapi.responses import StreamingResponse
 
 
-from ..data_models import QuotaSubmission
-from .. import db, oauth
+from ..data_models import (
+    DatabasePoolStatus,
+    QuotaSubmission,
+    QuotaOperation,
+    QuotaOperationResult,
+    QuotaOperationStatus,
+    Quota,
+    JobStatus,
+    JobRelationship,
+    ExportFormat,
+    SparseJob,
+    Tag,
+)
+from ..globals import RESOURCE_USAGE_UNITS
+from .. import db, oauth, utils
 
 logger = logging.getLogger("simqueue")
 
-auth = HTTPBearer()
 router = APIRouter()
 
 
+# fields of a job that come from the job table itself, rather than from related objects
+EXPORT_FIELDS = [
+    field
+    for field in SparseJob.model_fields
+    if field not in ("input_data", "output_data", "output_data_summary", "tags")
+]
+
+
+@router.get("/jobs/export", response_class=StreamingResponse)
+async def export_jobs(
+    request: Request,
+    status: List[JobStatus] = Query(None, description="status"),
+    tags: List[Tag] = Query(None, description="tags"),
+    collab: List[str] = Query(None, description="collab id"),
+    user_id: List[str] = Query(None, description="user id"),
+    hardware_platform: List[str] = Query(
+        None, description="hardware platform (e.g. SpiNNaker, BrainScales)"
+    ),
+    date_range_start: date = Query(None, description="jobs submitted after this date"),
+    date_range_end: date = Query(None, description="jobs submitted before this date"),
+    expand: List[JobRelationship] = Query(
+        None, description="Related objects to include with each job"
+    ),
+    format: ExportFormat = Query(ExportFormat.ndjson, description="Export format"),
+    # from header
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
+):
+    """
+    Export all jobs matching the filters, in order of job id,
+    as newline-delimited JSON (one job per line) or as CSV.
+
+    The jobs are streamed from the database, so there is no limit on the number of jobs.
+    Jobs can also be filtered on `hardware_config` and `provenance`, as for `GET /jobs/`.
+    In CSV format, structured values (e.g. hardware_config, tags) are given as JSON.
+    """
+    (user,) = await context.authenticate()
+    if not user.is_admin:
+        raise HTTPException(
+            status_code=status_codes.HTTP_403_FORBIDDEN,
+            detail="Only admins can export jobs",
+        )
+    include = [relationship.value for relationship in expand or []]
+    jobs = db.iterate_jobs(
+        include=include,
+        status=status,
+        tags=tags,
+        collab=collab,
+        user_id=user_id,
+        hardware_platform=hardware_platform,
+        date_range_start=date_range_start,
+        date_range_end=date_range_end,
+        **utils.get_json_filters(request.query_params),
+    )
+    fields = EXPORT_FIELDS + include
+    if format == ExportFormat.csv:
+        return StreamingResponse(
+            _export_csv(jobs, fields),
+            media_type="text/csv",
+            headers={"Content-Disposition": 'attachment; filename="jobs.csv"'},
+        )
+    return StreamingResponse(_export_ndjson(jobs, fields), media_type="application/x-ndjson")
+
+
+async def _export_ndjson(jobs, fields):
+    async for job in jobs:
+        yield SparseJob.from_db(job, fields).model_dump_json(exclude_unset=True) + "\n"
+
+
+async def _export_csv(jobs, fields):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def line(values):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(values)
+        return buffer.getvalue()
+
+    yield line(fields)
+    async for job in jobs:
+        data = SparseJob.from_db(job, fields).model_dump(mode="json")
+        yield line(
+            json.dumps(data[field]) if isinstance(data[field], (dict, list)) else data[field]
+            for field in fields
+        )
+
+
+@router.get("/database-pool", response_model=DatabasePoolStatus)
+async def get_database_pool_status(
+    # from header
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
+):
+    """
+    Current size and usage of the pool of database connections.
+
+    Counts and times are totals since the service started:
+    a growing number of timeouts means the pool is saturated.
+    """
+    (user,) = await context.authenticate()
+    if not user.is_admin:
+        raise HTTPException(
+            status_code=status_codes.HTTP_403_FORBIDDEN,
+            detail="Only admins can view the status of the database pool",
+        )
+    return db.database.pool_status()
+
+
 @router.delete("/jobs/{job_id}", status_code=status_codes.HTTP_200_OK)
 async def delete_job(
     job_id: int = Path(..., title="Job ID", description="ID of the job to be deleted"),
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     If called normally this sets the job status to "removed".
     If called by an admin with "?as_admin=true", the job is completely deleted from the database.
     """
 
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -41,9 +169,10 @@ async def delete_job(
         result = await db.delete_job(job_id)
         return result
 
-    access_allowed = job["user_id"] == user.username or await user.can_edit(job["collab_id"])
+    access_allowed = job["user_id"] == user.username or user.can_edit(job["collab_id"])
     if access_allowed:
         result = await db.update_job(job_id, {"status": "removed"})
+        await db.release_reservations(job_id)
         return None
     else:
         raise HTTPException(
@@ -61,12 +190,9 @@ async def create_quota(
         description="ID of the project to which quotas should be added",
     ),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_project_task = asyncio.create_task(db.get_project(project_id))
-    user = await get_user_task
-    project = await get_project_task
+    user, project = await context.authenticate(context.get_project(project_id))
     if project is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -78,3 +204,50 @@ async def create_quota(
             detail="Only admins can add quotas",
         )
     await db.create_quota(str(project_id), quota.to_db())
+
+
+@router.post("/quotas/", response_model=List[QuotaOperationResult])
+async def create_or_update_quotas(
+    operations: List[QuotaOperation],
+    # from header
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
+):
+    """
+    Create or update quotas for many projects at once.
+
+    For each operation, if the project already has a quota for the given platform,
+    its limit (and usage, if given) are updated, otherwise a new quota is created.
+    Valid operations are applied in a single transaction;
+    the result of each operation is returned in the same order as the request.
+    """
+    (user,) = await context.authenticate()
+    if not user.is_admin:
+        raise HTTPException(
+            status_code=status_codes.HTTP_404_NOT_FOUND,
+            detail="Only admins can add quotas",
+        )
+    results = [None] * len(operations)
+    valid_operations = []
+    for i, operation in enumerate(operations):
+        if operation.platform not in RESOURCE_USAGE_UNITS:
+            results[i] = QuotaOperationResult(
+                project_id=operation.project_id,
+                platform=operation.platform,
+                status=QuotaOperationStatus.error,
+                detail=f"Unknown platform: {operation.platform}",
+            )
+        else:
+            valid_operations.append((i, operation))
+    if valid_operations:
+        db_results = await db.apply_quota_operations(
+            [operation.to_db() for i, operation in valid_operations]
+        )
+        for (i, operation), result in zip(valid_operations, db_results):
+            results[i] = QuotaOperationResult(
+                project_id=operation.project_id,
+                platform=operation.platform,
+                status=result["status"],
+                quota=Quota.from_db(result["quota"]) if "quota" in result else None,
+                detail=result.get("detail"),
+            )
+    return results
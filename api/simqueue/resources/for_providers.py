@@ -10,6 +10,7 @@ from fastapi.security.api_key import APIKey
 from ..data_models import (
     Job,
     JobPatch,
+    JobStatus,
     QuotaUpdate,
     Session,
     SessionUpdate,
@@ -68,8 +69,13 @@ async def update_job(
     result = await db.update_job(job_id, job_update.to_db())
     if job_update.resource_usage:
         await utils.update_quotas(
-            old_job["collab_id"], old_job["hardware_platform"], job_update.resource_usage
+            old_job["collab_id"],
+            old_job["hardware_platform"],
+            job_update.resource_usage,
+            job_id=job_id,
         )
+    elif job_update.status in (JobStatus.finished, JobStatus.error):
+        await db.release_reservations(job_id)
     return result
 
 
@@ -232,6 +238,7 @@ async def update_session(
             old_session["collab_id"],
             old_session["hardware_platform"],
             session_update.resource_usage,
+            session_id=session_id,
         )
 
     result = await db.update_session(session_id, session_update.to_db())
@@ -1,8 +1,8 @@
 from uuid import UUID
-from typing import List
+from typing import List, Optional, Union
 from datetime import date
-import logging
 import asyncio
+import logging
 
 from fastapi import (
     APIRouter,
@@ -10,12 +10,12 @@ from fastapi import (
     Depends,
     Query,
     Path,
+    Header,
     HTTPException,
+    Request,
     status as status_codes,
 )
-from fastapi.responses import PlainTextResponse
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from fastapi.security.api_key import APIKey
+from fastapi.responses import PlainTextResponse, StreamingResponse
 
 from ..data_models import (
     SubmittedJob,
@@ -23,6 +23,9 @@ from ..data_models import (
     Job,
     JobStatus,
     DataSet,
+    DataSetPage,
+    DataItem,
+    DataTransfer,
     Comment,
     CommentBody,
     Tag,
@@ -33,22 +36,51 @@ from ..data_models import (
     Quota,
     Session,
     SessionStatus,
+    SparseJob,
+    SparseSession,
+    JobField,
+    SessionField,
+    db_fields,
+    lookup_repository,
+)
+from ..data_repositories import (
+    SourceFileDoesNotExist,
+    EBRAINSDrive,
+    repository_lookup_by_name,
+    code_archive_executor,
 )
-from ..data_repositories import SourceFileDoesNotExist, SourceFileIsTooBig, EBRAINSDrive
 from .. import db, oauth, utils, settings
+from ..responses import ModelResponse
 from ..globals import PROVIDER_QUEUE_NAMES
 from ..utils import send_email
 
 logger = logging.getLogger("simqueue")
 
-auth_optional = HTTPBearer(auto_error=False)
-auth = HTTPBearer()
 router = APIRouter()
 
 
-async def _check_auth_for_list(token, api_key, collab, user_id, hardware_platform, as_admin):
-    if token:
-        user = await oauth.User.from_token(token.credentials)
+async def _check_collab_access(user, collabs, edit=False):
+    """
+    Raise a 403 error unless the user can view (or, with `edit=True`, edit) all `collabs`.
+
+    Each collab is checked only once, and public-collab lookups are run concurrently.
+    """
+    if edit:
+        access = {cid: user.can_edit(cid) for cid in dict.fromkeys(collabs)}
+    else:
+        access = await user.can_view_many(collabs)
+    for cid, allowed in access.items():
+        if not allowed:
+            raise HTTPException(
+                status_code=status_codes.HTTP_403_FORBIDDEN,
+                detail=f"You do not have permission to view collab {cid}",
+            )
+
+
+async def _check_auth_for_list(context, collab, user_id, hardware_platform, as_admin):
+    (principal,) = await context.authenticate()
+    if context.user:
+        user = principal
         if not as_admin:
             if user_id:
                 if len(user_id) > 1:
@@ -62,12 +94,7 @@ async def _check_auth_for_list(token, api_key, collab, user_id, hardware_platfor
                         detail=f"User id provided ({user_id[0]}) does not match authentication token ({user.username})",
                     )
             if collab:
-                for cid in collab:
-                    if not await user.can_view(cid):
-                        raise HTTPException(
-                            status_code=status_codes.HTTP_403_FORBIDDEN,
-                            detail=f"You do not have permission to view collab {cid}",
-                        )
+                await _check_collab_access(user, collab)
             else:
                 user_id = [user.username]
         elif not user.is_admin:
@@ -75,18 +102,13 @@ async def _check_auth_for_list(token, api_key, collab, user_id, hardware_platfor
                 status_code=status_codes.HTTP_403_FORBIDDEN,
                 detail="The token provided does not give admin privileges",
             )
-    elif api_key:
-        provider_name = await api_key
+    else:
+        provider_name = principal
         if hardware_platform:
             for hp in hardware_platform:
                 utils.check_provider_matches_platform(provider_name, hp)
         else:
             hardware_platform = PROVIDER_QUEUE_NAMES[provider_name]
-    else:
-        raise HTTPException(
-            status_code=status_codes.HTTP_401_UNAUTHORIZED,
-            detail="You must provide either a token or an API key",
-        )
     return user_id, hardware_platform
 
 
@@ -106,8 +128,9 @@ def about_this_api():
     }
 
 
-@router.get("/jobs/", response_model=List[Job])
+@router.get("/jobs/", response_model=Union[List[Job], List[SparseJob]])
 async def query_jobs(
+    request: Request,
     status: List[JobStatus] = Query(None, description="status"),
     tags: List[Tag] = Query(None, description="tags"),
     collab: List[str] = Query(None, description="collab id"),
@@ -119,15 +142,23 @@ async def query_jobs(
     date_range_end: date = Query(None, description="jobs submitted before this date"),
     size: int = Query(10, description="Number of jobs to return"),
     from_index: int = Query(0, description="Index of the first job to return"),
+    fields: List[JobField] = Query(
+        None, description="Fields to return for each job. By default, all fields are returned"
+    ),
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth_optional),
-    api_key: APIKey = Depends(oauth.get_provider_optional),
+    context: oauth.RequestContext = Depends(oauth.get_request_context),
 ):
     """
-    Return a list of jobs
+    Return a list of jobs.
+
+    Jobs can also be filtered on the contents of `hardware_config` and `provenance`,
+    using the path of a value within these fields as the parameter name,
+    e.g. `?hardware_config.wafer=62&provenance.software.pyNN=0.12.1`.
+    Values are interpreted as JSON numbers, booleans or null where possible,
+    otherwise as strings; use quotes (`"62"`) to match a string that looks like a number.
     """
     # If the user (from the token) is an admin there are no restrictions on the query
     # If the user is not an admin:
@@ -135,7 +166,7 @@ async def query_jobs(
     #   - if collab is not provided, only the user's own jobs are returned
     #   - if collab is provided the user must be a member of all collabs in the list
     user_id, hardware_platform = await _check_auth_for_list(
-        token, api_key, collab, user_id, hardware_platform, as_admin
+        context, collab, user_id, hardware_platform, as_admin
     )
     jobs = await db.query_jobs(
         status=status,
@@ -145,12 +176,19 @@ async def query_jobs(
         hardware_platform=hardware_platform,
         date_range_start=date_range_start,
         date_range_end=date_range_end,
+        **utils.get_json_filters(request.query_params),
+        fields=db_fields(field.value for field in fields) if fields else None,
         from_index=from_index,
         size=size,
         exclude_removed=True,
     )
 
-    return [Job.from_db(job) for job in jobs]
+    if fields:
+        fields = [field.value for field in fields]
+        return ModelResponse(
+            [SparseJob.from_db(job, fields) for job in jobs], List[SparseJob], exclude_unset=True
+        )
+    return ModelResponse([Job.from_db(job) for job in jobs], List[Job])
 
 
 @router.get("/jobs/{job_id}", response_model=Job)
@@ -158,47 +196,49 @@ async def get_job(
     job_id: int = Path(..., title="Job ID", description="ID of the job to be retrieved"),
     with_comments: bool = Query(False, description="Include comments"),
     with_log: bool = Query(False, description="Include log"),
+    with_output_data: Optional[bool] = Query(
+        None,
+        description=(
+            "Include the list of output data files. By default, the list is included "
+            f"only for jobs with at most {settings.MAX_EMBEDDED_OUTPUT_FILES} files. "
+            "A summary of the output data is always included."
+        ),
+    ),
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth_optional),
-    api_key: APIKey = Depends(oauth.get_provider_optional),
+    context: oauth.RequestContext = Depends(oauth.get_request_context),
 ):
     """
     Return an individual job
     """
-    if token:
-        get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-        user = await get_user_task
-    elif api_key:
-        provider_name = await api_key
-    else:
-        raise HTTPException(
-            status_code=status_codes.HTTP_401_UNAUTHORIZED,
-            detail="You must provide either a token or an API key",
-        )
-
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    job = await get_job_task
+    principal, job = await context.authenticate(context.get_job(job_id, output_data=False))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
             detail=f"Either there is no job with id {job_id}, or you do not have access to it",
         )
 
-    if token:
+    if context.user:
+        user = principal
         access_allowed = (
             (as_admin and user.is_admin)
             or job["user_id"] == user.username
             or await user.can_view(job["collab_id"])
         )
     else:
-        assert api_key is not None
+        provider_name = principal
         access_allowed = utils.check_provider_matches_platform(
             provider_name, job["hardware_platform"]
         )
 
     if access_allowed:
+        n_files = job["output_data_summary"]["count"]
+        if n_files and (
+            with_output_data
+            or (with_output_data is None and n_files <= settings.MAX_EMBEDDED_OUTPUT_FILES)
+        ):
+            job["output_data"] = await db.query_output_data(job_id)
         if with_comments:
             job["comments"] = await db.get_comments(job_id)
         if with_log:
@@ -220,15 +260,12 @@ async def get_log(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return the log for an individual job
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -255,15 +292,12 @@ async def get_comments(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return the comments on an individual job
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -282,20 +316,30 @@ async def get_comments(
     )
 
 
-@router.get("/jobs/{job_id}/output_data", response_model=DataSet)
+@router.get("/jobs/{job_id}/output_data", response_model=DataSetPage)
 async def get_output_data(
     job_id: int = Path(
         ..., title="Job ID", description="ID of the job whose output data are to be retrieved"
     ),
+    size: Optional[int] = Query(
+        None, ge=1, description="Number of files to return. By default, all files are returned"
+    ),
+    cursor: Optional[int] = Query(
+        None, description="Return the files after this point, given by 'next_cursor'"
+    ),
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    accept: Optional[str] = Header(None),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    """
+    Return the output data files of a job, optionally one page at a time.
+
+    With "Accept: application/x-ndjson", the full list of files is streamed,
+    one JSON object per line.
+    """
+    user, job = await context.authenticate(context.get_job(job_id, output_data=False))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -306,9 +350,13 @@ async def get_output_data(
         or job["user_id"] == user.username
         or await user.can_view(job["collab_id"])
     ):
-        job = await db.get_job(job_id)
-        # todo: implement a get_data_items() function in `db` module
-        return DataSet.from_db(job["output_data"])
+        summary = job["output_data_summary"]
+        if accept and "application/x-ndjson" in accept:
+            return StreamingResponse(
+                _stream_output_data(job_id, summary), media_type="application/x-ndjson"
+            )
+        data_items = await db.query_output_data(job_id, size=size, cursor=cursor)
+        return DataSetPage.from_db(data_items, summary, size)
 
     raise HTTPException(
         status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -316,21 +364,36 @@ async def get_output_data(
     )
 
 
-@router.put("/jobs/{job_id}/output_data", response_model=DataSet)
+async def _stream_output_data(job_id, summary):
+    repository_obj = lookup_repository(summary["url"])
+    async for data_item in db.iterate_output_data(job_id):
+        yield DataItem.from_db(data_item, repository_obj).model_dump_json() + "\n"
+
+
+@router.put(
+    "/jobs/{job_id}/output_data",
+    response_model=DataTransfer,
+    status_code=status_codes.HTTP_202_ACCEPTED,
+)
 async def update_output_data(
     updated_dataset: DataSet,
+    background_tasks: BackgroundTasks,
     job_id: int = Path(
         ..., title="Job ID", description="ID of the job whose output data are to be retrieved"
     ),
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    """
+    Start copying the output data of a job to a different repository.
+
+    The files are copied in the background; the transfer status can be followed using
+    the returned `resource_uri`. If a transfer fails part-way through, repeating the request
+    copies only those files that were not already copied.
+    """
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -339,31 +402,32 @@ async def update_output_data(
     if (
         (as_admin and user.is_admin)
         or job["user_id"] == user.username
-        or await user.can_edit(job["collab_id"])
+        or user.can_edit(job["collab_id"])
     ):
         original_dataset = DataSet.from_db(job["output_data"])
         if updated_dataset.repository == original_dataset.repository:
             raise HTTPException(
                 status_code=status_codes.HTTP_304_NOT_MODIFIED, detail="No change of repository"
             )
-
-        try:
-            updated_dataset_result = original_dataset.move_to(
-                updated_dataset.repository, user, collab=job["collab_id"]
-            )
-        except ValueError as err:  # requested repository does not exist
+        if updated_dataset.repository not in repository_lookup_by_name:
             raise HTTPException(
-                status_code=status_codes.HTTP_422_UNPROCESSABLE_ENTITY, detail=str(err)
+                status_code=status_codes.HTTP_422_UNPROCESSABLE_ENTITY,
+                detail=f"Repository '{updated_dataset.repository}' does not exist or is not supported",
             )
-        except SourceFileIsTooBig as err:
-            raise HTTPException(status_code=status_codes.HTTP_406_NOT_ACCEPTABLE, detail=str(err))
-        except SourceFileDoesNotExist as err:
-            raise HTTPException(status_code=status_codes.HTTP_410_GONE, detail=str(err))
-
-        # now update the job
-        await db.update_job_output_data_item(job_id, updated_dataset_result.to_db())
 
-        return updated_dataset_result
+        transfer, created = await db.create_data_transfer(
+            job_id, user.username, updated_dataset.repository, len(job["output_data"])
+        )
+        # if a transfer is already in progress, we don't start another one
+        if created:
+            background_tasks.add_task(
+                utils.transfer_output_data,
+                transfer["id"],
+                job,
+                updated_dataset.repository,
+                user,
+            )
+        return DataTransfer.from_db(transfer)
 
     raise HTTPException(
         status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -371,7 +435,50 @@ async def update_output_data(
     )
 
 
-def normalize_code(code, collab, user):
+@router.get(
+    "/jobs/{job_id}/output_data/transfers/{transfer_id}",
+    response_model=DataTransfer,
+)
+async def get_output_data_transfer(
+    job_id: int = Path(
+        ..., title="Job ID", description="ID of the job whose output data are being transferred"
+    ),
+    transfer_id: int = Path(..., title="Transfer ID", description="ID of the transfer"),
+    as_admin: bool = Query(
+        False, description="Run this query with admin privileges, if you have them"
+    ),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
+):
+    """
+    Return the progress of copying a job's output data to a different repository.
+    """
+    user, job, transfer = await context.authenticate(
+        context.get_job(job_id), db.get_data_transfer(transfer_id)
+    )
+    if (
+        job is not None
+        and transfer is not None
+        and transfer["job_id"] == job_id
+        and (
+            (as_admin and user.is_admin)
+            or job["user_id"] == user.username
+            or await user.can_view(job["collab_id"])
+        )
+    ):
+        return DataTransfer.from_db(transfer)
+
+    raise HTTPException(
+        status_code=status_codes.HTTP_404_NOT_FOUND,
+        detail=f"Either there is no transfer with id {transfer_id} for job {job_id}, or you do not have access to it",
+    )
+
+
+# Drive code archives currently being prepared, by Drive URI and username,
+# so that concurrent submissions of the same code share a single preparation
+_code_preparations = {}
+
+
+async def normalize_code(code, collab, user):
     """
     The code field may contain:
         1. the Python code to be run
@@ -387,7 +494,20 @@ def normalize_code(code, collab, user):
     """
     if code.startswith("drive://"):
         # todo: add original `code` field to job provenance
-        return EBRAINSDrive.get_download_url(code, user)
+        # preparations are not shared between users, since they may have different access rights
+        key = (code, user.username)
+        future = _code_preparations.get(key)
+        if future is None:
+            # downloading from the Drive is blocking, so we do it outside the event loop
+            future = asyncio.get_running_loop().run_in_executor(
+                code_archive_executor, EBRAINSDrive.get_download_url, code, user
+            )
+            _code_preparations[key] = future
+            future.add_done_callback(lambda f: _code_preparations.pop(key, None))
+        # if this request is cancelled, other requests waiting on the same preparation are not
+        url = await asyncio.shield(future)
+        await utils.evict_code_archives()
+        return url
     else:
         return code
 
@@ -398,18 +518,20 @@ async def create_job(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    user = await get_user_task
+    user = await context.get_user()
     if (as_admin and user.is_admin) or user.can_edit(job.collab):
+        estimate = utils.estimate_resource_usage(
+            job.hardware_platform, job.estimated_resource_usage
+        )
         try:
-            job.code = normalize_code(job.code, job.collab, user)
+            job.code = await normalize_code(job.code, job.collab, user)
         except SourceFileDoesNotExist as err:
             raise HTTPException(status_code=status_codes.HTTP_400_BAD_REQUEST, detail=str(err))
-        proceed = await utils.check_quotas(job.collab, job.hardware_platform, user=user.username)
-        if proceed:
-            accepted_job = await db.create_job(user_id=user.username, job=job.to_db())
+        # the quota check and the reservation are made together, with the quotas locked
+        accepted_job = await utils.submit_job(user.username, job.to_db(), estimate)
+        if accepted_job is not None:
             return Job.from_db(accepted_job)
         else:
             raise HTTPException(
@@ -431,15 +553,12 @@ async def add_comment(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Post a comment
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -472,19 +591,14 @@ async def update_comment(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Edit a comment
     """
-    get_comment_task = asyncio.create_task(db.get_comment(comment_id))
-    old_comment = await get_comment_task
+    user, old_comment = await context.authenticate(db.get_comment(comment_id))
     job_id = old_comment["job_id"]
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-
-    user = await get_user_task
-    job = await get_job_task
+    job = await context.get_job(job_id)
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -509,19 +623,14 @@ async def remove_comment(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Remove a comment from a job
     """
-    get_comment_task = asyncio.create_task(db.get_comment(comment_id))
-    old_comment = await get_comment_task
+    user, old_comment = await context.authenticate(db.get_comment(comment_id))
     job_id = old_comment["job_id"]
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-
-    user = await get_user_task
-    job = await get_job_task
+    job = await context.get_job(job_id)
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -547,15 +656,12 @@ async def get_tags(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return the tags on an individual job
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -581,15 +687,12 @@ async def add_tags(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Add tags to a job
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -619,15 +722,12 @@ async def remove_tags(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Remove tags from a job
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_job_task = asyncio.create_task(db.get_job(job_id))
-    user = await get_user_task
-    job = await get_job_task
+    user, job = await context.authenticate(context.get_job(job_id))
     if job is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -649,12 +749,12 @@ async def remove_tags(
 @router.get("/tags/", response_model=List[Tag])
 async def query_tags(
     collab: str = Query(None, description="collab id"),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return a list of tags used by existing jobs
     """
-    user = await oauth.User.from_token(token.credentials)
+    user = await context.get_user()
     if collab and collab not in ("null", "undefined"):
         if not (user.is_admin or user.can_view(collab)):
             raise HTTPException(
@@ -681,8 +781,7 @@ async def query_projects(
         False, description="Run this query with admin privileges, if you have them"
     ),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth_optional),
-    api_key: APIKey = Depends(oauth.get_provider_optional),
+    context: oauth.RequestContext = Depends(oauth.get_request_context),
 ):
     """
     Return a list of projects
@@ -692,8 +791,9 @@ async def query_projects(
     #   - if owner is provided, it must contain _only_ the user's id
     #   - if collab is not provided, projects for collabs for which the user has edit access are returned
     #   - if collab is provided, the user must have edit access for all collabs in the list
-    if token:
-        user = await oauth.User.from_token(token.credentials)
+    (principal,) = await context.authenticate()
+    if context.user:
+        user = principal
         if not as_admin:
             if owner:
                 if len(owner) > 1:
@@ -707,12 +807,7 @@ async def query_projects(
                         detail=f"Owner id provided ({owner[0]}) does not match authentication token ({user.username})",
                     )
             if collab:
-                for cid in collab:
-                    if not user.can_edit(cid):
-                        raise HTTPException(
-                            status_code=status_codes.HTTP_403_FORBIDDEN,
-                            detail=f"You do not have permission to view collab {cid}",
-                        )
+                await _check_collab_access(user, collab, edit=True)
             else:
                 collab = user.get_collabs(access=["editor", "administrator"])
         elif not user.is_admin:
@@ -720,13 +815,7 @@ async def query_projects(
                 status_code=status_codes.HTTP_403_FORBIDDEN,
                 detail="The token provided does not give admin privileges",
             )
-    elif api_key:
-        provider_name = await api_key
-        if provider_name is None:
-            raise HTTPException(
-                status_code=status_codes.HTTP_403_FORBIDDEN,
-                detail=f"Invalid API key",
-            )
+    else:
         if not collab:
             raise HTTPException(
                 status_code=status_codes.HTTP_400_BAD_REQUEST,
@@ -738,11 +827,6 @@ async def query_projects(
                 detail="If authenticating via API key, status must be 'accepted'",
             )
         status = ProjectStatus.accepted
-    else:
-        raise HTTPException(
-            status_code=status_codes.HTTP_401_UNAUTHORIZED,
-            detail="You must provide either a token or an API key",
-        )
     projects = await db.query_projects(
         status=status, collab=collab, owner=owner, from_index=from_index, size=size
     )
@@ -761,16 +845,12 @@ async def get_project(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return an individual project
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_project_task = db.get_project(project_id)
-
-    user = await get_user_task
-    project = await get_project_task
+    user, project = await context.authenticate(context.get_project(project_id))
 
     if project is not None:
         if (as_admin and user.is_admin) or await user.can_view(project["collab"]):
@@ -796,17 +876,13 @@ async def delete_project(
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Delete a project and its associated quotas
     """
 
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_project_task = db.get_project(project_id)
-
-    user = await get_user_task
-    project = await get_project_task
+    user, project = await context.authenticate(context.get_project(project_id))
 
     if project is not None:
         if (as_admin and user.is_admin) or user.can_edit(project["collab"]):
@@ -835,17 +911,13 @@ async def delete_quota(
     quota_id: int = Path(
         ..., title="Quota ID", description="ID of the quota that should be deleted"
     ),
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Delete a quota
     """
 
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_project_task = db.get_project(project_id)
-
-    user = await get_user_task
-    project = await get_project_task
+    user, project = await context.authenticate(context.get_project(project_id))
 
     if project is None:
         raise HTTPException(
@@ -874,10 +946,9 @@ async def create_project(
         False, description="Run this query with admin privileges, if you have them"
     ),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    user = await get_user_task
+    user = await context.get_user()
 
     project = projectRB.to_db(owner=user.username)
     if not ((as_admin and user.is_admin) or user.can_edit(project["collab"])):
@@ -903,15 +974,12 @@ async def query_quotas(
     size: int = Query(10, description="Number of quotas to return"),
     from_index: int = Query(0, description="Index of the first quota to return"),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return a list of quotas for a given project
     """
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_project_task = asyncio.create_task(db.get_project(project_id))
-    user = await get_user_task
-    project = await get_project_task
+    user, project = await context.authenticate(context.get_project(project_id))
     if project is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -942,16 +1010,13 @@ async def get_quota(
     size: int = Query(10, description="Number of projects to return"),
     from_index: int = Query(0, description="Index of the first project to return"),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return a list of quotas for a given project
     """
 
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_project_task = asyncio.create_task(db.get_project(project_id))
-    user = await get_user_task
-    project = await get_project_task
+    user, project = await context.authenticate(context.get_project(project_id))
     if project is None:
         raise HTTPException(
             status_code=status_codes.HTTP_404_NOT_FOUND,
@@ -984,7 +1049,7 @@ async def query_collabs(
         False, description="Run this query with admin privileges, if you have them"
     ),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
     """
     Return a list of collabs for which the user has edit permissions and a neuromorphic computing project exists
@@ -994,7 +1059,7 @@ async def query_collabs(
     #   - if user_id is provided, it must contain _only_ the user's id
     #   - if collab is not provided, projects for collabs for which the user has edit access are returned
     #   - if collab is provided, the user must have edit access for all collabs in the list
-    user = await oauth.User.from_token(token.credentials)
+    user = await context.get_user()
     if not as_admin:
         if user_id:
             if len(user_id) > 1:
@@ -1040,12 +1105,10 @@ async def update_project(
         False, description="Run this query with admin privileges, if you have them"
     ),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth),
+    context: oauth.RequestContext = Depends(oauth.get_user_context),
 ):
-    get_user_task = asyncio.create_task(oauth.User.from_token(token.credentials))
-    get_project_task = asyncio.create_task(db.get_project(project_id))
-    user = await get_user_task
-    original_project = Project.from_db(await get_project_task)
+    user, project = await context.authenticate(context.get_project(project_id))
+    original_project = Project.from_db(project)
 
     if original_project is None:
         raise HTTPException(
@@ -1102,7 +1165,7 @@ async def update_project(
         return status_codes.HTTP_201_CREATED
 
 
-@router.get("/sessions/", response_model=List[Session])
+@router.get("/sessions/", response_model=Union[List[Session], List[SparseSession]])
 async def query_sessions(
     status: List[SessionStatus] = Query(None, description="status"),
     collab: List[str] = Query(None, description="collab id"),
@@ -1114,12 +1177,14 @@ async def query_sessions(
     date_range_end: date = Query(None, description="sessions started before this date"),
     size: int = Query(10, description="Number of sessions to return"),
     from_index: int = Query(0, description="Index of the first session to return"),
+    fields: List[SessionField] = Query(
+        None, description="Fields to return for each session. By default, all fields are returned"
+    ),
     as_admin: bool = Query(
         False, description="Run this query with admin privileges, if you have them"
     ),
     # from header
-    token: HTTPAuthorizationCredentials = Depends(auth_optional),
-    api_key: APIKey = Depends(oauth.get_provider_optional),
+    context: oauth.RequestContext = Depends(oauth.get_request_context),
 ):
     """
     Return a list of sessions
@@ -1130,7 +1195,7 @@ async def query_sessions(
     #   - if collab is not provided, only the user's own sessions are returned
     #   - if collab is provided the user must be a member of all collabs in the list
     user_id, hardware_platform = await _check_auth_for_list(
-        token, api_key, collab, user_id, hardware_platform, as_admin
+        context, collab, user_id, hardware_platform, as_admin
     )
     sessions = await db.query_sessions(
         status=status,
@@ -1139,8 +1204,16 @@ async def query_sessions(
         hardware_platform=hardware_platform,
         date_range_start=date_range_start,
         date_range_end=date_range_end,
+        fields=db_fields(field.value for field in fields) if fields else None,
         from_index=from_index,
         size=size,
     )
 
-    return [Session.from_db(session) for session in sessions]
+    if fields:
+        fields = [field.value for field in fields]
+        return ModelResponse(
+            [SparseSession.from_db(session, fields) for session in sessions],
+            List[SparseSession],
+            exclude_unset=True,
+        )
+    return ModelResponse([Session.from_db(session) for session in sessions], List[Session])
@@ -17,14 +17,24 @@ from ..data_models import (
     ProjectStatus,
     UserStatistics,
 )
-from .. import db, oauth
+from .. import db, oauth, settings
 
 from ..globals import STANDARD_QUEUES
 
 
 logger = logging.getLogger("simqueue")
 
-router = APIRouter()
+# each statistics request holds a database connection while it runs, so the number handled
+# at once is limited, to leave connections free for users and computing system providers
+statistics_slots = asyncio.Semaphore(settings.STATISTICS_CONCURRENCY)
+
+
+async def limit_concurrency():
+    async with statistics_slots:
+        yield
+
+
+router = APIRouter(dependencies=[Depends(limit_concurrency)])
 auth = HTTPBearer()
 
 
@@ -0,0 +1,32 @@
+from functools import lru_cache
+
+from fastapi.responses import JSONResponse
+from pydantic import TypeAdapter
+
+
+@lru_cache
+def get_serializer(response_model):
+    return TypeAdapter(response_model)
+
+
+class ModelResponse(JSONResponse):
+    """
+    JSON response for content that is already an instance of `response_model`,
+    e.g. a list of models built by their `from_db()` methods.
+
+    Returning this from an endpoint avoids FastAPI converting the content back to dicts,
+    validating it a second time against the endpoint's response model
+    and then encoding it with the standard library `json` module:
+    the content is serialised directly to JSON by pydantic, with a cached serializer.
+
+    With `exclude_unset=True`, fields that were not explicitly set are left out.
+    """
+
+    def __init__(self, content, response_model, exclude_unset=False, **kwargs):
+        self.response_model = response_model
+        self.exclude_unset = exclude_unset
+        super().__init__(content, **kwargs)
+
+    def render(self, content) -> bytes:
+        serializer = get_serializer(self.response_model)
+        return serializer.dump_json(content, exclude_unset=self.exclude_unset)
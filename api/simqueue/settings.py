@@ -15,11 +15,38 @@ DATABASE_USERNAME = os.environ.get("NMPI_DATABASE_USER", "nmpi_dbadmin")
 DATABASE_PASSWORD = os.environ.get("NMPI_DATABASE_PASSWORD")
 DATABASE_HOST = os.environ.get("NMPI_DATABASE_HOST")
 DATABASE_PORT = os.environ.get("NMPI_DATABASE_PORT")
+# "false", "true", or a libpq sslmode such as "require" or "verify-full"
+DATABASE_SSL = os.environ.get("NMPI_DATABASE_SSL", "false")
+DATABASE_SSL_ROOT_CERT = os.environ.get("NMPI_DATABASE_SSL_ROOT_CERT")  # for "verify-ca/full"
+DATABASE_POOL_MIN_SIZE = int(os.environ.get("NMPI_DATABASE_POOL_MIN_SIZE", 2))
+DATABASE_POOL_MAX_SIZE = int(os.environ.get("NMPI_DATABASE_POOL_MAX_SIZE", 10))
+DATABASE_POOL_ACQUIRE_TIMEOUT = float(os.environ.get("NMPI_DATABASE_POOL_ACQUIRE_TIMEOUT", 10))
+# prepared statements cached per connection; set to 0 behind a transaction-mode PgBouncer
+DATABASE_STATEMENT_CACHE_SIZE = int(os.environ.get("NMPI_DATABASE_STATEMENT_CACHE_SIZE", 100))
+# maximum number of statistics requests handled at once, each of which holds a database
+# connection, so that a burst of them cannot take all the connections from the pool
+STATISTICS_CONCURRENCY = int(os.environ.get("NMPI_STATISTICS_CONCURRENCY", 2))
 BASE_URL = os.environ.get("NMPI_BASE_URL", "")
 # ADMIN_GROUP_ID = ""
 AUTHENTICATION_TIMEOUT = 20
+QUOTA_CACHE_TTL = 30  # seconds
+QUOTA_CACHE_MAX_ENTRIES = 10000  # (collab, platform) pairs
+QUOTA_LEDGER_COMPACTION_INTERVAL = 300  # seconds
+COLLAB_LOOKUP_CONCURRENCY = 10  # maximum number of simultaneous requests to the Collab service
+FILE_TRANSFER_CONCURRENCY = 4  # maximum number of files copied between repositories at once
+FILE_TRANSFER_CONNECT_TIMEOUT = 10  # seconds
+FILE_TRANSFER_TIMEOUT = 120  # seconds without any data sent or received, during a file copy
+DATA_TRANSFER_HEARTBEAT_INTERVAL = 60  # seconds between updates of a running transfer
+DATA_TRANSFER_TIMEOUT = 300  # seconds without an update after which a transfer has failed
+DRIVE_CACHE_TTL = 60  # seconds
+MAX_EMBEDDED_OUTPUT_FILES = 1000  # larger file lists are only available from /jobs/{id}/output_data
+COMPRESSION_MINIMUM_SIZE = 1024  # bytes; smaller responses are sent uncompressed
+COMPRESSION_LEVELS = {"zstd": 3, "br": 4, "gzip": 6}  # see benchmarks/compression.py
 TMP_FILE_URL = BASE_URL + "/tmp_download"
 TMP_FILE_ROOT = os.environ.get("NMPI_TMP_FILE_ROOT", "tmp_download")
+TMP_FILE_CACHE_SIZE = int(os.environ.get("NMPI_TMP_FILE_CACHE_SIZE", 5 * 1024**3))  # bytes
+# code archives used more recently than this are not deleted, even if the cache is full
+TMP_FILE_GRACE_PERIOD = int(os.environ.get("NMPI_TMP_FILE_GRACE_PERIOD", 3600))  # seconds
 EMAIL_HOST = os.environ.get("NMPI_EMAIL_HOST")
 EMAIL_SENDER = "neuromorphic@ebrains.eu"
 EMAIL_PASSWORD = os.environ.get("NMPI_EMAIL_PASSWORD", None)
@@ -0,0 +1,110 @@
+import gzip
+import json
+
+import brotli
+import pytest
+import zstandard
+from fastapi import FastAPI
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from fastapi.testclient import TestClient
+
+from simqueue.compression import CompressionMiddleware, choose_encoding
+
+LEVELS = {"zstd": 3, "br": 4, "gzip": 6}
+
+large_content = [{"id": i, "code": "import pyNN.spiNNaker as sim\n"} for i in range(100)]
+log_lines = [f"line {i}: the quick brown fox jumps over the lazy dog\n" for i in range(1000)]
+
+compressed_app = FastAPI()
+compressed_app.add_middleware(CompressionMiddleware, levels=LEVELS, minimum_size=1024)
+
+
+@compressed_app.get("/large")
+def large():
+    return JSONResponse(large_content)
+
+
+@compressed_app.get("/small")
+def small():
+    return JSONResponse({"status": "ok"})
+
+
+@compressed_app.get("/stream")
+def stream():
+    return StreamingResponse(iter(log_lines), media_type="text/plain")
+
+
+@compressed_app.get("/precompressed")
+def precompressed():
+    return Response(
+        gzip.compress("".join(log_lines).encode("utf-8")),
+        media_type="text/plain",
+        headers={"Content-Encoding": "gzip"},
+    )
+
+
+@compressed_app.get("/archive")
+def archive():
+    return Response(b"PK" + bytes(4096), media_type="application/zip")
+
+
+client = TestClient(compressed_app)
+
+DECOMPRESS = {
+    "gzip": gzip.decompress,
+    "br": brotli.decompress,
+    "zstd": lambda data: zstandard.ZstdDecompressor().decompressobj().decompress(data),
+}
+
+
+def get(path, accept_encoding):
+    # use a stream so that the raw (still compressed) body can be checked
+    with client.stream("GET", path, headers={"Accept-Encoding": accept_encoding}) as response:
+        return response, b"".join(response.iter_raw())
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_compress_large_response(encoding):
+    response, body = get("/large", encoding)
+    assert response.status_code == 200
+    assert response.headers["content-encoding"] == encoding
+    assert response.headers["vary"] == "Accept-Encoding"
+    assert int(response.headers["content-length"]) == len(body)
+    assert json.loads(DECOMPRESS[encoding](body)) == large_content
+
+
+@pytest.mark.parametrize("encoding", ["gzip", "br", "zstd"])
+def test_compress_streaming_response(encoding):
+    response, body = get("/stream", encoding)
+    assert response.headers["content-encoding"] == encoding
+    assert "content-length" not in response.headers
+    assert DECOMPRESS[encoding](body).decode("utf-8") == "".join(log_lines)
+
+
+def test_no_compression():
+    # small responses
+    response, body = get("/small", "gzip")
+    assert "content-encoding" not in response.headers
+    assert json.loads(body) == {"status": "ok"}
+    # clients that do not accept any supported encoding
+    response, body = get("/large", "identity")
+    assert "content-encoding" not in response.headers
+    assert json.loads(body) == large_content
+    # content that is already compressed
+    response, body = get("/precompressed", "zstd, br, gzip")
+    assert response.headers["content-encoding"] == "gzip"
+    assert gzip.decompress(body).decode("utf-8") == "".join(log_lines)
+    response, body = get("/archive", "gzip")
+    assert "content-encoding" not in response.headers
+    assert body == b"PK" + bytes(4096)
+
+
+def test_choose_encoding():
+    assert choose_encoding("gzip, deflate, br, zstd") == "zstd"
+    assert choose_encoding("gzip, deflate, br") == "br"
+    assert choose_encoding("gzip;q=0.5, br;q=0.2") == "gzip"
+    assert choose_encoding("*") == "zstd"
+    assert choose_encoding("*, zstd;q=0") == "br"
+    assert choose_encoding("gzip;q=0, identity") is None
+    assert choose_encoding("") is None
+    assert choose_encoding("gzip, br", available=("gzip",)) == "gzip"
@@ -1,4 +1,5 @@
 import os
+import asyncio
 from datetime import date, datetime, timezone
 from copy import deepcopy
 from uuid import uuid4, UUID
@@ -6,8 +7,11 @@ import json
 import pytz
 import pytest
 import pytest_asyncio
+import asyncpg
 
-from .. import db, settings
+from sqlalchemy.dialects import postgresql
+
+from .. import db, migrate, settings, utils
 from ..data_models import ProjectStatus
 
 TEST_COLLAB = "neuromorphic-testing-private"
@@ -38,7 +42,7 @@ async def submitted_job(new_tag):
         "collab_id": TEST_COLLAB,
         "status": "submitted",
         "hardware_platform": "TestPlatform",
-        "hardware_config": json.dumps({"answer": "42"}),
+        "hardware_config": {"answer": "42"},
         "tags": sorted(["test", new_tag]),
     }
     response = await db.create_job(user_id=TEST_USER, job=data)
@@ -67,6 +71,25 @@ async def new_project():
     response2 = await db.delete_project(response["context"])
 
 
+@pytest_asyncio.fixture()
+async def accepted_project():
+    # each project has its own collab, so that tests do not share quotas
+    data = {
+        "collab": f"test-{uuid4().hex}",
+        "owner": TEST_USER,
+        "title": "Test Project - to delete",
+        "abstract": "this is the abstract",
+        "description": "this is the description",
+    }
+    response = await db.create_project(data)
+    await db.update_project(response["context"], {"accepted": True, "decision_date": date.today()})
+    yield response
+    # remove any jobs submitted to the collab during the test
+    for job in await db.query_jobs(collab=[response["collab"]], size=1000):
+        await db.delete_job(job["id"])
+    response2 = await db.delete_project(response["context"])
+
+
 @pytest_asyncio.fixture()
 async def new_session():
     data = {
@@ -74,7 +97,7 @@ async def new_session():
         "user_id": TEST_USER,
         "status": "submitted",
         "hardware_platform": "TestPlatform",
-        "hardware_config": json.dumps({"answer": "42"}),
+        "hardware_config": {"answer": "42"},
         "timestamp_start": datetime(2022, 11, 22, 12, 23, 45, tzinfo=timezone.utc),
         "resource_usage": 0.0,
     }
@@ -110,6 +133,30 @@ async def test_query_jobs_no_filters(database_connection):
     assert set(jobs[0].keys()) == expected_keys
 
 
+@pytest.mark.asyncio
+async def test_query_jobs_with_fields(database_connection):
+    jobs = await db.query_jobs(fields=["status", "hardware_platform"], size=5)
+    assert len(jobs) == 5
+    assert set(jobs[0].keys()) == {"status", "hardware_platform"}
+
+    # the job id is always included when related objects are requested
+    jobs = await db.query_jobs(fields=["status", "tags"], size=5)
+    assert set(jobs[0].keys()) == {"id", "status", "tags"}
+
+
+@pytest.mark.asyncio
+async def test_iterate_jobs(database_connection):
+    filters = dict(status=["submitted", "running", "finished", "error"])
+    expected = await db.query_jobs(**filters, size=100000)
+    jobs = [job async for job in db.iterate_jobs(include=["tags"], batch_size=3, **filters)]
+    assert len(jobs) == len(expected) > 3
+    assert [job["id"] for job in jobs] == sorted(job["id"] for job in expected)
+    expected_tags = {job["id"]: job["tags"] for job in expected}
+    for job in jobs:
+        assert job["tags"] == expected_tags[job["id"]]
+        assert "input_data" not in job
+
+
 @pytest.mark.asyncio
 async def test_query_jobs_with_filters(database_connection):
     jobs = await db.query_jobs(
@@ -137,6 +184,25 @@ async def test_query_jobs_with_filters(database_connection):
         )
 
 
+@pytest.mark.asyncio
+async def test_query_jobs_with_json_filters(database_connection, submitted_job):
+    jobs = await db.query_jobs(
+        hardware_platform=["TestPlatform"], hardware_config={"answer": "42"}, size=100
+    )
+    assert submitted_job["id"] in [job["id"] for job in jobs]
+    for job in jobs:
+        assert job["hardware_config"]["answer"] == "42"
+
+    await db.update_job(submitted_job["id"], {"provenance": {"software": {"pyNN": "0.12.1"}}})
+    jobs = await db.query_jobs(provenance={"software": {"pyNN": "0.12.1"}}, size=100)
+    assert submitted_job["id"] in [job["id"] for job in jobs]
+
+    jobs = await db.query_jobs(
+        hardware_platform=["TestPlatform"], hardware_config={"answer": 42}, size=100
+    )
+    assert submitted_job["id"] not in [job["id"] for job in jobs]
+
+
 @pytest.mark.asyncio
 async def test_get_job(database_connection):
     job = await db.get_job(142972)
@@ -166,12 +232,47 @@ async def test_get_nonexistent_job(database_connection):
     assert job is None
 
 
+@pytest.mark.asyncio
+async def test_cached_queries(database_connection, submitted_job):
+    # results from compiled-once queries are the same as from queries compiled each time
+    query = db.jobs.select().where(db.jobs.c.id == submitted_job["id"])
+    expected = dict(await db.database.fetch_one(query))
+    assert dict(await db._job_query.fetch_one(job_id=submitted_job["id"])) == expected
+    assert await db._job_query.fetch_one(job_id=-1) is None
+    job = await db.get_job(submitted_job["id"])
+    assert job["hardware_config"] == {"answer": "42"}
+    assert job["tags"] == submitted_job["tags"]
+    assert job["input_data"] == []
+
+
 @pytest.mark.asyncio
 async def test_get_next_job(database_connection, submitted_job):
     next_job = await db.get_next_job(submitted_job["hardware_platform"])
     assert next_job["id"] == submitted_job["id"]
 
 
+@pytest.mark.asyncio
+async def test_get_code_archives_in_use(database_connection):
+    async with db.database.transaction(force_rollback=True):
+        for status, name in [
+            ("submitted", "a-1.zip"),
+            ("running", "b-1.zip"),
+            ("finished", "c-1.zip"),
+        ]:
+            job = {
+                "code": f"https://example.com/tmp_download/{name}",
+                "command": None,
+                "collab_id": TEST_COLLAB,
+                "hardware_platform": "TestPlatform",
+                "hardware_config": None,
+                "tags": [],
+            }
+            created_job = await db.create_job(user_id=TEST_USER, job=job)
+            await db.update_job(created_job["id"], {"status": status})
+        in_use = await db.get_code_archives_in_use("https://example.com/tmp_download")
+        assert in_use == {"a-1.zip", "b-1.zip"}
+
+
 @pytest.mark.asyncio
 async def test_get_comments(database_connection):
     comments = await db.get_comments(142972)
@@ -194,7 +295,7 @@ async def test_create_job(database_connection, new_tag):
         "collab_id": TEST_COLLAB,
         "status": "submitted",
         "hardware_platform": "testPlatform",
-        "hardware_config": json.dumps({"answer": "42"}),
+        "hardware_config": {"answer": "42"},
         "tags": sorted(["test", new_tag]),
     }
     response = await db.create_job(user_id=TEST_USER, job=data)
@@ -241,7 +342,7 @@ async def test_update_job(database_connection, submitted_job):
                 hash="edcba9876543210f",
             ),
         ],
-        "provenance": json.dumps({"foo": "bar"}),
+        "provenance": {"foo": "bar"},
         "resource_usage": 999.0,
         "log": "Lorem ipsum dolor sit amet, consectetur adipiscing elit",
     }
@@ -257,6 +358,120 @@ async def test_update_job(database_connection, submitted_job):
     assert response == expected
 
 
+@pytest.mark.asyncio
+@pytest.mark.parametrize("n_files", [10, 10000])
+async def test_update_job_many_output_files(database_connection, submitted_job, n_files):
+    output_data = [
+        dict(
+            url=f"http://example.com/{submitted_job['id']}/trace_{i}.npz",
+            path=f"trace_{i}.npz",
+            content_type="application/octet-stream",
+            size=i,
+            hash=f"{submitted_job['id']}-{i}",
+        )
+        for i in range(n_files)
+    ]
+    response = await db.update_job(
+        job_id=submitted_job["id"], job_patch={"status": "finished", "output_data": output_data}
+    )
+    assert response["status"] == "finished"
+    assert len(response["output_data"]) == n_files
+    for data_item in response["output_data"]:
+        data_item.pop("id")
+    response["output_data"].sort(key=lambda item: item["size"])
+    assert response["output_data"] == output_data
+
+
+@pytest.mark.asyncio
+async def test_update_job_output_path_too_long(database_connection, submitted_job):
+    # values longer than the column must be rejected, not silently truncated
+    output_data = [
+        dict(
+            url=f"http://example.com/{submitted_job['id']}/trace.npz",
+            path="x" * 1001,
+            content_type="application/octet-stream",
+            size=1,
+            hash=f"{submitted_job['id']}-long",
+        )
+    ]
+    with pytest.raises(asyncpg.exceptions.StringDataRightTruncationError):
+        await db.update_job(job_id=submitted_job["id"], job_patch={"output_data": output_data})
+    job = await db.get_job(submitted_job["id"])
+    assert job["output_data"] == []
+
+
+@pytest.mark.asyncio
+async def test_query_output_data(database_connection, submitted_job):
+    output_data = [
+        dict(
+            url=f"http://example.com/{submitted_job['id']}/trace_{i}.npz",
+            path=f"trace_{i}.npz",
+            content_type="application/octet-stream",
+            size=100,
+            hash=f"{submitted_job['id']}-{i}",
+        )
+        for i in range(5)
+    ]
+    await db.update_job(job_id=submitted_job["id"], job_patch={"output_data": output_data})
+
+    job = await db.get_job(submitted_job["id"], output_data=False)
+    assert job["output_data"] is None
+    assert job["output_data_summary"]["count"] == 5
+    assert job["output_data_summary"]["size"] == 500
+
+    page1 = await db.query_output_data(submitted_job["id"], size=3)
+    page2 = await db.query_output_data(submitted_job["id"], size=3, cursor=page1[-1]["id"])
+    assert len(page1) == 3
+    assert len(page2) == 2
+    all_items = [item async for item in db.iterate_output_data(submitted_job["id"])]
+    assert all_items == page1 + page2
+
+
+@pytest.mark.asyncio
+async def test_shared_data_items(database_connection):
+    shared_item = dict(
+        url=f"http://example.com/{uuid4()}/stimulus.dat",
+        path="stimulus.dat",
+        content_type="application/octet-stream",
+        size=1024,
+        hash="0123456789abcdef",
+    )
+    data = {
+        "code": "import antigravity\n",
+        "command": None,
+        "collab_id": TEST_COLLAB,
+        "hardware_platform": "TestPlatform",
+        "hardware_config": None,
+        "input_data": [shared_item, shared_item],
+    }
+    job1 = await db.create_job(user_id=TEST_USER, job=data)
+    job2 = await db.create_job(user_id=TEST_USER, job=data)
+    # both jobs link to a single data item
+    assert len(job1["input_data"]) == 1
+    dataitem_id = job1["input_data"][0]["id"]
+    assert job2["input_data"][0]["id"] == dataitem_id
+
+    # changing the item for one job does not affect the other
+    await db.create_job_output_data_item(job1["id"], [shared_item])
+    await db.update_job_output_data_item(
+        job1["id"], [{"hash": shared_item["hash"], "url": "http://example.com/moved.dat"}]
+    )
+    job1 = await db.get_job(job1["id"])
+    assert job1["output_data"][0]["url"] == "http://example.com/moved.dat"
+    assert job1["output_data"][0]["path"] == "stimulus.dat"
+    assert job1["input_data"][0]["id"] == dataitem_id
+
+    # the item is only deleted once no job uses it
+    await db.delete_job(job1["id"])
+    job2 = await db.get_job(job2["id"])
+    assert job2["input_data"][0]["id"] == dataitem_id
+    await db.delete_job(job2["id"])
+    query = db.data_items.select().where(
+        db.data_items.c.url.in_([shared_item["url"], "http://example.com/moved.dat"])
+    )
+    assert await db.database.fetch_all(query) == []
+
+
 @pytest.mark.asyncio
 async def test_add_and_remove_tags(database_connection, submitted_job):
     original_tags = submitted_job["tags"]
@@ -317,6 +532,51 @@ async def test_add_update_and_remove_comments(database_connection, submitted_job
     assert len(response7) == 1
 
 
+@pytest.mark.asyncio
+async def test_data_transfers(database_connection, submitted_job):
+    job_id = submitted_job["id"]
+    transfer, created = await db.create_data_transfer(job_id, TEST_USER, "EBRAINS Bucket", 2)
+    assert created
+    assert transfer["status"] == "queued"
+    assert transfer["n_copied"] == 0
+    assert (await db.get_active_data_transfer(job_id))["id"] == transfer["id"]
+
+    # only one transfer can be active at once, even for concurrent requests
+    results = await asyncio.gather(
+        *(db.create_data_transfer(job_id, TEST_USER, "EBRAINS Drive", 2) for i in range(3))
+    )
+    assert [(other["id"], created) for other, created in results] == [(transfer["id"], False)] * 3
+
+    await db.update_data_transfer(transfer["id"], {"status": "running"})
+    await asyncio.gather(*(db.record_file_transferred(transfer["id"]) for i in range(2)))
+    transfer = await db.get_data_transfer(transfer["id"])
+    assert (transfer["status"], transfer["n_copied"]) == ("running", 2)
+
+    await db.update_data_transfer(transfer["id"], {"status": "finished"})
+    assert await db.get_active_data_transfer(job_id) is None
+
+
+@pytest.mark.asyncio
+async def test_stale_data_transfers(database_connection, submitted_job):
+    job_id = submitted_job["id"]
+    async with db.database.transaction(force_rollback=True):
+        # a transfer whose process was restarted, which would otherwise block later transfers
+        transfer, created = await db.create_data_transfer(job_id, TEST_USER, "EBRAINS Bucket", 2)
+        await db.database.execute(
+            db.data_transfers.update()
+            .where(db.data_transfers.c.id == transfer["id"])
+            .values(status="running", timestamp_update=datetime(2020, 1, 1, tzinfo=timezone.utc))
+        )
+        new_transfer, created = await db.create_data_transfer(
+            job_id, TEST_USER, "EBRAINS Bucket", 2
+        )
+        assert created
+        assert new_transfer["id"] != transfer["id"]
+        transfer = await db.get_data_transfer(transfer["id"])
+        assert transfer["status"] == "error"
+        assert transfer["timestamp_end"] is not None
+
+
 # ---- Sessions -------------------------------------------
 
 
@@ -327,7 +587,7 @@ async def test_create_session(database_connection, new_session):
         "user_id": TEST_USER,
         "status": "running",
         "hardware_platform": "TestPlatform",
-        "hardware_config": json.dumps({"answer": "42"}),
+        "hardware_config": {"answer": "42"},
         "timestamp_start": datetime.fromisoformat("2022-11-22T12:23:45+00:00"),
         "timestamp_end": None,
         "resource_usage": 0.0,
@@ -458,7 +718,7 @@ async def test_update_project(database_connection, new_project):
 async def test_query_quotas_no_filters(database_connection):
     quotas = await db.query_quotas(size=5, from_index=1)
     assert len(quotas) > 0
-    expected_keys = ("id", "project_id", "usage", "limit", "units", "platform")
+    expected_keys = ("id", "project_id", "usage", "reserved", "limit", "units", "platform")
     assert set(quotas[0].keys()) == set(expected_keys)
 
 
@@ -474,6 +734,7 @@ async def test_create_quota(database_connection, new_project):
     expected = deepcopy(data)
     expected["id"] = quota_id
     expected["project_id"] = new_project["context"]
+    expected["reserved"] = 0.0
     assert dict(response2[0]) == expected
 
 
@@ -490,6 +751,202 @@ async def test_update_quota(database_connection, new_project):
     assert dict(response2) == expected
 
 
+@pytest.mark.asyncio
+async def test_get_available_quotas(database_connection, new_project):
+    collab = new_project["collab"]
+    project_id = new_project["context"]
+    quota_data = {"units": "bushels", "limit": 100.0, "usage": 0.0, "platform": "TestPlatform"}
+    await db.create_quota(project_id, quota_data)
+    # quotas in projects that have not been accepted are not available
+    available_quotas = await db.get_available_quotas(collab, "TestPlatform")
+    assert str(project_id) not in [str(quota["project_id"]) for quota in available_quotas]
+
+    await db.update_project(project_id, {"accepted": True, "decision_date": date.today()})
+    available_quotas = await db.get_available_quotas(collab, "TestPlatform")
+    expected = await db.query_quotas(project_id=project_id, platform="TestPlatform")
+    assert all(quota in available_quotas for quota in expected)
+
+    await db.debit_quotas(collab, "TestPlatform", 25.0)
+    available_quotas = await db.get_available_quotas(collab, "TestPlatform")
+    assert sum(quota["usage"] for quota in available_quotas) >= 25.0
+
+
+@pytest.mark.asyncio
+async def test_concurrent_quota_debits(database_connection, accepted_project):
+    # simulate many jobs for the same collab completing at the same time,
+    # and check that no usage is lost
+    collab = accepted_project["collab"]
+    project_id = accepted_project["context"]
+    quota_data = {"units": "bushels", "limit": 30.0, "usage": 0.0, "platform": "TestPlatform"}
+    quota1 = await db.create_quota(project_id, quota_data)
+    quota2 = await db.create_quota(project_id, dict(quota_data, limit=1000.0))
+
+    n_jobs = 100
+    await asyncio.gather(*(db.debit_quotas(collab, "TestPlatform", 0.5) for i in range(n_jobs)))
+    # concurrent debits may take the first quota over its limit, until compaction
+    quota1 = await db.get_quota(quota1["id"])
+    quota2 = await db.get_quota(quota2["id"])
+    assert quota1["usage"] + quota2["usage"] == n_jobs * 0.5
+    assert quota1["usage"] >= 30.0
+
+    await db.compact_quota_ledger()
+    assert (await db.get_quota(quota1["id"]))["usage"] == 30.0
+    assert (await db.get_quota(quota2["id"]))["usage"] == n_jobs * 0.5 - 30.0
+
+
+@pytest.mark.asyncio
+async def test_reserve_and_debit_quotas(database_connection, submitted_job, accepted_project):
+    collab = accepted_project["collab"]
+    project_id = accepted_project["context"]
+    quota_data = {"units": "bushels", "limit": 10.0, "usage": 0.0, "platform": "TestPlatform"}
+    quota = await db.create_quota(project_id, quota_data)
+
+    reservations = await db.reserve_quotas(submitted_job["id"], collab, "TestPlatform", 4.0)
+    assert reservations == {quota["id"]: 4.0}
+    quota = await db.get_quota(quota["id"])
+    assert (quota["usage"], quota["reserved"]) == (0.0, 4.0)
+
+    # actual usage replaces the reservation
+    await db.debit_quotas(collab, "TestPlatform", 3.0, job_id=submitted_job["id"])
+    quota = await db.get_quota(quota["id"])
+    assert (quota["usage"], quota["reserved"]) == (3.0, 0.0)
+
+
+@pytest.mark.asyncio
+async def test_concurrent_job_submissions(database_connection, accepted_project):
+    collab = accepted_project["collab"]
+    project_id = accepted_project["context"]
+    quota_data = {"units": "bushels", "limit": 3.0, "usage": 0.0, "platform": "TestPlatform"}
+    quota = await db.create_quota(project_id, quota_data)
+    job = {
+        "code": "import antigravity\n",
+        "command": None,
+        "collab_id": collab,
+        "hardware_platform": "TestPlatform",
+        "hardware_config": None,
+        "tags": [],
+    }
+
+    async def submit():
+        try:
+            return await db.submit_job(TEST_USER, job, 1.0)
+        except db.QuotaExceeded:
+            return None
+
+    # each submission sees the reservations of the others, so only three are accepted
+    results = await asyncio.gather(*(submit() for i in range(10)))
+    accepted_jobs = [result for result in results if result is not None]
+    assert len(accepted_jobs) == 3
+    assert (await db.get_quota(quota["id"]))["reserved"] == 3.0
+    # rejected submissions leave no job behind
+    assert len(await db.query_jobs(collab=[collab])) == 3
+
+
+@pytest.mark.asyncio
+async def test_quota_ledger_compaction(database_connection, accepted_project):
+    collab = accepted_project["collab"]
+    project_id = accepted_project["context"]
+    quota_data = {"units": "bushels", "limit": 10.0, "usage": 1.0, "platform": "TestPlatform"}
+    quota = await db.create_quota(project_id, quota_data)
+
+    await db.debit_quotas(collab, "TestPlatform", 2.0, session_id=42)
+    await db.debit_quotas(collab, "TestPlatform", 3.0)
+
+    # usage includes the uncompacted ledger entries
+    assert (await db.get_quota(quota["id"]))["usage"] == 6.0
+    ledger = await db.get_quota_ledger(quota["id"])
+    assert [entry["amount"] for entry in ledger] == [2.0, 3.0]
+    assert [entry["session_id"] for entry in ledger] == [42, None]
+    assert not any(entry["compacted"] for entry in ledger)
+
+    assert await db.compact_quota_ledger() >= 2
+    assert (await db.get_quota(quota["id"]))["usage"] == 6.0
+    ledger = await db.get_quota_ledger(quota["id"])
+    assert len(ledger) == 2
+    assert all(entry["compacted"] for entry in ledger)
+
+    # setting usage directly supersedes any uncompacted entries
+    await db.debit_quotas(collab, "TestPlatform", 1.0)
+    await db.update_quota(quota["id"], {"limit": 10.0, "usage": 5.0})
+    assert (await db.get_quota(quota["id"]))["usage"] == 5.0
+
+
+@pytest.mark.asyncio
+async def test_quota_ledger_compaction_corrects_over_allocation(
+    database_connection, mocker, accepted_project
+):
+    collab = accepted_project["collab"]
+    project_id = accepted_project["context"]
+    quota_data = {"units": "bushels", "limit": 10.0, "usage": 9.0, "platform": "TestPlatform"}
+    quota1 = await db.create_quota(project_id, quota_data)
+    quota2 = await db.create_quota(project_id, dict(quota_data, usage=0.0))
+
+    # two debits that ran at the same time, each seeing 1.0 left in the first quota
+    snapshot = await db.query_available_quotas(collab, "TestPlatform")
+    mocker.patch("simqueue.db.query_available_quotas", return_value=snapshot)
+    await db.debit_quotas(collab, "TestPlatform", 1.0)
+    await db.debit_quotas(collab, "TestPlatform", 1.0)
+    mocker.stopall()
+    assert (await db.get_quota(quota1["id"]))["usage"] == 11.0
+
+    await db.compact_quota_ledger()
+    assert (await db.get_quota(quota1["id"]))["usage"] == 10.0
+    assert (await db.get_quota(quota2["id"]))["usage"] == 1.0
+    ledger = await db.get_quota_ledger(quota2["id"])
+    assert [(entry["amount"], entry["compacted"]) for entry in ledger] == [(1.0, True)]
+
+
+@pytest.mark.asyncio
+async def test_concurrent_test_quota_provisioning(database_connection):
+    # simulate a new user submitting several jobs at once
+    collab = f"test-{uuid4().hex}"
+    results = await asyncio.gather(
+        *(utils.create_test_quota(collab, "Demo", TEST_USER) for i in range(5))
+    )
+    created = [result for result in results if result is not None]
+    assert len(created) == 1
+    project, quota = created[0]
+    assert project["accepted"] is True
+    assert quota["limit"] == 1.0
+
+    available_quotas = await db.query_available_quotas(collab, "Demo")
+    assert [q["id"] for q in available_quotas] == [quota["id"]]
+    await db.delete_project(project["context"])
+
+
+@pytest.mark.asyncio
+async def test_apply_quota_operations(database_connection, accepted_project):
+    project_id = str(accepted_project["context"])
+    quota_data = {"units": "bushels", "limit": 10.0, "usage": 3.0, "platform": "TestPlatform"}
+    quota = await db.create_quota(project_id, quota_data)
+    missing_project_id = str(uuid4())
+
+    operation = {"project_id": project_id, "units": "bushels", "usage": None}
+    results = await db.apply_quota_operations(
+        [
+            dict(operation, platform="TestPlatform", limit=20.0),
+            dict(operation, platform="Demo", limit=5.0),
+            dict(operation, platform="Demo", limit=6.0),
+            dict(operation, project_id=missing_project_id, platform="Demo", limit=5.0),
+        ]
+    )
+    assert [result["status"] for result in results] == ["updated", "created", "error", "error"]
+    assert results[0]["quota"]["id"] == quota["id"]
+    assert (results[0]["quota"]["limit"], results[0]["quota"]["usage"]) == (20.0, 3.0)
+    assert (results[1]["quota"]["limit"], results[1]["quota"]["usage"]) == (5.0, 0.0)
+    assert "Duplicate" in results[2]["detail"]
+    assert missing_project_id in results[3]["detail"]
+
+    quotas = await db.query_quotas(project_id=project_id)
+    assert sorted(q["platform"] for q in quotas) == ["Demo", "TestPlatform"]
+
+    results = await db.apply_quota_operations(
+        [dict(operation, platform="TestPlatform", limit=30.0, usage=1.0)]
+    )
+    assert results[0]["status"] == "updated"
+    assert (results[0]["quota"]["limit"], results[0]["quota"]["usage"]) == (30.0, 1.0)
+
+
 # ---- Test statistics access functions -------------------
 
 
@@ -520,3 +977,176 @@ async def test_get_users_list(database_connection):
 async def test_count_jobs(database_connection):
     count = await db.count_jobs(hardware_platform=["BrainScaleS"], status=["error", "finished"])
     assert count > 0
+
+
+# ---- Schema: migrations and indexes ---------------------
+
+
+@pytest.mark.asyncio
+async def test_migrations(database_connection, tmp_path):
+    # the test database is created with the latest schema
+    assert await db.database.fetch_val("SELECT count(*) FROM schema_migrations") == len(
+        migrate.list_migrations()
+    )
+    assert await migrate.migrate() == []
+
+    (tmp_path / "0001_already_applied.sql").write_text("SELECT 1/0;")
+    (tmp_path / "9999_new_table.sql").write_text(
+        "CREATE TABLE test_migration(id integer); INSERT INTO test_migration VALUES (42);"
+    )
+    async with db.database.transaction(force_rollback=True):
+        assert await migrate.migrate(directory=tmp_path) == ["9999"]
+        assert await db.database.fetch_val("SELECT id FROM test_migration") == 42
+        assert await migrate.migrate(directory=tmp_path) == []
+
+
+# the rows added to make the query planner's choices realistic,
+# with many users, collabs and tags, and few jobs waiting in the queue
+EXPLAIN_DATASET = """
+INSERT INTO simqueue_job
+    (code, command, collab_id, user_id, status, hardware_platform, timestamp_submission)
+    SELECT 'import pyNN', '', 'explain-collab-' || i % 300, 'explain-user-' || i % 1000,
+           CASE WHEN i % 500 = 0 THEN 'submitted' ELSE 'finished' END,
+           (ARRAY['SpiNNaker', 'BrainScaleS', 'BrainScaleS-2', 'Spikey', 'Demo'])[1 + i % 5],
+           now() - i * interval '1 minute'
+    FROM generate_series(1, 20000) i;
+INSERT INTO taggit_tag (name, slug)
+    SELECT 'explain-tag-' || i, 'explain-tag-' || i FROM generate_series(0, 999) i;
+INSERT INTO taggit_taggeditem (object_id, content_type_id, tag_id)
+    SELECT job.id, 1, tag.id FROM simqueue_job job JOIN taggit_tag tag
+        ON tag.name = 'explain-tag-' || job.id % 1000
+    WHERE job.user_id LIKE 'explain-user-%' AND job.id % 4 = 0;
+INSERT INTO quotas_project (context, collab, owner, title, abstract, description, accepted)
+    SELECT gen_random_uuid(), 'explain-collab-' || i % 2000, 'explain-user', 'Project', '', '', true
+    FROM generate_series(1, 5000) i;
+INSERT INTO quotas_quota (units, "limit", usage, platform, project_id)
+    SELECT 'hours', 100, 0, platform, context
+    FROM quotas_project, unnest(ARRAY['SpiNNaker', 'BrainScaleS']) platform
+    WHERE collab LIKE 'explain-collab-%';
+ANALYZE simqueue_job, taggit_tag, taggit_taggeditem, quotas_project, quotas_quota;
+"""
+
+
+def plan_nodes(plan):
+    yield plan
+    for subplan in plan.get("Plans", []):
+        yield from plan_nodes(subplan)
+
+
+@pytest.mark.asyncio
+async def test_hot_queries_use_indexes(database_connection, mocker):
+    async with db.database.transaction(force_rollback=True):
+        async with db.database.connection() as connection:
+            await connection.raw_connection.execute(EXPLAIN_DATASET)
+        project_id = await db.database.fetch_val(
+            "SELECT context FROM quotas_project WHERE collab = 'explain-collab-42' LIMIT 1"
+        )
+        tagged_job_id = await db.database.fetch_val(
+            "SELECT object_id FROM taggit_taggeditem ORDER BY object_id DESC LIMIT 1"
+        )
+
+        # for each hot query, the indexes that should be used, and the table that should not be
+        # scanned sequentially
+        hot_queries = [
+            (db.get_next_job("SpiNNaker"), "ix_simqueue_job_submitted", "simqueue_job"),
+            (
+                db.query_jobs(user_id=["explain-user-42"], exclude_removed=True),
+                "ix_simqueue_job_user_id_id",
+                "simqueue_job",
+            ),
+            (
+                db.query_jobs(collab=["explain-collab-42"], exclude_removed=True),
+                "ix_simqueue_job_collab_id_id",
+                "simqueue_job",
+            ),
+            (db.query_jobs(tags=["explain-tag-40"]), "ix_taggit_tag_name", "taggit_tag"),
+            (
+                db.query_jobs(tags=["explain-tag-40"]),
+                "ix_taggit_taggeditem_tag_id",
+                "taggit_taggeditem",
+            ),
+            (db.get_tags(tagged_job_id), "ix_taggit_taggeditem_object_id", "taggit_taggeditem"),
+            (db.query_quotas(project_id=project_id), "ix_quotas_quota_project_id", "quotas_quota"),
+            (
+                db.query_projects(collab=["explain-collab-42"]),
+                "ix_quotas_project_collab",
+                "quotas_project",
+            ),
+            (
+                db.query_available_quotas("explain-collab-42", "SpiNNaker"),
+                "ix_quotas_project_collab",
+                "quotas_project",
+            ),
+        ]
+        queries = []
+
+        def record_queries(method):
+            async def recording_method(query, *args, **kwargs):
+                sql = query.compile(
+                    dialect=postgresql.dialect(), compile_kwargs={"literal_binds": True}
+                )
+                queries.append((str(sql), []))
+                return await method(query, *args, **kwargs)
+
+            return recording_method
+
+        def record_cached_queries(method):
+            async def recording_method(cached_query, **values):
+                queries.append((cached_query.sql, cached_query._args(values)))
+                return await method(cached_query, **values)
+
+            return recording_method
+
+        for method_name in ("fetch_all", "fetch_one"):
+            method = getattr(db.database, method_name)
+            mocker.patch.object(db.database, method_name, side_effect=record_queries(method))
+            method = getattr(db.CachedQuery, method_name)
+            mocker.patch.object(db.CachedQuery, method_name, record_cached_queries(method))
+
+        for coroutine, index_name, table_name in hot_queries:
+            queries.clear()
+            await coroutine
+            # the first query made is the one of interest
+            sql, args = queries[0]
+            async with db.database.connection() as connection:
+                explanation = await connection.raw_connection.fetchval(
+                    f"EXPLAIN (FORMAT JSON) {sql}", *args
+                )
+            nodes = list(plan_nodes(json.loads(explanation)[0]["Plan"]))
+            assert index_name in [node.get("Index Name") for node in nodes], sql
+            assert table_name not in [
+                node.get("Relation Name") for node in nodes if node["Node Type"] == "Seq Scan"
+            ], sql
+
+
+@pytest.mark.asyncio
+async def test_database_pool(database_connection):
+    database = db.Database(db.SQLALCHEMY_DATABASE_URL, acquire_timeout=0.1, min_size=1, max_size=1)
+    await database.connect()
+    try:
+        assert database.pool_status()["max_size"] == 1
+
+        async def query():
+            return await database.fetch_val("SELECT 1")
+
+        async with database.connection():
+            # the only connection is in use, so a query from another task has to wait for it
+            status = database.pool_status()
+            assert status["in_use"] == 1
+            assert status["idle"] == 0
+            with pytest.raises(db.DatabaseBusy):
+                await asyncio.create_task(query())
+        assert await asyncio.create_task(query()) == 1
+        status = database.pool_status()
+        assert status["timeouts"] == 1
+        assert status["waiting"] == 0
+        assert status["max_wait_time"] >= 0.1
+    finally:
+        await database.disconnect()
+
+
+def test_ssl_options():
+    assert db.ssl_options("false") is False
+    assert db.ssl_options("True") is True
+    assert db.ssl_options("require") == "require"
+    assert db.ssl_options("verify-full") == "verify-full"
@@ -73,7 +73,7 @@ async def adequate_quota(database_connection):
     await db.delete_project(project_id)  # this also deletes the quota
 
 
-def fake_download(url):
+def fake_download(url, size_limit=None, repository_name=None):
     if "example.com" in str(url):
         fp = NamedTemporaryFile(delete=False, mode="w")
         fp.write('{"foo": "bar"}\n')
@@ -226,8 +226,15 @@ async def test_job_lifetime(database_connection, adequate_quota, mocker, provide
             },
             headers=user_auth,
         )
-        assert response8.status_code == 200
-        for item in response8.json()["files"]:
+        assert response8.status_code == 202
+        # the files are copied in a background task, which has completed by the time we get here
+        response8a = await client.get(response8.json()["resource_uri"], headers=user_auth)
+        assert response8a.status_code == 200
+        assert response8a.json()["status"] == "finished"
+        response8b = await client.get(
+            final_job["resource_uri"] + "/output_data", headers=user_auth
+        )
+        for item in response8b.json()["files"]:
             assert item["url"].startswith(f"https://{settings.EBRAINS_DRIVE_SERVICE_URL}")
 
     # user checks their quota
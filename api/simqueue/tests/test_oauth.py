@@ -1,6 +1,11 @@
+import asyncio
 import os
+from copy import deepcopy
 import pytest
-from simqueue.oauth import User
+from fastapi import HTTPException
+from fastapi.security import HTTPAuthorizationCredentials
+from simqueue.oauth import User, RequestContext
+import simqueue.oauth
 
 
 @pytest.fixture(scope="module")
@@ -64,3 +69,83 @@ def test_user_can_edit(fake_user_data):
     user = User(**fake_user_data)
     assert user.can_edit("neuromorphic-testing-private")
     assert not user.can_edit("some-other-collab")
+
+
+@pytest.mark.asyncio
+async def test_user_can_view_many(mocker, fake_user_data):
+    user_data = deepcopy(fake_user_data)
+    user_data["token"] = {"access_token": "notarealtoken", "token_type": "bearer"}
+    user = User(**user_data)
+
+    async def fake_get_collab_info(collab, token, client=None):
+        if collab == "does-not-exist":
+            raise ValueError("Invalid collab id")
+        return {"isPublic": collab == "documentation"}
+
+    mocker.patch("simqueue.oauth.get_collab_info", side_effect=fake_get_collab_info)
+    access = await user.can_view_many(
+        [
+            "neuromorphic-testing-private",
+            "documentation",
+            "someone-elses-collab",
+            "documentation",
+            "does-not-exist",
+        ]
+    )
+    assert access == {
+        "neuromorphic-testing-private": True,
+        "documentation": True,
+        "someone-elses-collab": False,
+        "does-not-exist": False,
+    }
+    # team memberships are resolved locally, and each remaining collab is looked up once
+    looked_up = sorted(call.args[0] for call in simqueue.oauth.get_collab_info.await_args_list)
+    assert looked_up == ["documentation", "does-not-exist", "someone-elses-collab"]
+
+    # results of previous look-ups are re-used
+    assert await user.can_view("documentation")
+    assert simqueue.oauth.get_collab_info.await_count == 3
+
+
+def test_user_role_index(fake_user_data):
+    user_data = deepcopy(fake_user_data)
+    user_data["roles"]["team"].append("collab-some-other-collab-editor")
+    user = User(**user_data)
+    assert user.is_admin
+    assert user.can_edit("some-other-collab")
+    assert not user.can_edit("some-other")
+    assert user.get_collabs(access=["viewer"]) == [
+        f"private-{user_data['preferred_username']}",
+        "some-other-collab",
+    ]
+    with pytest.raises(AttributeError):
+        user.roles = {}
+
+
+def test_user_without_team_roles():
+    user = User(preferred_username="busterkeaton", roles={"group": []})
+    assert not user.is_admin
+    assert user.get_collabs() == ["private-busterkeaton"]
+    assert user.can_edit("private-busterkeaton")
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("with_token", [True, False])
+async def test_failed_authentication_cancels_lookups(mocker, with_token):
+    async def invalid_token(token):
+        raise HTTPException(status_code=401, detail="Invalid token")
+
+    async def slow_lookup():
+        await asyncio.sleep(60)
+
+    mocker.patch("simqueue.oauth.User.from_token", side_effect=invalid_token)
+    if with_token:
+        context = RequestContext(
+            token=HTTPAuthorizationCredentials(scheme="Bearer", credentials="notarealtoken")
+        )
+    else:
+        context = RequestContext()
+    lookup = asyncio.ensure_future(slow_lookup())
+    with pytest.raises(HTTPException):
+        await context.authenticate(lookup)
+    assert lookup.cancelled()
@@ -1,9 +1,14 @@
 from datetime import date
+import asyncio
+import json
+import time
+import pytest
 from fastapi.testclient import TestClient
 from simqueue.main import app
 from simqueue.oauth import User
 from simqueue.data_models import JobStatus
 import simqueue.db
+from simqueue.resources.for_users import normalize_code
 
 client = TestClient(app)
 
@@ -25,6 +30,16 @@ class MockUser(User):
         return cls(**user_data)
 
 
+class MockCollabEditor(User):
+    # can edit the collab of the mock jobs, but did not submit them and is not an admin
+    @classmethod
+    async def from_token(cls, token):
+        return cls(
+            preferred_username="busterkeaton",
+            roles={"team": ["collab-neuromorphic-testing-private-editor"]},
+        )
+
+
 mock_jobs = [
     {
         "code": "import numpy",
@@ -138,6 +153,7 @@ def test_query_jobs(mocker):
         "size": size,
         "from_index": from_index,
         "tags": None,
+        "fields": None,
         "exclude_removed": True,
     }
     assert simqueue.db.query_jobs.await_args.kwargs == expected_args
@@ -170,22 +186,207 @@ def test_query_jobs_with_valid_filters(mocker):
         "size": size,
         "from_index": from_index,
         "tags": None,
+        "fields": None,
         "exclude_removed": True,
     }
     assert simqueue.db.query_jobs.await_args.kwargs == expected_args
 
 
+mock_job_without_output = dict(
+    mock_jobs[0], output_data_summary={"count": 0, "size": None, "url": None}
+)
+
+mock_output_data = [
+    {
+        "id": 1000 + i,
+        "url": f"https://example.com/job_999999/results{i}.txt",
+        "path": None,
+        "content_type": "text/plain",
+        "size": 42,
+        "hash": None,
+    }
+    for i in range(3)
+]
+
+mock_job_with_output = dict(
+    mock_jobs[0],
+    output_data_summary={"count": 3, "size": 126, "url": mock_output_data[0]["url"]},
+)
+
+
+def test_query_jobs_with_json_filters(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.query_jobs", return_value=mock_jobs)
+    response = client.get(
+        "/jobs/?hardware_config.wafer=62&hardware_config.label=%2262%22"
+        "&provenance.software.pyNN=0.10&provenance.software.nest=3.6&provenance.gpu=true",
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 200
+    kwargs = simqueue.db.query_jobs.await_args.kwargs
+    assert kwargs["hardware_config"] == {"wafer": 62, "label": "62"}
+    assert kwargs["provenance"] == {"software": {"pyNN": "0.10", "nest": 3.6}, "gpu": True}
+
+    response = client.get(
+        "/jobs/?hardware_config.wafer=62&hardware_config.wafer.id=3",
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 400
+
+
+def test_query_jobs_with_fields(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch(
+        "simqueue.db.query_jobs",
+        return_value=[{"id": 999999, "status": "finished", "tags": ["tag 1"]}],
+    )
+    response = client.get(
+        "/jobs/?fields=id&fields=status&fields=tags&fields=resource_uri",
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 200
+    assert simqueue.db.query_jobs.await_args.kwargs["fields"] == ["id", "status", "tags"]
+    assert response.json() == [
+        {"id": 999999, "status": "finished", "tags": ["tag 1"], "resource_uri": "/jobs/999999"}
+    ]
+
+    response = client.get(
+        "/jobs/?fields=id&fields=password", headers={"Authorization": "Bearer notarealtoken"}
+    )
+    assert response.status_code == 422
+
+
+def test_export_jobs(mocker):
+    async def mock_iterate_jobs(include=(), **filters):
+        for job in mock_jobs:
+            yield {
+                key: value
+                for key, value in job.items()
+                if key in include or key not in ("input_data", "output_data", "tags")
+            }
+
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.iterate_jobs", side_effect=mock_iterate_jobs)
+    response = client.get(
+        "/jobs/export?hardware_platform=SpiNNaker&expand=tags",
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    assert simqueue.db.iterate_jobs.call_args.kwargs["include"] == ["tags"]
+    assert simqueue.db.iterate_jobs.call_args.kwargs["hardware_platform"] == ["SpiNNaker"]
+    lines = response.text.splitlines()
+    assert len(lines) == len(mock_jobs)
+    job = json.loads(lines[0])
+    assert job["id"] == 999999
+    assert job["tags"] == ["tag 1"]
+    assert job["resource_uri"] == "/jobs/999999"
+    assert "input_data" not in job
+
+    response = client.get(
+        "/jobs/export?format=csv", headers={"Authorization": "Bearer notarealtoken"}
+    )
+    assert response.status_code == 200
+    header, row = response.text.splitlines()
+    assert header.startswith("id,")
+    assert "tags" not in header
+    assert row.startswith("999999,")
+
+
+def test_export_jobs_requires_admin(mocker):
+    class MockNonAdminUser(MockUser):
+        @classmethod
+        async def from_token(cls, token):
+            return cls(preferred_username="haroldlloyd", roles={"team": []})
+
+    mocker.patch("simqueue.oauth.User", MockNonAdminUser)
+    mocker.patch("simqueue.db.iterate_jobs")
+    response = client.get("/jobs/export", headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 403
+    assert simqueue.db.iterate_jobs.call_count == 0
+
+
+def test_get_database_pool_status(mocker):
+    pool_status = {
+        "size": 4,
+        "idle": 1,
+        "in_use": 3,
+        "min_size": 2,
+        "max_size": 10,
+        "waiting": 0,
+        "acquired": 1234,
+        "timeouts": 2,
+        "total_wait_time": 0.5,
+        "max_wait_time": 0.25,
+    }
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.database.pool_status", return_value=pool_status)
+    response = client.get("/database-pool", headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 200
+    assert response.json() == pool_status
+
+
+def test_get_database_pool_status_requires_admin(mocker):
+    class MockNonAdminUser(MockUser):
+        @classmethod
+        async def from_token(cls, token):
+            return cls(preferred_username="haroldlloyd", roles={"team": []})
+
+    mocker.patch("simqueue.oauth.User", MockNonAdminUser)
+    response = client.get("/database-pool", headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 403
+
+
 def test_get_job(mocker):
     mocker.patch("simqueue.oauth.User", MockUser)
-    mocker.patch("simqueue.db.get_job", return_value=mock_jobs[0])
+    mocker.patch("simqueue.db.get_job", return_value=mock_job_without_output)
     response = client.get("/jobs/999999", headers={"Authorization": "Bearer notarealtoken"})
     assert response.status_code == 200
     assert simqueue.db.get_job.await_args.args == (999999,)
+    assert simqueue.db.get_job.await_args.kwargs == {"output_data": False}
+    assert response.json()["output_data_summary"] == {"repository": None, "count": 0, "size": None}
+
+
+def test_get_job_database_busy(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.get_job", side_effect=simqueue.db.DatabaseBusy)
+    response = client.get("/jobs/999999", headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "5"
+
+
+def test_get_job_with_output_data(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch(
+        "simqueue.db.get_job", side_effect=lambda *args, **kwargs: dict(mock_job_with_output)
+    )
+    mocker.patch("simqueue.db.query_output_data", return_value=mock_output_data)
+    response = client.get("/jobs/999999", headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 200
+    assert len(response.json()["output_data"]["files"]) == 3
+    assert response.json()["output_data_summary"] == {
+        "repository": "Fake repository used for testing",
+        "count": 3,
+        "size": 126,
+    }
+
+    # for jobs with many output files, by default only the summary is included
+    mocker.patch("simqueue.settings.MAX_EMBEDDED_OUTPUT_FILES", 2)
+    response = client.get("/jobs/999999", headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 200
+    assert response.json()["output_data"] is None
+    assert response.json()["output_data_summary"]["count"] == 3
+    assert simqueue.db.query_output_data.await_count == 1
+
+    response = client.get(
+        "/jobs/999999?with_output_data=true", headers={"Authorization": "Bearer notarealtoken"}
+    )
+    assert len(response.json()["output_data"]["files"]) == 3
 
 
 def test_get_job_with_log_and_comments(mocker):
     mocker.patch("simqueue.oauth.User", MockUser)
-    mocker.patch("simqueue.db.get_job", return_value=mock_jobs[0])
+    mocker.patch("simqueue.db.get_job", return_value=mock_job_without_output)
     mocker.patch(
         "simqueue.db.get_comments",
         return_value=[
@@ -298,16 +499,18 @@ def test_get_log(mocker):
 
 def test_post_job(mocker):
     mocker.patch("simqueue.oauth.User", MockUser)
-    mocker.patch("simqueue.db.create_job", return_value=mock_accepted_job)
-    mocker.patch("simqueue.db.query_projects", return_value=[{"context": "xyz"}])
-    mocker.patch("simqueue.db.query_quotas", return_value=[{"usage": 0, "limit": 100}])
+    mocker.patch("simqueue.db.submit_job", return_value=mock_accepted_job)
+    mocker.patch(
+        "simqueue.db.get_available_quotas",
+        return_value=[{"usage": 0, "reserved": 0, "limit": 100}],
+    )
     response = client.post(
         "/jobs/", json=mock_submitted_job, headers={"Authorization": "Bearer notarealtoken"}
     )
     assert response.status_code == 201
-    assert simqueue.db.create_job.await_args.kwargs == {
-        "user_id": "haroldlloyd",
-        "job": {
+    assert simqueue.db.submit_job.await_args.args == (
+        "haroldlloyd",
+        {
             "code": mock_submitted_job["code"],
             "command": mock_submitted_job["command"],
             "collab_id": mock_submitted_job["collab"],
@@ -316,7 +519,21 @@ def test_post_job(mocker):
             "hardware_config": mock_submitted_job["hardware_config"],
             "tags": None,
         },
-    }
+        0.01,
+    )
+
+
+def test_post_job_without_quota(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.submit_job", side_effect=simqueue.db.QuotaExceeded)
+    mocker.patch(
+        "simqueue.db.get_available_quotas",
+        return_value=[{"usage": 100, "reserved": 0, "limit": 100}],
+    )
+    response = client.post(
+        "/jobs/", json=mock_submitted_job, headers={"Authorization": "Bearer notarealtoken"}
+    )
+    assert response.status_code == 403
 
 
 def test_put_job(mocker):
@@ -350,10 +567,22 @@ def test_delete_job_as_user(mocker):
     mocker.patch("simqueue.oauth.User", MockUser)
     mocker.patch("simqueue.db.get_job", return_value=mock_jobs[0])
     mocker.patch("simqueue.db.update_job", return_value=None)
+    mocker.patch("simqueue.db.release_reservations", return_value=None)
     response = client.delete("/jobs/999999", headers={"Authorization": "Bearer notarealtoken"})
     assert response.status_code == 200
     assert simqueue.db.get_job.await_args.args == (999999,)
     assert simqueue.db.update_job.await_args.args == (999999, {"status": "removed"})
+    assert simqueue.db.release_reservations.await_args.args == (999999,)
+
+
+def test_delete_job_as_collab_editor(mocker):
+    mocker.patch("simqueue.oauth.User", MockCollabEditor)
+    mocker.patch("simqueue.db.get_job", return_value=mock_jobs[0])
+    mocker.patch("simqueue.db.update_job", return_value=None)
+    mocker.patch("simqueue.db.release_reservations", return_value=None)
+    response = client.delete("/jobs/999999", headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 200
+    assert simqueue.db.update_job.await_args.args == (999999, {"status": "removed"})
 
 
 def test_add_comment(mocker):
@@ -403,3 +632,206 @@ def test_remove_comment(mocker):
     assert simqueue.db.get_job.await_args.args == (999999,)
     assert simqueue.db.get_comment.await_args.args == (42,)
     assert simqueue.db.delete_comment.await_args.args == (42,)
+
+
+def test_get_output_data(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.get_job", return_value=mock_job_with_output)
+    mocker.patch("simqueue.db.query_output_data", return_value=mock_output_data)
+    response = client.get(
+        "/jobs/999999/output_data", headers={"Authorization": "Bearer notarealtoken"}
+    )
+    assert response.status_code == 200
+    assert response.json()["repository"] == "Fake repository used for testing"
+    assert response.json()["files"][0]["path"] == "/job_999999/results0.txt"
+    assert response.json()["next_cursor"] is None
+    # the job is only retrieved from the database once per request
+    assert simqueue.db.get_job.await_count == 1
+
+
+def test_get_output_data_paginated(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.get_job", return_value=mock_job_with_output)
+    mocker.patch("simqueue.db.query_output_data", return_value=mock_output_data[1:3])
+    response = client.get(
+        "/jobs/999999/output_data?size=2&cursor=1000",
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 200
+    assert simqueue.db.query_output_data.await_args.kwargs == {"size": 2, "cursor": 1000}
+    assert len(response.json()["files"]) == 2
+    assert response.json()["next_cursor"] == 1002
+
+
+def test_get_output_data_ndjson(mocker):
+    async def mock_iterate_output_data(job_id):
+        for data_item in mock_output_data:
+            yield data_item
+
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.get_job", return_value=mock_job_with_output)
+    mocker.patch("simqueue.db.iterate_output_data", mock_iterate_output_data)
+    response = client.get(
+        "/jobs/999999/output_data",
+        headers={"Authorization": "Bearer notarealtoken", "Accept": "application/x-ndjson"},
+    )
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "application/x-ndjson"
+    lines = response.text.splitlines()
+    assert len(lines) == 3
+    assert json.loads(lines[2])["path"] == "/job_999999/results2.txt"
+
+
+mock_transfer = {
+    "id": 42,
+    "job_id": 999999,
+    "user_id": "haroldlloyd",
+    "repository": "Fake repository used for testing",
+    "status": "queued",
+    "n_files": 1,
+    "n_copied": 0,
+    "error": None,
+    "timestamp_start": "2022-10-11T02:50:23.746231+00:00",
+    "timestamp_end": None,
+}
+
+
+def test_update_output_data(mocker):
+    job_with_output = dict(
+        mock_jobs[0],
+        output_data=[
+            {
+                "id": 1001,
+                "url": "https://demo.hbpneuromorphic.eu/data/my_collab/job_999999/results.txt",
+                "path": None,
+                "content_type": "text/plain",
+                "size": 42,
+                "hash": None,
+            }
+        ],
+    )
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.get_job", return_value=job_with_output)
+    mocker.patch("simqueue.db.create_data_transfer", return_value=(mock_transfer, True))
+    mocker.patch("simqueue.utils.transfer_output_data")
+    response = client.put(
+        "/jobs/999999/output_data",
+        json={"repository": "Fake repository used for testing", "files": []},
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 202
+    assert response.json()["resource_uri"] == "/jobs/999999/output_data/transfers/42"
+    assert simqueue.db.create_data_transfer.await_args.args == (
+        999999,
+        "haroldlloyd",
+        "Fake repository used for testing",
+        1,
+    )
+    # the files are copied in a background task
+    assert simqueue.utils.transfer_output_data.call_args.args[:3] == (
+        42,
+        job_with_output,
+        "Fake repository used for testing",
+    )
+
+    # if a transfer is already in progress, we don't start another one
+    mocker.patch("simqueue.db.create_data_transfer", return_value=(mock_transfer, False))
+    mocker.patch("simqueue.utils.transfer_output_data")
+    response = client.put(
+        "/jobs/999999/output_data",
+        json={"repository": "Fake repository used for testing", "files": []},
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 202
+    assert response.json()["resource_uri"] == "/jobs/999999/output_data/transfers/42"
+    assert simqueue.utils.transfer_output_data.call_count == 0
+
+
+def test_update_output_data_as_collab_editor(mocker):
+    mocker.patch("simqueue.oauth.User", MockCollabEditor)
+    job_with_output = dict(
+        mock_jobs[0],
+        output_data=[
+            {
+                "id": 1001,
+                "url": "https://demo.hbpneuromorphic.eu/data/my_collab/job_999999/results.txt",
+                "path": None,
+                "content_type": "text/plain",
+                "size": 42,
+                "hash": None,
+            }
+        ],
+    )
+    mocker.patch("simqueue.db.get_job", return_value=job_with_output)
+    mocker.patch("simqueue.db.create_data_transfer", return_value=(mock_transfer, True))
+    mocker.patch("simqueue.utils.transfer_output_data")
+    response = client.put(
+        "/jobs/999999/output_data",
+        json={"repository": "Fake repository used for testing", "files": []},
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 202
+    assert simqueue.db.create_data_transfer.await_args.args == (
+        999999,
+        "busterkeaton",
+        "Fake repository used for testing",
+        1,
+    )
+
+
+def test_get_output_data_transfer(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.get_job", return_value=mock_jobs[0])
+    mocker.patch(
+        "simqueue.db.get_data_transfer", return_value=dict(mock_transfer, status="running")
+    )
+    response = client.get(
+        "/jobs/999999/output_data/transfers/42",
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 200
+    assert response.json()["status"] == "running"
+    assert simqueue.db.get_data_transfer.await_args.args == (42,)
+
+    # transfer belonging to a different job
+    response = client.get(
+        "/jobs/999998/output_data/transfers/42",
+        headers={"Authorization": "Bearer notarealtoken"},
+    )
+    assert response.status_code == 404
+
+
+def test_query_jobs_with_invalid_api_key(mocker):
+    mocker.patch("simqueue.db.get_provider", return_value=None)
+    mocker.patch("simqueue.db.query_jobs", return_value=mock_jobs)
+    response = client.get("/jobs/", headers={"x-api-key": "notarealapikey"})
+    assert response.status_code == 403
+    assert simqueue.db.query_jobs.await_count == 0
+
+
+@pytest.mark.asyncio
+async def test_normalize_code_shares_preparation(mocker):
+    def slow_get_download_url(drive_uri, user):
+        time.sleep(0.1)
+        return f"https://example.com/tmp_download/{user.username}.zip"
+
+    mocker.patch(
+        "simqueue.data_repositories.EBRAINSDrive.get_download_url",
+        side_effect=slow_get_download_url,
+    )
+    user1 = User(preferred_username="haroldlloyd")
+    user2 = User(preferred_username="charliechaplin")
+    code = "drive://neuromorphic-testing-private/my_model"
+    results = await asyncio.gather(
+        *(normalize_code(code, "neuromorphic-testing-private", user1) for i in range(5)),
+        normalize_code(code, "neuromorphic-testing-private", user2),
+    )
+    assert results == ["https://example.com/tmp_download/haroldlloyd.zip"] * 5 + [
+        "https://example.com/tmp_download/charliechaplin.zip"
+    ]
+    # concurrent submissions by the same user share one preparation
+    assert simqueue.data_repositories.EBRAINSDrive.get_download_url.call_count == 2
+
+    assert await normalize_code("import pyNN", "neuromorphic-testing-private", user1) == (
+        "import pyNN"
+    )
@@ -520,6 +520,7 @@ def test_query_quotas(mocker):
             "platform": "TestPlatform",
             "limit": 5000,
             "usage": 42,
+            "reserved": 0.0,
             "units": "bushels",
             "project_id": project_id,
         },
@@ -528,6 +529,7 @@ def test_query_quotas(mocker):
             "platform": "BrainScaleS",
             "limit": 0.1,
             "usage": 0.00123,
+            "reserved": 0.01,
             "units": "wafer-hours",
             "project_id": project_id,
         },
@@ -555,6 +557,7 @@ def test_get_quota(mocker):
         "platform": "TestPlatform",
         "limit": 5000,
         "usage": 42,
+        "reserved": 0.0,
         "units": "bushels",
         "project_id": project_id,
     }
@@ -641,3 +644,63 @@ def test_remove_quota_as_admin_user(mocker):
         headers={"Authorization": "Bearer notarealtoken"},
     )
     assert response.status_code == 200
+
+
+def test_create_or_update_quotas(mocker):
+    project_ids = ["b52ebde9-116b-4419-894a-5f330ec3b484", "ff4e494f-6f44-47c6-9a85-7091ff788b17"]
+    operations = [
+        {"project_id": project_ids[0], "platform": "TestPlatform", "limit": 100.0},
+        {"project_id": project_ids[1], "platform": "TestPlatform", "limit": 50.0, "usage": 2.0},
+        {"project_id": project_ids[1], "platform": "NoSuchPlatform", "limit": 50.0},
+    ]
+    mock_quota = {
+        "id": 999,
+        "project_id": project_ids[1],
+        "platform": "TestPlatform",
+        "units": "bushels",
+        "limit": 50.0,
+        "usage": 2.0,
+        "reserved": 0.0,
+    }
+    mocker.patch("simqueue.oauth.User", MockUserAdmin)
+    mocker.patch(
+        "simqueue.db.apply_quota_operations",
+        return_value=[
+            {"status": "error", "detail": f"There is no project with id {project_ids[0]}"},
+            {"status": "updated", "quota": mock_quota},
+        ],
+    )
+    response = client.post(
+        "/quotas/", json=operations, headers={"Authorization": "Bearer notarealtoken"}
+    )
+    assert response.status_code == 200
+    assert simqueue.db.apply_quota_operations.await_args.args == (
+        [
+            {
+                "project_id": project_ids[0],
+                "platform": "TestPlatform",
+                "units": "bushels",
+                "limit": 100.0,
+                "usage": None,
+            },
+            {
+                "project_id": project_ids[1],
+                "platform": "TestPlatform",
+                "units": "bushels",
+                "limit": 50.0,
+                "usage": 2.0,
+            },
+        ],
+    )
+    results = response.json()
+    assert [result["status"] for result in results] == ["error", "updated", "error"]
+    assert results[1]["quota"]["resource_uri"] == f"/projects/{project_ids[1]}/quotas/999"
+    assert results[2]["detail"] == "Unknown platform: NoSuchPlatform"
+
+
+def test_create_or_update_quotas_as_normal_user(mocker):
+    mocker.patch("simqueue.oauth.User", MockUser)
+    mocker.patch("simqueue.db.apply_quota_operations")
+    response = client.post("/quotas/", json=[], headers={"Authorization": "Bearer notarealtoken"})
+    assert response.status_code == 404
+    assert simqueue.db.apply_quota_operations.await_count == 0
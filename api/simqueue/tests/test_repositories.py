@@ -1,14 +1,20 @@
 import os
+import time
+from contextlib import contextmanager
 from datetime import datetime
-import urllib.request
 import requests
 import pytest
+import simqueue.data_repositories
 from simqueue.data_models import DataItem
 from simqueue.data_repositories import (
     EBRAINSDrive,
     EBRAINSBucket,
     SourceFileDoesNotExist,
     SourceFileIsTooBig,
+    ArchiveCache,
+    DriveCache,
+    download_file_to_tmp_dir,
+    drive_mkdir_p,
 )
 
 
@@ -24,8 +30,212 @@ def mock_user():
         return MockUser
 
 
-def fake_urlretrieve(url):
-    raise urllib.request.HTTPError(url=url, code=404, msg="Not Found")
+class MockStreamingResponse:
+    reason_phrase = "OK"
+
+    def __init__(self, content, status_code=200, headers=None):
+        self.content = content
+        self.status_code = status_code
+        self.headers = headers or {}
+        self.bytes_read = 0
+
+    def raise_for_status(self):
+        pass
+
+    def iter_bytes(self, chunk_size):
+        for i in range(0, len(self.content), chunk_size):
+            self.bytes_read += chunk_size
+            yield self.content[i : i + chunk_size]
+
+
+def mock_stream(response):
+    @contextmanager
+    def stream(method, url, **kwargs):
+        yield response
+
+    return stream
+
+
+def test_download_file_to_tmp_dir(mocker):
+    response = MockStreamingResponse(b"x" * 3000, headers={"Content-Length": "3000"})
+    mocker.patch("httpx.stream", mock_stream(response))
+    local_path = download_file_to_tmp_dir("https://example.com/data.bin", size_limit=1.0)
+    with open(local_path, "rb") as fp:
+        assert fp.read() == response.content
+    os.remove(local_path)
+
+
+def test_download_file_too_large(mocker):
+    # with Content-Length, the size is checked before any content is read
+    response = MockStreamingResponse(b"x" * 3000, headers={"Content-Length": "3000"})
+    mocker.patch("httpx.stream", mock_stream(response))
+    with pytest.raises(SourceFileIsTooBig):
+        download_file_to_tmp_dir("https://example.com/data.bin", size_limit=2000 / 1024**3)
+    assert response.bytes_read == 0
+
+    # without Content-Length, the size is checked as the content is read
+    response = MockStreamingResponse(b"x" * 3_000_000)
+    mocker.patch("httpx.stream", mock_stream(response))
+    with pytest.raises(SourceFileIsTooBig):
+        download_file_to_tmp_dir("https://example.com/data.bin", size_limit=2_000_000 / 1024**3)
+
+
+def test_download_file_gone(mocker):
+    response = MockStreamingResponse(b"", status_code=404)
+    mocker.patch("httpx.stream", mock_stream(response))
+    with pytest.raises(SourceFileDoesNotExist):
+        download_file_to_tmp_dir("https://example.com/data.bin")
+
+
+class MockDriveDir:
+    def __init__(self, repo, path):
+        self.repo = repo
+        self.path = path
+        self.name = path.split("/")[-1]
+        self.subdirs = []
+
+    def ls(self, entity_type=None, force_refresh=True):
+        self.repo.n_requests += 1
+        return self.subdirs
+
+    def mkdir(self, name):
+        self.repo.n_requests += 1
+        subdir = MockDriveDir(self.repo, f"{self.path.rstrip('/')}/{name}")
+        self.subdirs.append(subdir)
+        return subdir
+
+
+class MockDriveRepo:
+    id = "abc123"
+
+    def __init__(self):
+        self.n_requests = 0
+        self.root_dir = MockDriveDir(self, "/")
+
+    def get_dir(self, path):
+        self.n_requests += 1
+        return self.root_dir
+
+
+def test_drive_mkdir_p_with_cache():
+    repo = MockDriveRepo()
+    listings = {}
+    dir_obj = drive_mkdir_p(repo.root_dir, "job_42/figures", listings)
+    assert dir_obj.path == "/job_42/figures"
+    n_requests = repo.n_requests  # two listings and two mkdirs
+    assert n_requests == 4
+
+    # directories that are already known are neither listed nor created again
+    dir_obj2 = drive_mkdir_p(repo.root_dir, "job_42/figures", listings)
+    assert dir_obj2 is dir_obj
+    assert repo.n_requests == n_requests
+    dir_obj3 = drive_mkdir_p(repo.root_dir, "job_42/data", listings)
+    assert dir_obj3.path == "/job_42/data"
+    assert repo.n_requests == n_requests + 1
+
+    assert drive_mkdir_p(repo.root_dir, "") is repo.root_dir
+
+
+def test_drive_cache(mocker):
+    repo = MockDriveRepo()
+    client = mocker.MagicMock()
+    client.repos.get_repos_by_filter.return_value = [repo]
+    cache = DriveCache(client, ttl=60)
+    assert cache.get_repo("my-collab") is repo
+    assert cache.get_repo("my-collab") is repo
+    assert client.repos.get_repos_by_filter.call_count == 1
+
+    cache.mkdir_p(repo, "job_42/figures")
+    n_requests = repo.n_requests
+    cache.mkdir_p(repo, "job_42/figures")
+    assert repo.n_requests == n_requests
+    assert not cache.expired
+
+
+def test_bucket_copy_existing_file(mocker):
+    class MockUserWithToken:
+        token = {"access_token": "notarealtoken"}
+
+    client = mocker.MagicMock()
+    mocker.patch.object(EBRAINSBucket, "_get_client", return_value=client)
+    mocker.patch("simqueue.data_repositories.open_source_file")
+    bucket = client.buckets.get_bucket.return_value
+    file = DataItem(
+        url="https://example.com/job_42/results.txt",
+        path="my-collab/job_42/results.txt",
+        content_type="text/plain",
+        size=48,
+    )
+    url = EBRAINSBucket.copy(file, MockUserWithToken)
+    assert url == f"https://{EBRAINSBucket.host}/api/v1/buckets/my-collab/job_42/results.txt"
+    assert client.buckets.get_bucket.call_args.args == ("my-collab",)
+    # the file already exists, so there is no need to download it again
+    assert bucket.get_file.call_args.args == ("/job_42/results.txt",)
+    assert bucket.ls.call_count == 0
+    assert simqueue.data_repositories.open_source_file.call_count == 0
+
+
+def write_bytes(n_bytes):
+    def write(path):
+        with open(path, "wb") as fp:
+            fp.write(b"x" * n_bytes)
+
+    return write
+
+
+def test_archive_cache(tmp_path):
+    cache = ArchiveCache(str(tmp_path), max_size=250)
+    assert cache.get("a-1.zip") is None
+    path = cache.add("a-1.zip", write_bytes(100))
+    assert cache.get("a-1.zip") == path
+    assert os.path.getsize(path) == 100
+
+    # a new version does not replace the old one, which may still be needed by a queued job
+    cache.add("a-2.zip", write_bytes(100))
+    assert cache.get("a-1.zip") is not None
+    assert not cache.is_full()
+
+    # least recently used archives are removed when the cache is full,
+    # except for those still in use
+    cache.get("a-1.zip")
+    cache.add("b-1.zip", write_bytes(100))
+    assert cache.is_full()
+    cache.evict(in_use={"a-2.zip"})
+    assert cache.get("a-2.zip") is not None
+    assert cache.get("a-1.zip") is None
+    assert cache.get("b-1.zip") is not None
+    assert not cache.is_full()
+
+    # a cache created later, e.g. by another process, finds the existing archives
+    cache2 = ArchiveCache(str(tmp_path), max_size=250)
+    assert cache2.get("b-1.zip") is not None
+
+
+def test_archive_cache_grace_period(tmp_path):
+    cache = ArchiveCache(str(tmp_path), max_size=150, grace_period=60)
+    cache.add("a-1.zip", write_bytes(100))
+    cache.add("b-1.zip", write_bytes(100))
+    # recently used archives are kept, even if the cache is full
+    cache.evict()
+    assert cache.get("a-1.zip") is not None
+    one_hour_ago = time.time() - 3600
+    os.utime(os.path.join(tmp_path, "a-1.zip"), (one_hour_ago, one_hour_ago))
+    cache.evict()
+    assert cache.get("a-1.zip") is None
+    assert cache.get("b-1.zip") is not None
+
+
+def test_archive_cache_failed_write(tmp_path):
+    def write_and_fail(path):
+        write_bytes(100)(path)
+        raise IOError("connection lost")
+
+    cache = ArchiveCache(str(tmp_path), max_size=250)
+    with pytest.raises(IOError):
+        cache.add("a-1.zip", write_and_fail)
+    # neither the partly-written archive nor the temporary file are left behind
+    assert cache.get("a-1.zip") is None
+    assert os.listdir(tmp_path) == []
 
 
 class TestDrive:
@@ -57,7 +267,6 @@ class TestDrive:
         )
 
     def test_copy_file_gone(self, mocker, mock_user):
-        mocker.patch("urllib.request.urlretrieve", fake_urlretrieve)
         repo = EBRAINSDrive
         file = DataItem(
             url="http://example.com/this_file_does_not_exist.md",
@@ -69,9 +278,8 @@ class TestDrive:
             result = repo.copy(file, mock_user)
 
     def test_copy_file_too_large(self, mocker, mock_user):
-        mocker.patch(
-            "simqueue.data_repositories.get_file_size", return_value=EBRAINSDrive.size_limit * 2
-        )
+        # the file is 48 bytes
+        mocker.patch.object(EBRAINSDrive, "size_limit", 40 / 1024**3)
         repo = EBRAINSDrive
         file = DataItem(
             url="https://drive.ebrains.eu/f/22862ad196dc4f5b9d4c/?dl=1",
@@ -1,4 +1,5 @@
 import pytest
+from fastapi import HTTPException
 
 from .. import utils
 from ..data_models import ResourceUsage
@@ -8,9 +9,9 @@ import simqueue.db
 @pytest.fixture()
 def mock_quotas():
     return [
-        {"limit": 100, "usage": 100, "id": 101},
-        {"limit": 50, "usage": 49, "id": 102},
-        {"limit": 1000, "usage": 0, "id": 103},
+        {"limit": 100, "usage": 100, "reserved": 0, "id": 101},
+        {"limit": 50, "usage": 49, "reserved": 0, "id": 102},
+        {"limit": 1000, "usage": 0, "reserved": 0, "id": 103},
     ]
 
 
@@ -24,31 +25,145 @@ async def test_check_quotas(mocker, mock_quotas):
 
 
 @pytest.mark.asyncio
-async def test_update_quotas_1(mocker, mock_quotas):
+async def test_check_quotas_with_reservations(mocker, mock_quotas):
+    mock_quotas[1]["reserved"] = 1
+    mock_quotas[2]["reserved"] = 1000
     mocker.patch("simqueue.utils.get_available_quotas", return_value=mock_quotas)
-    mocker.patch("simqueue.db.update_quota")
+    assert await utils.check_quotas("some-collab", "TestPlatform") is False
 
-    await utils.update_quotas(
-        "some-collab", "TestPlatform", ResourceUsage(units="bushels", value=1)
-    )
-    assert simqueue.db.update_quota.await_args_list[0].args == (
-        102,
-        {"limit": 50, "usage": 50, "id": 102},
+
+def test_estimate_resource_usage():
+    assert utils.estimate_resource_usage("TestPlatform") == 1.0
+    assert (
+        utils.estimate_resource_usage("TestPlatform", ResourceUsage(units="bushels", value=3))
+        == 3
     )
+    with pytest.raises(HTTPException):
+        utils.estimate_resource_usage("TestPlatform", ResourceUsage(units="litres", value=3))
+
+
+def test_allocate_usage_1(mock_quotas):
+    assert simqueue.db.allocate_usage(mock_quotas, 1) == {102: 50}
+
+
+def test_allocate_usage_2(mock_quotas):
+    assert simqueue.db.allocate_usage(mock_quotas, 2) == {102: 50, 103: 1}
 
 
 @pytest.mark.asyncio
-async def test_update_quotas_2(mocker, mock_quotas):
-    mocker.patch("simqueue.utils.get_available_quotas", return_value=mock_quotas)
-    mocker.patch("simqueue.db.update_quota")
+async def test_update_quotas(mocker):
+    mocker.patch("simqueue.db.debit_quotas")
     await utils.update_quotas(
         "some-collab", "TestPlatform", ResourceUsage(units="bushels", value=2)
     )
-    assert simqueue.db.update_quota.await_args_list[0].args == (
-        102,
-        {"limit": 50, "usage": 50, "id": 102},
-    )
-    assert simqueue.db.update_quota.await_args_list[1].args == (
-        103,
-        {"limit": 1000, "usage": 1, "id": 103},
-    )
+    assert simqueue.db.debit_quotas.await_args.args == ("some-collab", "TestPlatform", 2)
+
+
+@pytest.mark.asyncio
+async def test_update_quotas_wrong_units(mocker):
+    mocker.patch("simqueue.db.debit_quotas")
+    with pytest.raises(HTTPException):
+        await utils.update_quotas(
+            "some-collab", "TestPlatform", ResourceUsage(units="litres", value=2)
+        )
+    assert simqueue.db.debit_quotas.await_count == 0
+
+
+@pytest.mark.asyncio
+async def test_available_quotas_cache(mocker, mock_quotas):
+    mocker.patch("simqueue.db.query_available_quotas", return_value=mock_quotas)
+    simqueue.db.invalidate_quota_cache()
+
+    assert await utils.get_available_quotas("some-collab", "TestPlatform") == mock_quotas
+    assert await utils.get_available_quotas("some-collab", "TestPlatform") == mock_quotas
+    assert simqueue.db.query_available_quotas.await_count == 1
+
+    await utils.get_available_quotas("some-other-collab", "TestPlatform")
+    assert simqueue.db.query_available_quotas.await_count == 2
+
+    simqueue.db.invalidate_quota_cache("some-collab", "TestPlatform")
+    await utils.get_available_quotas("some-collab", "TestPlatform")
+    await utils.get_available_quotas("some-other-collab", "TestPlatform")
+    assert simqueue.db.query_available_quotas.await_count == 3
+
+    simqueue.db.invalidate_quota_cache()
+
+
+@pytest.mark.asyncio
+async def test_available_quotas_cache_invalidated_during_query(mocker, mock_quotas):
+    simqueue.db.invalidate_quota_cache()
+
+    async def query_then_invalidate(collab, platform):
+        # the quotas change while the query is in progress
+        simqueue.db.invalidate_quota_cache(collab, platform)
+        return mock_quotas
+
+    mocker.patch("simqueue.db.query_available_quotas", side_effect=query_then_invalidate)
+    assert await utils.get_available_quotas("some-collab", "TestPlatform") == mock_quotas
+    # the result of the earlier query was not cached
+    await utils.get_available_quotas("some-collab", "TestPlatform")
+    assert simqueue.db.query_available_quotas.await_count == 2
+
+    simqueue.db.invalidate_quota_cache()
+
+
+@pytest.mark.asyncio
+async def test_available_quotas_cache_size(mocker, mock_quotas):
+    mocker.patch("simqueue.db.query_available_quotas", return_value=mock_quotas)
+    mocker.patch("simqueue.settings.QUOTA_CACHE_MAX_ENTRIES", 3)
+    simqueue.db.invalidate_quota_cache()
+
+    for collab in ("collab-a", "collab-b", "collab-c", "collab-d"):
+        await utils.get_available_quotas(collab, "TestPlatform")
+    # the oldest entry was removed to make room
+    assert set(simqueue.db._available_quotas_cache) == {
+        ("collab-b", "TestPlatform"),
+        ("collab-c", "TestPlatform"),
+        ("collab-d", "TestPlatform"),
+    }
+
+    simqueue.db.invalidate_quota_cache()
+
+
+@pytest.mark.asyncio
+async def test_transfer_output_data(mocker):
+    job = {
+        "id": 999999,
+        "collab_id": "some-collab",
+        "output_data": [
+            {
+                "id": 1001,
+                "url": "https://demo.hbpneuromorphic.eu/data/some-collab/job_999999/results.txt",
+                "path": "job_999999/results.txt",
+                "content_type": "text/plain",
+                "size": 42,
+                "hash": None,
+            },
+            {
+                # already copied in an earlier transfer
+                "id": 1002,
+                "url": "https://example.com/job_999999/log.txt",
+                "path": "job_999999/log.txt",
+                "content_type": "text/plain",
+                "size": 42,
+                "hash": None,
+            },
+        ],
+    }
+    mocker.patch("simqueue.db.update_data_transfer")
+    mocker.patch("simqueue.db.record_file_transferred")
+    await utils.transfer_output_data(42, job, "Fake repository used for testing", None)
+    calls = [call.args for call in simqueue.db.record_file_transferred.await_args_list]
+    assert sorted(calls, key=len) == [
+        (42,),
+        (
+            42,
+            1001,
+            {
+                "url": "https://example.com/job_999999/results.txt",
+                "path": "job_999999/results.txt",
+            },
+        ),
+    ]
+    assert simqueue.db.update_data_transfer.await_args_list[0].args == (42, {"status": "running"})
+    assert simqueue.db.update_data_transfer.await_args.args[1]["status"] == "finished"
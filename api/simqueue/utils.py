@@ -1,26 +1,34 @@
+import asyncio
 from datetime import date
+from functools import partial
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
+import json
 import logging
 import smtplib
 
 from fastapi import HTTPException, status as status_codes
 
-from .data_models import ProjectStatus, ResourceUsage
+from .data_models import ResourceUsage, DataSet
+from .data_repositories import (
+    repository_lookup_by_name,
+    transfer_executor,
+    archive_cache,
+    code_archive_executor,
+)
 from . import db, settings
-from .globals import RESOURCE_USAGE_UNITS, PROVIDER_QUEUE_NAMES, DEMO_QUOTA_SIZES
+from .globals import (
+    RESOURCE_USAGE_UNITS,
+    PROVIDER_QUEUE_NAMES,
+    DEMO_QUOTA_SIZES,
+    DEFAULT_RESOURCE_USAGE_ESTIMATES,
+)
 
 logger = logging.getLogger("simqueue")
 
 
 async def get_available_quotas(collab, hardware_platform):
-    available_projects = await db.query_projects(collab=[collab], status=ProjectStatus.accepted)
-    available_quotas = []
-    for project in available_projects:
-        available_quotas.extend(
-            await db.query_quotas(project["context"], platform=hardware_platform, size=100)
-        )
-    return available_quotas
+    return await db.get_available_quotas(collab, hardware_platform)
 
 
 async def check_quotas(collab: str, hardware_platform: str, user: str = None):
@@ -36,7 +44,8 @@ async def check_quotas(collab: str, hardware_platform: str, user: str = None):
         await create_test_quota(collab, hardware_platform, user)
         return True
     for quota in available_quotas:
-        if quota["usage"] < quota["limit"]:
+        # quota reserved by queued jobs is not available
+        if quota["usage"] + quota["reserved"] < quota["limit"]:
             return True
     logger.info(
         f"No quota available for user {user} on {hardware_platform}. collab={collab}, available quotas: {available_quotas}"
@@ -44,28 +53,146 @@ async def check_quotas(collab: str, hardware_platform: str, user: str = None):
     return False
 
 
-async def update_quotas(collab: str, hardware_platform: str, resource_usage: ResourceUsage):
+async def submit_job(user_id: str, job: dict, estimate: float):
+    """
+    Create a job, if its collab has quota available for its platform,
+    reserving the estimated resource usage.
+
+    If the collab has never had a quota for the platform, a test/demo quota is created first.
+    Returns None, without creating the job, if there is no quota available.
+    """
+    collab, hardware_platform = job["collab_id"], job["hardware_platform"]
+    if hardware_platform in DEMO_QUOTA_SIZES:
+        if len(await get_available_quotas(collab, hardware_platform)) == 0:
+            await create_test_quota(collab, hardware_platform, user_id)
+    try:
+        return await db.submit_job(user_id, job, estimate)
+    except db.QuotaExceeded:
+        logger.info(
+            f"No quota available for user {user_id} on {hardware_platform}. collab={collab}"
+        )
+        return None
+
+
+def check_resource_usage_units(hardware_platform: str, resource_usage: ResourceUsage):
     if resource_usage.units != RESOURCE_USAGE_UNITS[hardware_platform]:
         raise HTTPException(
             status_code=status_codes.HTTP_400_BAD_REQUEST,
             detail=f"Invalid units ({resource_usage.units}) for resource usage. Expected units: {RESOURCE_USAGE_UNITS[hardware_platform]}",
         )
-    available_quotas = await get_available_quotas(collab, hardware_platform)
-    usage = resource_usage.value
-    quotas_to_update = []
-    for quota in available_quotas:
-        remaining = quota["limit"] - quota["usage"]
-        if remaining > 0:
-            if usage <= remaining:
-                quota["usage"] += usage
-                quotas_to_update.append(quota)
-                break
-            else:
-                quota["usage"] = quota["limit"]
-                quotas_to_update.append(quota)
-                usage -= remaining
-    for quota in quotas_to_update:
-        await db.update_quota(quota["id"], quota)
+
+
+def estimate_resource_usage(hardware_platform: str, estimate: ResourceUsage = None) -> float:
+    """
+    Return the amount of quota to reserve for a job: the user's estimate if provided,
+    otherwise the default for the platform.
+    """
+    if estimate is not None:
+        check_resource_usage_units(hardware_platform, estimate)
+        return max(estimate.value, 0.0)
+    return DEFAULT_RESOURCE_USAGE_ESTIMATES.get(hardware_platform, 0.0)
+
+
+async def update_quotas(
+    collab: str,
+    hardware_platform: str,
+    resource_usage: ResourceUsage,
+    job_id: int = None,
+    session_id: int = None,
+):
+    """
+    Debit the resources used by a job or session from the collab's quotas.
+    If `job_id` is given, the quota reserved when the job was submitted is released.
+    """
+    check_resource_usage_units(hardware_platform, resource_usage)
+    await db.debit_quotas(
+        collab, hardware_platform, resource_usage.value, job_id=job_id, session_id=session_id
+    )
+
+
+async def compact_quota_ledger_periodically(interval: float):
+    """Fold the quota ledger into the quota usage values every `interval` seconds"""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            n_entries = await db.compact_quota_ledger()
+        except Exception as err:
+            logger.error(f"Unable to compact quota ledger: {err}")
+        else:
+            if n_entries:
+                logger.info(f"Compacted {n_entries} quota ledger entries")
+
+
+async def evict_code_archives():
+    """
+    If the cache of code archives is full, delete the least recently used archives,
+    other than those still needed by jobs that have not yet run.
+    """
+    if archive_cache.is_full():
+        in_use = await db.get_code_archives_in_use(settings.TMP_FILE_URL)
+        await asyncio.get_running_loop().run_in_executor(
+            code_archive_executor, archive_cache.evict, in_use
+        )
+
+
+async def transfer_output_data(transfer_id: int, job: dict, repository_name: str, user):
+    """
+    Copy the output data files of a job to another repository,
+    several files at a time, updating the database as each file is copied.
+
+    Files already in the target repository (e.g. from an earlier, interrupted transfer)
+    are not copied again.
+    """
+    repository_obj = repository_lookup_by_name[repository_name]
+    dataset = DataSet.from_db(job["output_data"])
+    semaphore = asyncio.Semaphore(settings.FILE_TRANSFER_CONCURRENCY)
+    loop = asyncio.get_running_loop()
+    errors = []
+
+    async def transfer_file(data_item, file):
+        async with semaphore:
+            if file.url.host == repository_obj.host:
+                await db.record_file_transferred(transfer_id)
+                return
+            try:
+                new_url = await loop.run_in_executor(
+                    transfer_executor,
+                    partial(repository_obj.copy, file, user, collab=job["collab_id"]),
+                )
+            except Exception as err:
+                errors.append(f"{file.path}: {err}")
+                return
+            # we also store the path, since it can no longer be deduced from the original URL
+            await db.record_file_transferred(
+                transfer_id, data_item["id"], {"url": new_url, "path": file.path}
+            )
+
+    async def heartbeat():
+        # shows that the transfer is still in progress, see db.expire_stale_data_transfers()
+        while True:
+            await asyncio.sleep(settings.DATA_TRANSFER_HEARTBEAT_INTERVAL)
+            await db.update_data_transfer(transfer_id, {})
+
+    await db.update_data_transfer(transfer_id, {"status": "running"})
+    heartbeat_task = asyncio.create_task(heartbeat())
+    try:
+        await asyncio.gather(
+            *(
+                transfer_file(data_item, file)
+                for data_item, file in zip(job["output_data"], dataset.files)
+            )
+        )
+    except Exception as err:
+        errors.append(str(err))
+    finally:
+        heartbeat_task.cancel()
+    if errors:
+        logger.error(f"Errors transferring output data of job {job['id']}: {errors}")
+        values = {"status": "error", "error": "\n".join(errors)}
+    else:
+        values = {"status": "finished"}
+    values["timestamp_end"] = db.now_in_utc()
+    await db.update_data_transfer(transfer_id, values)
 
 
 def check_provider_matches_platform(provider_name: str, hardware_platform: str) -> bool:
@@ -78,35 +205,71 @@ def check_provider_matches_platform(provider_name: str, hardware_platform: str)
     return True
 
 
+def get_json_filters(query_params, fields=("hardware_config", "provenance")) -> dict:
+    """
+    Collect filters on the JSON fields of a job from query parameters
+    such as "hardware_config.wafer=62" or "provenance.software.pyNN=0.12.1".
+
+    Returns a dict containing, for each field, the (nested) structure that the
+    field must contain. Values are read as JSON where this gives back the same text
+    (e.g. 62, true), otherwise as strings (e.g. 0.12.1, 0.10); "62" is the string "62".
+    """
+    filters = {}
+    for key, text in query_params.multi_items():
+        field, _, path = key.partition(".")
+        if field not in fields or not path:
+            continue
+        try:
+            value = json.loads(text)
+        except ValueError:
+            value = text
+        else:
+            if not isinstance(value, (dict, list)) and json.dumps(value) != text:
+                value = text
+        *parents, name = path.split(".")
+        target = filters.setdefault(field, {})
+        for parent in parents:
+            target = target.setdefault(parent, {})
+            if not isinstance(target, dict):
+                break
+        if not isinstance(target, dict) or name in target:
+            raise HTTPException(
+                status_code=status_codes.HTTP_400_BAD_REQUEST,
+                detail=f"Conflicting values given for {key}",
+            )
+        target[name] = value
+    return filters
+
+
 async def create_test_quota(collab, hardware_platform, owner):
+    """
+    Create a demo project with a test quota for the given platform.
+
+    If several requests try to do this at the same time, only one project is created;
+    the others return None.
+    """
     today = date.today()
-    project = await db.create_project(
-        {
-            "collab": collab,
-            "owner": owner,
-            "title": f"Test access for the {hardware_platform} platform in collab '{collab}'",
-            "abstract": (
-                "This project was created automatically for demonstration/testing purposes. "
-                f"It gives you a test quota for the {hardware_platform} platform. "
-                f"All members of the '{collab}' collab workspace can use this quota. "
-                "When the test quotas are used up, you will need to request a new quota "
-                "through the Job Manager app or Python client, or by contacting EBRAINS support."
-            ),
-            "description": "",
-            "submission_date": today,
-        }
-    )
-    project_id = project["context"]
-    project = await db.update_project(project_id, {"accepted": True, "decision_date": today})
-    # for platform, limit in DEMO_QUOTA_SIZES.items():
+    project_data = {
+        "collab": collab,
+        "owner": owner,
+        "title": f"Test access for the {hardware_platform} platform in collab '{collab}'",
+        "abstract": (
+            "This project was created automatically for demonstration/testing purposes. "
+            f"It gives you a test quota for the {hardware_platform} platform. "
+            f"All members of the '{collab}' collab workspace can use this quota. "
+            "When the test quotas are used up, you will need to request a new quota "
+            "through the Job Manager app or Python client, or by contacting EBRAINS support."
+        ),
+        "description": "",
+        "submission_date": today,
+    }
     quota_data = {
         "platform": hardware_platform,
         "limit": DEMO_QUOTA_SIZES[hardware_platform],
         "usage": 0.0,
         "units": RESOURCE_USAGE_UNITS[hardware_platform],
     }
-    quota = await db.create_quota(project_id, quota_data)
-    return project, quota
+    return await db.provision_quota(collab, hardware_platform, project_data, quota_data)
 
 
 def send_email(recipient_email: str, body: str):